@@ -3,16 +3,18 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 # Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
 
-from typing import Any
+from typing import Any, Optional
 import argparse
-import binascii
 import libcamera as libcam
 import libcamera.utils
 import sys
+import time
 import traceback
 
 
 class CameraContext:
+    # The libcamera module, or libcamera.fake with --fake
+    backend: Any
     camera: libcam.Camera
     id: str
     idx: int
@@ -21,23 +23,24 @@ class CameraContext:
     opt_strict_formats: bool
     opt_crc: bool
     opt_metadata: bool
+    metadata_subscription: Optional[libcamera.utils.MetadataSubscription] = None
     opt_save_frames: bool
+    opt_stats: bool
     opt_capture: int
 
     stream_names: dict[libcam.Stream, str]
     streams: list[libcam.Stream]
+    pool: libcamera.utils.RequestPool
     allocator: libcam.FrameBufferAllocator
-    requests: list[libcam.Request]
-    reqs_queued: int
     reqs_completed: int
     last: int = 0
     fps: float
 
-    def __init__(self, camera, idx):
+    def __init__(self, camera, idx, backend=libcam):
+        self.backend = backend
         self.camera = camera
         self.idx = idx
         self.id = 'cam' + str(idx)
-        self.reqs_queued = 0
         self.reqs_completed = 0
 
     def do_cmd_list_props(self):
@@ -170,39 +173,20 @@ class CameraContext:
             print('{}-{}: stream config {}'.format(self.id, self.stream_names[stream], stream.configuration))
 
     def alloc_buffers(self):
-        allocator = libcam.FrameBufferAllocator(self.camera)
+        # The requests are created for the buffers, and requeued until
+        # opt_capture requests have been queued
+        self.pool = libcamera.utils.RequestPool(self.camera, self.streams, self.idx,
+                                                self.backend.FrameBufferAllocator(self.camera),
+                                                self.opt_capture)
+        self.allocator = self.pool.allocator
 
         for stream in self.streams:
-            allocated = allocator.allocate(stream)
+            print('{}-{}: Allocated {} buffers'.format(self.id, self.stream_names[stream],
+                                                       len(self.pool.buffers(stream))))
 
-            print('{}-{}: Allocated {} buffers'.format(self.id, self.stream_names[stream], allocated))
-
-        self.allocator = allocator
-
-    def create_requests(self):
-        self.requests = []
-
-        # Identify the stream with the least number of buffers
-        num_bufs = min([len(self.allocator.buffers(stream)) for stream in self.streams])
-
-        requests = []
-
-        for buf_num in range(num_bufs):
-            request = self.camera.create_request(self.idx)
-
-            if request is None:
-                print('Can not create request')
-                exit(-1)
-
-            for stream in self.streams:
-                buffers = self.allocator.buffers(stream)
-                buffer = buffers[buf_num]
-
-                request.add_buffer(stream, buffer)
-
-            requests.append(request)
-
-        self.requests = requests
+    @property
+    def reqs_queued(self):
+        return self.pool.queued
 
     def start(self):
         self.camera.start()
@@ -211,30 +195,40 @@ class CameraContext:
         self.camera.stop()
 
     def queue_requests(self):
-        for request in self.requests:
-            self.camera.queue_request(request)
-            self.reqs_queued += 1
-
-        del self.requests
+        self.pool.start()
 
 
 class CaptureState:
+    backend: Any
     cm: libcam.CameraManager
     contexts: list[CameraContext]
+    context_map: dict[int, CameraContext]
     renderer: Any
+    sinks: list[Any]
+    mfb_pool: libcamera.utils.MappedFrameBufferPool
+    display_policy: str
+    display_depth: int
 
-    def __init__(self, cm, contexts):
+    def __init__(self, cm, contexts, backend=libcam):
+        self.backend = backend
         self.cm = cm
         self.contexts = contexts
+        self.context_map = {ctx.idx: ctx for ctx in contexts}
+        self.mfb_pool = libcamera.utils.MappedFrameBufferPool.singleton()
+        self.sinks = []
+        self.display_policy = 'drop-oldest'
+        self.display_depth = 2
 
     # Called from renderer when there is a libcamera event
     def event_handler(self):
         try:
-            reqs = self.cm.get_ready_requests()
+            batch = self.cm.get_ready_request_batch()
 
-            for req in reqs:
-                ctx = next(ctx for ctx in self.contexts if ctx.idx == req.cookie)
-                self.__request_handler(ctx, req)
+            # The requests are grouped by their cookie, which is the context idx
+            for cookie, completions in batch.items():
+                ctx = self.context_map[cookie]
+                for completion in completions:
+                    self.__request_handler(ctx, completion)
 
             running = any(ctx.reqs_completed < ctx.opt_capture for ctx in self.contexts)
             return running
@@ -242,10 +236,17 @@ class CaptureState:
             traceback.print_exc()
             return False
 
-    def __request_handler(self, ctx, req):
-        if req.status != libcam.Request.Status.Complete:
+    def __request_handler(self, ctx, completion):
+        dispatch_ts = time.monotonic_ns()
+
+        req = completion.request
+
+        if req.status != self.backend.Request.Status.Complete:
             raise Exception('{}: Request failed: {}'.format(ctx.id, req.status))
 
+        # The renderer holds the request until it calls request_processed()
+        ctx.pool.take(req, completion.timestamp)
+
         buffers = req.buffers
 
         # Compute the frame rate. The timestamp is arbitrarily retrieved from
@@ -257,45 +258,32 @@ class CaptureState:
         ctx.fps = fps
 
         if ctx.opt_metadata:
-            reqmeta = req.metadata
-            for ctrl, val in reqmeta.items():
-                print(f'\t{ctrl} = {val}')
-
-        for stream, fb in buffers.items():
-            stream_name = ctx.stream_names[stream]
-
-            crcs = []
-            if ctx.opt_crc:
-                with libcamera.utils.MappedFrameBuffer(fb) as mfb:
-                    plane_crcs = [binascii.crc32(p) for p in mfb.planes]
-                    crcs.append(plane_crcs)
-
-            meta = fb.metadata
-
-            print('{:.6f} ({:.2f} fps) {}-{}: seq {}, bytes {}, CRCs {}'
-                  .format(ts / 1000000000, fps,
-                          ctx.id, stream_name,
-                          meta.sequence,
-                          '/'.join([str(p.bytes_used) for p in meta.planes]),
-                          crcs))
-
-            if ctx.opt_save_frames:
-                with libcamera.utils.MappedFrameBuffer(fb) as mfb:
-                    filename = 'frame-{}-{}-{}.data'.format(ctx.id, stream_name, ctx.reqs_completed)
-                    with open(filename, 'wb') as f:
-                        for p in mfb.planes:
-                            f.write(p)
+            if ctx.metadata_subscription:
+                record = ctx.metadata_subscription.read(req)
+                if record is not None:
+                    print('\t' + ', '.join(f'{k} = {v}' for k, v in record._asdict().items()))
+            else:
+                reqmeta = req.metadata
+                for ctrl, val in reqmeta.items():
+                    print(f'\t{ctrl} = {val}')
+
+        for sink in self.sinks:
+            sink.handle(ctx, req, completion, dispatch_ts)
 
         self.renderer.request_handler(ctx, req)
 
         ctx.reqs_completed += 1
 
-    # Called from renderer when it has finished with a request
+    # Take an additional hold of a completed request, to be released with
+    # request_processed(). May be called from any thread.
+    def hold_request(self, req):
+        self.context_map[req.cookie].pool.hold(req)
+
+    # Called from renderer when it has finished with a request, and by other
+    # holders of the request. The request is reused and queued again when the
+    # last holder has released it. May be called from any thread.
     def request_processed(self, ctx, req):
-        if ctx.reqs_queued < ctx.opt_capture:
-            req.reuse()
-            ctx.camera.queue_request(req)
-            ctx.reqs_queued += 1
+        ctx.pool.release(req)
 
     def __capture_init(self):
         for ctx in self.contexts:
@@ -307,8 +295,8 @@ class CaptureState:
         for ctx in self.contexts:
             ctx.alloc_buffers()
 
-        for ctx in self.contexts:
-            ctx.create_requests()
+        for sink in self.sinks:
+            sink.start()
 
     def __capture_start(self):
         for ctx in self.contexts:
@@ -318,9 +306,28 @@ class CaptureState:
             ctx.queue_requests()
 
     def __capture_deinit(self):
+        for ctx in self.contexts:
+            ctx.pool.stop()
+
+        for sink in self.sinks:
+            sink.close()
+
         for ctx in self.contexts:
             ctx.stop()
 
+        for ctx in self.contexts:
+            for stream in ctx.streams:
+                for fb in ctx.allocator.buffers(stream):
+                    self.mfb_pool.unmap(fb)
+
+        for ctx in self.contexts:
+            pool = ctx.pool
+            if pool.starved_count:
+                print('{}: Out of requests {} times, for {:.1f} ms in total'.format(
+                    ctx.id, pool.starved_count, pool.starved_time * 1000))
+
+            pool.close()
+
         for ctx in self.contexts:
             ctx.release()
 
@@ -376,22 +383,58 @@ def main():
     parser.add_argument('-p', '--list-properties', action='store_true', help='List cameras properties')
     parser.add_argument('--list-controls', action='store_true', help='List cameras controls')
     parser.add_argument('-I', '--info', action='store_true', help='Display information about stream(s)')
+    parser.add_argument('--fake', nargs='?', type=float, const=30.0, metavar='FPS', help='Use a fake camera producing FPS frames per second, instead of libcamera')
     parser.add_argument('-R', '--renderer', default='null', help='Renderer (null, kms, qt, qtgl)')
+    parser.add_argument('--display-policy', default='drop-oldest', choices=['drop-oldest', 'latest', 'fifo'], help='Policy of the kms and qtgl renderers when the display is slower than the camera: drop the oldest queued frame, show only the latest frame, or drop new frames when the queue is full')
+    parser.add_argument('--display-queue', type=int, default=2, help='Maximum number of frames waiting to be displayed')
+    parser.add_argument('--writer-threads', type=int, default=2, help='Number of threads writing the frames saved with --save-frames')
+    parser.add_argument('--writer-queue', type=int, default=8, help='Maximum number of requests waiting to be written before the writer policy applies')
+    parser.add_argument('--writer-policy', default='copy', choices=['copy', 'drop', 'hold'], help='Frame writer policy: copy frames and delay requeuing when the queue is full, copy frames and drop when full, or always hold the requests')
+    parser.add_argument('--writer-direct', action='store_true', help='Write the frames with O_DIRECT')
+    parser.add_argument('--crc-algorithm', default='crc32', choices=libcamera.utils.ChecksumEngine.ALGORITHMS, help='Checksum algorithm used with --crc')
+    parser.add_argument('--crc-threads', type=int, default=0, help='Number of threads computing the checksums, defaults to the number of CPUs')
+    parser.add_argument('--record', metavar='FILE', help='Record the captured frames and their metadata to FILE')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write the capture statistics to FILE as JSON at exit')
+    parser.add_argument('--metadata-controls', metavar='NAME[,NAME...]', help='With --metadata, print only the given controls, and only when their values change. With --record-metadata, record the given controls.')
+    parser.add_argument('--record-metadata', metavar='FILE', help='Record the per-frame metadata to FILE, in the metadata store format')
+    parser.add_argument('--sync', nargs='?', type=float, const=1000.0, metavar='TOLERANCE', help='Match the frames of the cameras whose timestamps differ by at most TOLERANCE microseconds, and report the skew')
+    parser.add_argument('--sync-depth', type=int, default=2, help='Number of frames per camera held for matching with --sync')
+    parser.add_argument('--publish', metavar='PREFIX', help='Publish the captured frames in shared memory segments named PREFIX-<camera>-<stream>')
 
     # per camera options
     parser.add_argument('-C', '--capture', nargs='?', type=int, const=1000000, action=CustomAction, help='Capture until interrupted by user or until CAPTURE frames captured')
-    parser.add_argument('--crc', nargs=0, type=bool, action=CustomAction, help='Print CRC32 for captured frames')
+    parser.add_argument('--crc', nargs=0, type=bool, action=CustomAction, help='Print checksums for captured frames')
     parser.add_argument('--save-frames', nargs=0, type=bool, action=CustomAction, help='Save captured frames to files')
+    parser.add_argument('--stats', nargs=0, type=bool, action=CustomAction, help='Print periodic frame pacing and latency statistics instead of per-frame information')
     parser.add_argument('--metadata', nargs=0, type=bool, action=CustomAction, help='Print the metadata for completed requests')
     parser.add_argument('--strict-formats', type=bool, nargs=0, action=CustomAction, help='Do not allow requested stream format(s) to be adjusted')
     parser.add_argument('-s', '--stream', nargs='+', action=CustomAction)
     args = parser.parse_args()
 
-    cm = libcam.CameraManager.singleton()
+    if args.sync is not None and args.sync <= 0:
+        print('Bad --sync tolerance', args.sync)
+        return -1
+
+    if args.fake:
+        import libcamera.fake as backend
+        cm = backend.CameraManager([backend.FakeCameraOptions(fps=args.fake)] * max(args.camera, default=1))
+    else:
+        backend = libcam
+        cm = backend.CameraManager.singleton()
 
     if args.list:
         do_cmd_list(cm)
 
+    metadata_ids = None
+    if args.metadata_controls:
+        metadata_ids = []
+        for name in args.metadata_controls.split(','):
+            id = getattr(backend.controls, name, None)
+            if not isinstance(id, backend.ControlId):
+                print('Unknown control', name)
+                return -1
+            metadata_ids.append(id)
+
     contexts = []
 
     for cam_idx in args.camera:
@@ -401,11 +444,15 @@ def main():
             print('Unable to find camera', cam_idx)
             return -1
 
-        ctx = CameraContext(camera, cam_idx)
+        ctx = CameraContext(camera, cam_idx, backend)
         ctx.opt_capture = args.capture.get(cam_idx, 0)
         ctx.opt_crc = args.crc.get(cam_idx, False)
         ctx.opt_save_frames = args.save_frames.get(cam_idx, False)
         ctx.opt_metadata = args.metadata.get(cam_idx, False)
+        if ctx.opt_metadata and metadata_ids:
+            ctx.metadata_subscription = libcamera.utils.MetadataSubscription(metadata_ids,
+                                                                             changes_only=True)
+        ctx.opt_stats = args.stats.get(cam_idx, False)
         ctx.opt_strict_formats = args.strict_formats.get(cam_idx, False)
         ctx.opt_stream = args.stream.get(cam_idx, ['role=viewfinder'])
         contexts.append(ctx)
@@ -425,7 +472,9 @@ def main():
     contexts = [ctx for ctx in contexts if ctx.opt_capture > 0]
 
     if contexts:
-        state = CaptureState(cm, contexts)
+        state = CaptureState(cm, contexts, backend)
+        state.display_policy = args.display_policy
+        state.display_depth = args.display_queue
 
         if args.renderer == 'null':
             import cam_null
@@ -445,8 +494,53 @@ def main():
 
         state.renderer = renderer
 
+        # The sinks get the completed requests in this order, before the
+        # renderer
+        import sinks
+
+        stats_sink = None
+        if args.stats_json or any(ctx.opt_stats for ctx in contexts):
+            stats_sink = sinks.StatsSink(state)
+            state.sinks.append(stats_sink)
+
+        state.sinks.append(sinks.InfoSink(state))
+
+        if any(ctx.opt_crc for ctx in contexts):
+            state.sinks.append(sinks.ChecksumSink(state, args.crc_algorithm, args.crc_threads))
+
+        if args.record:
+            state.sinks.append(sinks.RecordSink(state, args.record))
+
+        if args.record_metadata:
+            names = [id.name for id in metadata_ids] if metadata_ids else None
+            state.sinks.append(sinks.MetadataRecordSink(state, args.record_metadata, names))
+
+        if any(ctx.opt_save_frames for ctx in contexts):
+            state.sinks.append(sinks.SaveSink(state, args.writer_threads, args.writer_queue,
+                                              args.writer_policy, args.writer_direct))
+
+        if args.sync is not None:
+            if len(contexts) < 2:
+                print('--sync needs at least two cameras')
+                return -1
+
+            import frame_sync
+
+            sync_sink = frame_sync.FrameSyncSink(state, int(args.sync * 1000), args.sync_depth)
+            if not any(ctx.opt_stats for ctx in contexts):
+                sync_sink.listeners.append(frame_sync.print_set)
+            state.sinks.append(sync_sink)
+
+        if args.publish:
+            state.sinks.append(sinks.ShmPublisherSink(state, args.publish))
+
         state.do_cmd_capture()
 
+        if args.stats_json:
+            import json
+            with open(args.stats_json, 'w') as f:
+                json.dump(stats_sink.stats.to_dict(), f, indent=4)
+
     return 0
 
 
@@ -1,18 +1,14 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 # Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
 
+from display_queue import DisplayQueue
+from renderer import Renderer
 import pykms
-import selectors
-import sys
 
 
-class KMSRenderer:
+class KMSRenderer(Renderer):
     def __init__(self, state):
-        self.state = state
-
-        self.cm = state.cm
-        self.contexts = state.contexts
-        self.running = False
+        super().__init__(state)
 
         card = pykms.Card()
 
@@ -33,7 +29,7 @@ class KMSRenderer:
         self.crtc = crtc
         self.mode = mode
 
-        self.bufqueue = []
+        self.bufqueue = DisplayQueue(state, state.display_policy, state.display_depth)
         self.current = None
         self.next = None
         self.cam_2_drm = {}
@@ -79,8 +75,13 @@ class KMSRenderer:
         old = self.current
         self.current = self.next
 
-        if len(self.bufqueue) > 0:
-            self.next = self.bufqueue.pop(0)
+        queued = self.bufqueue.pop()
+        if queued:
+            ctx, req = queued
+            self.next = {
+                'camctx': ctx,
+                'camreq': req,
+            }
         else:
             self.next = None
 
@@ -99,7 +100,7 @@ class KMSRenderer:
             self.next = drmreq
             self.apply_request(drmreq)
         else:
-            self.bufqueue.append(drmreq)
+            self.bufqueue.push(drmreq['camctx'], drmreq['camreq'])
 
     # libcamera
 
@@ -147,32 +148,17 @@ class KMSRenderer:
             if ev.type == pykms.DrmEventType.FLIP_COMPLETE:
                 self.handle_page_flip(ev.seq, ev.time)
 
-    def readcam(self, fd):
-        self.running = self.state.event_handler()
-
-    def readkey(self, fileobj):
-        sys.stdin.readline()
-        self.running = False
+    def event_sources(self):
+        return [(self.card.fd, self.readdrm)]
 
     def run(self):
-        print('Capturing...')
-
-        self.running = True
-
-        sel = selectors.DefaultSelector()
-        sel.register(self.card.fd, selectors.EVENT_READ, self.readdrm)
-        sel.register(self.cm.event_fd, selectors.EVENT_READ, self.readcam)
-        sel.register(sys.stdin, selectors.EVENT_READ, self.readkey)
-
-        print('Press enter to exit')
+        super().run()
 
-        while self.running:
-            events = sel.select()
-            for key, mask in events:
-                callback = key.data
-                callback(key.fileobj)
+        # Release the requests not displayed
+        self.bufqueue.clear()
 
-        print('Exiting...')
+        if self.bufqueue.dropped:
+            print('Dropped {} frames not displayed in time'.format(self.bufqueue.dropped))
 
     def request_handler(self, ctx, req):
 
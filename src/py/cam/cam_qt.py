@@ -1,11 +1,13 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 # Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
 
+from concurrent.futures import ThreadPoolExecutor
 from helpers import mfb_to_rgb
 from PyQt5 import QtCore, QtGui, QtWidgets
+from renderer import QtEventLoopRenderer
 import libcamera as libcam
 import libcamera.utils
-import sys
+import threading
 
 
 # Loading MJPEG to a QPixmap produces corrupt JPEG data warnings. Ignore these.
@@ -24,23 +26,39 @@ def qt_message_handler(msg_type, msg_log_context, msg_string):
 old_msg_handler = QtCore.qInstallMessageHandler(qt_message_handler)
 
 
-def rgb_to_pix(rgb):
+def rgb_to_qimage(rgb):
     w = rgb.shape[1]
     h = rgb.shape[0]
-    qim = QtGui.QImage(rgb, w, h, QtGui.QImage.Format.Format_RGB888)
-    pix = QtGui.QPixmap.fromImage(qim)
-    return pix
+    qim = QtGui.QImage(rgb, w, h, rgb.strides[0], QtGui.QImage.Format.Format_RGB888)
+    # Detach the image from the array
+    return qim.copy()
 
 
-class QtRenderer:
-    def __init__(self, state):
-        self.state = state
+# Convert a frame to a QImage. Called in the converter threads.
+def buf_to_qimage(mfb, cfg, max_size):
+    if cfg.pixel_format == libcam.formats.MJPEG:
+        qim = QtGui.QImage()
+        qim.loadFromData(mfb.planes[0])
+    else:
+        # Convert only the pixels that fit in the preview
+        rgb = mfb_to_rgb(mfb, cfg, max_size)
+        if rgb is None:
+            raise Exception('Format not supported: ' + str(cfg.pixel_format))
+
+        qim = rgb_to_qimage(rgb)
+
+    return qim
 
-        self.cm = state.cm
-        self.contexts = state.contexts
+
+class QtRenderer(QtEventLoopRenderer):
+    # Number of threads converting the frames
+    CONVERT_THREADS = 2
 
     def setup(self):
-        self.app = QtWidgets.QApplication([])
+        super().setup()
+
+        self.executor = ThreadPoolExecutor(self.CONVERT_THREADS,
+                                           thread_name_prefix='qt-convert')
 
         windows = []
 
@@ -63,27 +81,10 @@ class QtRenderer:
         self.buf_mmap_map = buf_mmap_map
 
     def run(self):
-        camnotif = QtCore.QSocketNotifier(self.cm.event_fd, QtCore.QSocketNotifier.Read)
-        camnotif.activated.connect(lambda _: self.readcam())
-
-        keynotif = QtCore.QSocketNotifier(sys.stdin.fileno(), QtCore.QSocketNotifier.Read)
-        keynotif.activated.connect(lambda _: self.readkey())
-
-        print('Capturing...')
-
-        self.app.exec()
-
-        print('Exiting...')
-
-    def readcam(self):
-        running = self.state.event_handler()
-
-        if not running:
-            self.app.quit()
+        super().run()
 
-    def readkey(self):
-        sys.stdin.readline()
-        self.app.quit()
+        # Let the conversions in progress release their requests
+        self.executor.shutdown()
 
     def request_handler(self, ctx, req):
         buffers = req.buffers
@@ -91,36 +92,104 @@ class QtRenderer:
         for stream, fb in buffers.items():
             wnd = next(wnd for wnd in self.windows if wnd.stream == stream)
 
+            wnd.update_info()
+
+            if not wnd.begin_conversion(self.CONVERT_THREADS):
+                continue
+
+            # The request is held until the frame has been converted
+            self.state.hold_request(req)
+
             mfb = self.buf_mmap_map[fb]
 
-            wnd.handle_request(stream, mfb)
+            self.executor.submit(self.__convert, ctx, req, wnd, stream.configuration, mfb,
+                                 fb.metadata.sequence, wnd.label.target_size())
+
+        self.state.request_processed(ctx, req)
+
+    def __convert(self, ctx, req, wnd, cfg, mfb, seq, max_size):
+        try:
+            qim = buf_to_qimage(mfb, cfg, max_size)
+        except Exception as e:
+            print(f'{ctx.id}: Frame conversion failed: {e}')
+            qim = None
 
+        # The frame data has been consumed
         self.state.request_processed(ctx, req)
 
+        wnd.end_conversion(seq, qim)
+
     def cleanup(self):
         for w in self.windows:
             w.close()
 
 
+# A label showing the preview, scaled to the size of the label. A new pixmap
+# is pending until it has been painted.
+class PreviewLabel(QtWidgets.QLabel):
+    def __init__(self):
+        super().__init__()
+
+        self.pending = False
+
+        self.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Ignored)
+        self.setMinimumSize(64, 64)
+        self.setAlignment(QtCore.Qt.AlignCenter)
+
+    def target_size(self):
+        ratio = self.devicePixelRatioF()
+        return (int(self.width() * ratio), int(self.height() * ratio))
+
+    def set_preview(self, pix):
+        w, h = self.target_size()
+
+        if pix.width() > w or pix.height() > h:
+            pix = pix.scaled(w, h, QtCore.Qt.KeepAspectRatio, QtCore.Qt.FastTransformation)
+
+        pix.setDevicePixelRatio(self.devicePixelRatioF())
+
+        self.setPixmap(pix)
+        self.pending = True
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        self.pending = False
+
+
 class MainWindow(QtWidgets.QWidget):
+    # Initial maximum size of the preview
+    PREVIEW_SIZE = (800, 600)
+
+    # Emitted from the converter threads when a new image is available
+    image_ready = QtCore.pyqtSignal()
+
     def __init__(self, ctx, stream):
         super().__init__()
 
         self.ctx = ctx
         self.stream = stream
+        self.dropped = 0
+
+        # The conversions in progress and the newest converted image, shared
+        # with the converter threads
+        self.__lock = threading.Lock()
+        self.__inflight = 0
+        self.__image = None
+        self.__image_seq = -1
+        self.__posted = False
+
+        self.image_ready.connect(self.__show_image)
 
-        self.label = QtWidgets.QLabel()
+        self.label = PreviewLabel()
 
         windowLayout = QtWidgets.QHBoxLayout()
         self.setLayout(windowLayout)
 
-        windowLayout.addWidget(self.label)
+        windowLayout.addWidget(self.label, 1)
 
         controlsLayout = QtWidgets.QVBoxLayout()
         windowLayout.addLayout(controlsLayout)
 
-        windowLayout.addStretch()
-
         group = QtWidgets.QGroupBox('Info')
         groupLayout = QtWidgets.QVBoxLayout()
         group.setLayout(groupLayout)
@@ -157,26 +226,57 @@ class MainWindow(QtWidgets.QWidget):
 
         controlsLayout.addStretch()
 
-    def buf_to_qpixmap(self, stream, mfb):
-        cfg = stream.configuration
+        size = stream.configuration.size
+        scale = min(self.PREVIEW_SIZE[0] / size.width, self.PREVIEW_SIZE[1] / size.height, 1)
+        self.resize(int(size.width * scale) + controlsLayout.sizeHint().width(),
+                    max(int(size.height * scale), controlsLayout.sizeHint().height()))
 
-        if cfg.pixel_format == libcam.formats.MJPEG:
-            pix = QtGui.QPixmap(cfg.size.width, cfg.size.height)
-            pix.loadFromData(mfb.planes[0])
-        else:
-            rgb = mfb_to_rgb(mfb, cfg)
-            if rgb is None:
-                raise Exception('Format not supported: ' + cfg.pixel_format)
+    # Called in the GUI thread. Returns False if the frame is to be dropped,
+    # as the previous preview has not been painted yet or all the converter
+    # threads are busy with the frames of this window. The previews of a
+    # hidden or minimized window are not painted, so they are not waited for.
+    def begin_conversion(self, max_inflight):
+        painted = self.label.isVisible() and not self.isMinimized()
 
-            pix = rgb_to_pix(rgb)
+        with self.__lock:
+            if (self.label.pending and painted) or self.__inflight >= max_inflight:
+                self.dropped += 1
+                return False
 
-        return pix
+            self.__inflight += 1
+            return True
 
-    def handle_request(self, stream, mfb):
-        ctx = self.ctx
+    # Called in the converter threads. Only the newest image is kept, and it
+    # is posted to the GUI thread unless a post is already pending.
+    def end_conversion(self, seq, qim):
+        with self.__lock:
+            self.__inflight -= 1
+
+            if qim is None or seq <= self.__image_seq:
+                return
+
+            self.__image = qim
+            self.__image_seq = seq
+
+            if self.__posted:
+                return
 
-        pix = self.buf_to_qpixmap(stream, mfb)
-        self.label.setPixmap(pix)
+            self.__posted = True
+
+        self.image_ready.emit()
+
+    def __show_image(self):
+        with self.__lock:
+            qim = self.__image
+            self.__image = None
+            self.__posted = False
+
+        if qim is not None:
+            self.label.set_preview(QtGui.QPixmap.fromImage(qim))
+
+    def update_info(self):
+        ctx = self.ctx
 
-        self.frameLabel.setText('Queued: {}\nDone: {}\nFps: {:.2f}'
-                                .format(ctx.reqs_queued, ctx.reqs_completed, ctx.fps))
+        self.frameLabel.setText('Queued: {}\nDone: {}\nFps: {:.2f}\nDropped: {}'
+                                .format(ctx.reqs_queued, ctx.reqs_completed, ctx.fps,
+                                        self.dropped))
@@ -1,12 +1,13 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 # Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
 
-from PyQt5 import QtCore, QtWidgets
+from PyQt5 import QtWidgets
 from PyQt5.QtCore import Qt
 
+import libcamera as libcam
+import libcamera.utils
 import math
 import os
-import sys
 
 os.environ['PYOPENGL_PLATFORM'] = 'egl'
 
@@ -23,7 +24,9 @@ from OpenGL.GLES3.VERSION.GLES3_3_0 import *
 
 from OpenGL.GL import shaders
 
+from display_queue import DisplayQueue
 from gl_helpers import *
+from renderer import QtEventLoopRenderer
 
 
 class EglState:
@@ -129,12 +132,9 @@ class EglState:
         assert(glEGLImageTargetTexture2DOES)
 
 
-class QtRenderer:
-    def __init__(self, state):
-        self.state = state
-
+class QtRenderer(QtEventLoopRenderer):
     def setup(self):
-        self.app = QtWidgets.QApplication([])
+        super().setup()
 
         window = MainWindow(self.state)
         window.show()
@@ -142,27 +142,17 @@ class QtRenderer:
         self.window = window
 
     def run(self):
-        camnotif = QtCore.QSocketNotifier(self.state.cm.event_fd, QtCore.QSocketNotifier.Read)
-        camnotif.activated.connect(lambda _: self.readcam())
-
-        keynotif = QtCore.QSocketNotifier(sys.stdin.fileno(), QtCore.QSocketNotifier.Read)
-        keynotif.activated.connect(lambda _: self.readkey())
-
-        print('Capturing...')
-
-        self.app.exec()
+        super().run()
 
-        print('Exiting...')
+        self.window.destroy_textures()
 
-    def readcam(self):
-        running = self.state.event_handler()
+        # Release the requests not displayed
+        for queue in self.window.reqqueue.values():
+            queue.clear()
 
-        if not running:
-            self.app.quit()
-
-    def readkey(self):
-        sys.stdin.readline()
-        self.app.quit()
+        dropped = sum(q.dropped for q in self.window.reqqueue.values())
+        if dropped:
+            print('Dropped {} frames not displayed in time'.format(dropped))
 
     def request_handler(self, ctx, req):
         self.window.handle_request(ctx, req)
@@ -180,13 +170,17 @@ class MainWindow(QtWidgets.QWidget):
 
         self.state = state
 
+        # The texture shown for each stream
         self.textures = {}
+        # The EGLImage and texture of each FrameBuffer
+        self.fb_textures = {}
         self.reqqueue = {}
         self.current = {}
 
         for ctx in self.state.contexts:
 
-            self.reqqueue[ctx.idx] = []
+            self.reqqueue[ctx.idx] = DisplayQueue(state, state.display_policy,
+                                                  state.display_depth)
             self.current[ctx.idx] = []
 
             for stream in ctx.streams:
@@ -259,22 +253,84 @@ class MainWindow(QtWidgets.QWidget):
         glVertexAttribPointer(inputAttrib, 2, GL_FLOAT, GL_FALSE, 0, vertPositions)
         glEnableVertexAttribArray(inputAttrib)
 
+        self.create_textures()
+
+    # The buffers are allocated before the capture is started and don't
+    # change, so each buffer is imported as an EGLImage and a texture once,
+    # and the texture is reused for every frame captured to the buffer.
+    def create_textures(self):
+        for ctx in self.state.contexts:
+            for stream in ctx.streams:
+                for fb in ctx.allocator.buffers(stream):
+                    self.fb_textures[fb] = self.create_texture(stream, fb)
+
+    def destroy_textures(self):
+        if not self.fb_textures:
+            return
+
+        b = eglMakeCurrent(self.egl.display, self.surface, self.surface, self.egl.context)
+        assert(b)
+
+        for image, texture in self.fb_textures.values():
+            glDeleteTextures(1, [texture])
+            eglDestroyImageKHR(self.egl.display, image)
+
+        self.fb_textures = {}
+
+    PLANE_ATTRIBS = [
+        (EGL_DMA_BUF_PLANE0_FD_EXT, EGL_DMA_BUF_PLANE0_OFFSET_EXT, EGL_DMA_BUF_PLANE0_PITCH_EXT),
+        (EGL_DMA_BUF_PLANE1_FD_EXT, EGL_DMA_BUF_PLANE1_OFFSET_EXT, EGL_DMA_BUF_PLANE1_PITCH_EXT),
+        (EGL_DMA_BUF_PLANE2_FD_EXT, EGL_DMA_BUF_PLANE2_OFFSET_EXT, EGL_DMA_BUF_PLANE2_PITCH_EXT),
+    ]
+
+    YUV_COLOR_SPACES = {
+        libcam.ColorSpace.YcbcrEncoding.Rec601: EGL_ITU_REC601_EXT,
+        libcam.ColorSpace.YcbcrEncoding.Rec709: EGL_ITU_REC709_EXT,
+        libcam.ColorSpace.YcbcrEncoding.Rec2020: EGL_ITU_REC2020_EXT,
+    }
+
     def create_texture(self, stream, fb):
         cfg = stream.configuration
         fmt = cfg.pixel_format.fourcc
         w = cfg.size.width
         h = cfg.size.height
 
+        info = libcamera.utils.PixelFormatInfo.info(cfg.pixel_format)
+
         attribs = [
             EGL_WIDTH, w,
             EGL_HEIGHT, h,
             EGL_LINUX_DRM_FOURCC_EXT, fmt,
-            EGL_DMA_BUF_PLANE0_FD_EXT, fb.planes[0].fd,
-            EGL_DMA_BUF_PLANE0_OFFSET_EXT, 0,
-            EGL_DMA_BUF_PLANE0_PITCH_EXT, cfg.stride,
-            EGL_NONE,
         ]
 
+        for p in range(info.num_planes):
+            if len(fb.planes) == info.num_planes:
+                fd = fb.planes[p].fd
+                offset = fb.planes[p].offset
+            else:
+                # All the format planes are stored contiguously in one buffer plane
+                fd = fb.planes[0].fd
+                offset = fb.planes[0].offset + info.plane_offset(h, cfg.stride, p)
+
+            fd_attr, offset_attr, pitch_attr = self.PLANE_ATTRIBS[p]
+            attribs += [
+                fd_attr, fd,
+                offset_attr, offset,
+                pitch_attr, info.plane_stride(cfg.stride, p),
+            ]
+
+        # Let the driver convert YUV to RGB according to the color space
+        cs = cfg.color_space
+        if info.colour_encoding == info.ColourEncodingYUV and cs is not None and \
+           cs.ycbcrEncoding in self.YUV_COLOR_SPACES:
+            full = cs.range == libcam.ColorSpace.Range.Full
+            attribs += [
+                EGL_YUV_COLOR_SPACE_HINT_EXT, self.YUV_COLOR_SPACES[cs.ycbcrEncoding],
+                EGL_SAMPLE_RANGE_HINT_EXT, EGL_YUV_FULL_RANGE_EXT if full else EGL_YUV_NARROW_RANGE_EXT,
+            ]
+
+        attribs.append(EGL_NONE)
+
         image = eglCreateImageKHR(self.egl.display,
                                   EGL_NO_CONTEXT,
                                   EGL_LINUX_DMA_BUF_EXT,
@@ -282,15 +338,15 @@ class MainWindow(QtWidgets.QWidget):
                                   attribs)
         assert(image)
 
-        textures = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_EXTERNAL_OES, textures)
+        texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_EXTERNAL_OES, texture)
         glTexParameteri(GL_TEXTURE_EXTERNAL_OES, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
         glTexParameteri(GL_TEXTURE_EXTERNAL_OES, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
         glTexParameteri(GL_TEXTURE_EXTERNAL_OES, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
         glTexParameteri(GL_TEXTURE_EXTERNAL_OES, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
         glEGLImageTargetTexture2DOES(GL_TEXTURE_EXTERNAL_OES, image)
 
-        return textures
+        return image, texture
 
     def resizeEvent(self, event):
         size = event.size()
@@ -319,12 +375,11 @@ class MainWindow(QtWidgets.QWidget):
                 self.current[ctx_idx] = None
                 self.state.request_processed(ctx, old)
 
-            next_req = queue.pop(0)
+            _, next_req = queue.pop()
             self.current[ctx_idx] = next_req
 
-            stream, fb = next(iter(next_req.buffers.items()))
-
-            self.textures[stream] = self.create_texture(stream, fb)
+            for stream, fb in next_req.buffers.items():
+                self.textures[stream] = self.fb_textures[fb][1]
 
         self.paint_gl()
 
@@ -359,5 +414,5 @@ class MainWindow(QtWidgets.QWidget):
         assert(b)
 
     def handle_request(self, ctx, req):
-        self.reqqueue[ctx.idx].append(req)
+        self.reqqueue[ctx.idx].push(ctx, req)
         self.update()
@@ -0,0 +1,206 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+#
+# Fixed-point YUV to RGB conversion
+
+from typing import Optional
+import libcamera as libcam
+import numpy as np
+
+
+# Kr and Kb of the Y'CbCr encodings
+_ENCODINGS = {
+    libcam.ColorSpace.YcbcrEncoding.Rec601: (0.299, 0.114),
+    libcam.ColorSpace.YcbcrEncoding.Rec709: (0.2126, 0.0722),
+    libcam.ColorSpace.YcbcrEncoding.Rec2020: (0.2627, 0.0593),
+}
+
+# Packed YUV 4:2:2 formats, as the channel of Y and the channel and the
+# pixel parity (even or odd) of U and V in the (h, w, 2) array
+_PACKED_FORMATS = {
+    'YUYV': (0, (1, 0), (1, 1)),
+    'YVYU': (0, (1, 1), (1, 0)),
+    'UYVY': (1, (0, 0), (0, 1)),
+    'VYUY': (1, (0, 1), (0, 0)),
+}
+
+# Semi-planar YUV 4:2:0 formats, as the channel of U and V in the CbCr plane
+_SEMIPLANAR_FORMATS = {
+    'NV12': (0, 1),
+    'NV21': (1, 0),
+}
+
+# Planar YUV 4:2:0 formats, as the plane of U and V
+_PLANAR_FORMATS = {
+    'YUV420': (1, 2),
+    'YVU420': (2, 1),
+}
+
+# Fractional bits of the fixed-point values
+_SHIFT = 16
+
+
+class YUVConverter:
+    """
+    Converts YUV frames to 24-bit RGB with integer arithmetic
+
+    The conversion coefficients are chosen by the Y'CbCr encoding and the
+    range of the color space, and applied through lookup tables holding
+    fixed-point values, so the per-pixel work is table lookups, additions and
+    shifts in int32. Chroma terms are computed at the chroma resolution and
+    broadcast over the luma samples, instead of upsampling the chroma planes.
+
+    The frame is converted in tiles of tile_rows rows, with preallocated
+    temporary arrays, to keep the working set small.
+    """
+
+    FORMATS = list(_PACKED_FORMATS) + list(_SEMIPLANAR_FORMATS) + list(_PLANAR_FORMATS)
+
+    def __init__(self, color_space: Optional[libcam.ColorSpace] = None, tile_rows: int = 32):
+        # Without a color space, use the JPEG conversion, Rec601 full range
+        if color_space is None or color_space.ycbcrEncoding not in _ENCODINGS:
+            encoding = libcam.ColorSpace.YcbcrEncoding.Rec601
+            full_range = True
+        else:
+            encoding = color_space.ycbcrEncoding
+            full_range = color_space.range == libcam.ColorSpace.Range.Full
+
+        self.encoding = encoding
+        self.full_range = full_range
+        self.__tile_rows = tile_rows & ~1
+        self.__scratch: dict[tuple[int, int], tuple[np.ndarray, np.ndarray]] = {}
+
+        kr, kb = _ENCODINGS[encoding]
+        kg = 1 - kr - kb
+
+        if full_range:
+            y_scale, y_offset, c_scale = 1.0, 0, 1.0
+        else:
+            y_scale, y_offset, c_scale = 255 / 219, 16, 255 / 224
+
+        one = 1 << _SHIFT
+        v = np.arange(256, dtype=np.float64)
+        c = (v - 128) * c_scale
+
+        def lut(values):
+            return np.round(values * one).astype(np.int32)
+
+        # The rounding offset is included in the Y table
+        self.__y = lut((v - y_offset) * y_scale) + (one >> 1)
+        self.__rv = lut(c * 2 * (1 - kr))
+        self.__gu = lut(c * -2 * kb * (1 - kb) / kg)
+        self.__gv = lut(c * -2 * kr * (1 - kr) / kg)
+        self.__bu = lut(c * 2 * (1 - kb))
+
+    def convert(self, fmt, planes: list[np.ndarray], out: Optional[np.ndarray] = None,
+                step: int = 1) -> np.ndarray:
+        """
+        Convert a frame to RGB, as a (height, width, 3) uint8 array
+
+        The planes are the NumPy views of the format planes, as returned by
+        MappedFrameBuffer.as_ndarray(). The width must be even, and for the
+        4:2:0 formats also the height. If out is given, the result is written
+        to it. out must be a C-contiguous uint8 array of the shape of the
+        result.
+
+        With step larger than 1, only every step'th pixel of every step'th
+        line is converted, for an image downscaled by step. step must be 1 or
+        even.
+        """
+        if step > 1 and step % 2:
+            raise ValueError(f'Bad decimation step {step}')
+
+        fmt = str(fmt)
+
+        if fmt in _PACKED_FORMATS:
+            ych, (uch, upar), (vch, vpar) = _PACKED_FORMATS[fmt]
+            data = planes[0]
+            y = data[:, :, ych]
+            u = data[:, upar::2, uch]
+            v = data[:, vpar::2, vch]
+            vsub = 1
+        elif fmt in _SEMIPLANAR_FORMATS:
+            uch, vch = _SEMIPLANAR_FORMATS[fmt]
+            y = planes[0]
+            u = planes[1][:, :, uch]
+            v = planes[1][:, :, vch]
+            vsub = 2
+        elif fmt in _PLANAR_FORMATS:
+            up, vp = _PLANAR_FORMATS[fmt]
+            y = planes[0]
+            u = planes[up]
+            v = planes[vp]
+            vsub = 2
+        else:
+            raise ValueError(f'Unsupported format {fmt}')
+
+        hsub = 2
+
+        if y.shape[1] % hsub:
+            raise ValueError(f'{fmt} needs an even width, got {y.shape[1]}')
+        if y.shape[0] % vsub:
+            raise ValueError(f'{fmt} needs an even height, got {y.shape[0]}')
+
+        # The chroma planes may be wider than the image due to padding
+        cw = y.shape[1] // 2
+        u = u[:, :cw]
+        v = v[:, :cw]
+
+        if step > 1:
+            # Pick the chroma samples of the picked luma samples, leaving the
+            # chroma at the luma resolution
+            y = y[::step, ::step]
+            u = u[::step // vsub, ::step // hsub]
+            v = v[::step // vsub, ::step // hsub]
+            vsub = hsub = 1
+
+        h, w = y.shape
+
+        if out is None:
+            out = np.empty((h, w, 3), dtype=np.uint8)
+        elif out.shape != (h, w, 3) or out.dtype != np.uint8 or not out.flags.c_contiguous:
+            # The tiles are converted through reshaped views of out, which
+            # would be copies for other layouts
+            raise ValueError(f'out must be a C-contiguous ({h}, {w}, 3) uint8 array')
+
+        for r0 in range(0, h, self.__tile_rows):
+            r1 = min(r0 + self.__tile_rows, h)
+            self.__convert_tile(y[r0:r1], u[r0 // vsub:r1 // vsub], v[r0 // vsub:r1 // vsub],
+                                vsub, hsub, out[r0:r1])
+
+        return out
+
+    def __convert_tile(self, y, u, v, vsub, hsub, out):
+        th, w = y.shape
+        cw = w // hsub
+
+        luma, tmp = self.__get_scratch(th, w)
+
+        np.take(self.__y, y, out=luma)
+
+        # Group the luma samples sharing the same chroma sample on their own
+        # axes, and broadcast the chroma terms over them
+        luma = luma.reshape(th // vsub, vsub, cw, hsub)
+        tmp = tmp.reshape(th // vsub, vsub, cw, hsub)
+        out = out.reshape(th // vsub, vsub, cw, hsub, 3)
+
+        def channel(term, c):
+            np.add(luma, term[:, None, :, None], out=tmp)
+            np.right_shift(tmp, _SHIFT, out=tmp)
+            np.clip(tmp, 0, 255, out=tmp)
+            out[..., c] = tmp
+
+        channel(self.__rv[v], 0)
+        channel(self.__gu[u] + self.__gv[v], 1)
+        channel(self.__bu[u], 2)
+
+    def __get_scratch(self, rows, width):
+        key = (rows, width)
+        scratch = self.__scratch.get(key)
+
+        if scratch is None:
+            scratch = (np.empty((rows, width), dtype=np.int32),
+                       np.empty((rows, width), dtype=np.int32))
+            self.__scratch[key] = scratch
+
+        return scratch
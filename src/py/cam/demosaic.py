@@ -0,0 +1,232 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+#
+# Bayer demosaicing to 24-bit RGB
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import numpy as np
+
+# Offsets of the neighbouring samples
+_C = [(0, 0)]
+_CROSS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+_DIAG = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+_NS = [(-1, 0), (1, 0)]
+_WE = [(0, -1), (0, 1)]
+_NS2 = [(-2, 0), (2, 0)]
+_WE2 = [(0, -2), (0, 2)]
+_CROSS2 = _NS2 + _WE2
+
+# The filters are lists of (weight, taps) and the number of fractional bits
+# of the weights. Each filter computes one color component at one of the
+# four positions of the 2x2 Bayer pattern.
+
+_NATIVE = ([(1, _C)], 0)
+
+_BILINEAR = {
+    'cross': ([(1, _CROSS)], 2),
+    'diag': ([(1, _DIAG)], 2),
+    'ns': ([(1, _NS)], 1),
+    'we': ([(1, _WE)], 1),
+}
+
+# Malvar, He, Cutler: High-quality linear interpolation for demosaicing of
+# Bayer-patterned color images, ICASSP 2004. The weights are in 1/16.
+_MALVAR = {
+    'cross': ([(8, _C), (4, _CROSS), (-2, _CROSS2)], 4),
+    'diag': ([(12, _C), (4, _DIAG), (-3, _CROSS2)], 4),
+    'ns': ([(10, _C), (8, _NS), (-2, _NS2), (-2, _DIAG), (1, _WE2)], 4),
+    'we': ([(10, _C), (8, _WE), (-2, _WE2), (-2, _DIAG), (1, _NS2)], 4),
+}
+
+# Border of the padded input, enough for the 5x5 filters
+_PAD = 2
+
+
+class Demosaicer:
+    """
+    Converts Bayer frames of a fixed size and order to 24-bit RGB
+
+    The modes are:
+
+    - 'bilinear': bilinear interpolation of the missing components
+    - 'malvar': the gradient-corrected interpolation by Malvar, He and Cutler
+    - 'binned': each 2x2 quad becomes one pixel, for a half size output
+
+    The scratch buffers are allocated once, and reused for all the frames,
+    so a Demosaicer must not be used from multiple threads at the same time.
+    The edges are handled by mirroring the frame, which keeps the Bayer
+    order, so no normalization of the edge pixels is needed. With
+    num_threads, bands of rows are processed in parallel.
+    """
+
+    MODES = ['bilinear', 'malvar', 'binned']
+
+    ORDERS = ['RGGB', 'GRBG', 'GBRG', 'BGGR']
+
+    def __init__(self, width: int, height: int, order: str, bits: int = 8,
+                 mode: str = 'bilinear', num_threads: int = 0):
+        if mode not in Demosaicer.MODES:
+            raise ValueError(f'Bad demosaic mode {mode}')
+        if order not in Demosaicer.ORDERS:
+            raise ValueError(f'Bad Bayer order {order}')
+        if width % 2 or height % 2:
+            raise ValueError(f'Bad Bayer frame size {width}x{height}')
+
+        self.width = width
+        self.height = height
+        self.order = order
+        self.bits = bits
+        self.mode = mode
+
+        self.__out_shift = max(bits - 8, 0)
+
+        pos = {c: (i // 2, i % 2) for i, c in enumerate(order) if c != 'G'}
+        ry, rx = pos['R']
+        by, bx = pos['B']
+        self.__r = (ry, rx)
+        self.__b = (by, bx)
+        # G in the R rows and G in the B rows
+        self.__gr = (ry, 1 - rx)
+        self.__gb = (by, 1 - bx)
+
+        if mode == 'binned':
+            self.__bands = [(0, height)]
+            self.__pool = None
+            return
+
+        filters = _BILINEAR if mode == 'bilinear' else _MALVAR
+
+        # (position, filter) for each of R, G and B
+        self.__filters = [
+            [(self.__r, _NATIVE), (self.__gr, filters['we']), (self.__gb, filters['ns']),
+             (self.__b, filters['diag'])],
+            [(self.__r, filters['cross']), (self.__gr, _NATIVE), (self.__gb, _NATIVE),
+             (self.__b, filters['cross'])],
+            [(self.__r, filters['diag']), (self.__gr, filters['ns']), (self.__gb, filters['we']),
+             (self.__b, _NATIVE)],
+        ]
+
+        self.__padded = np.empty((height + 2 * _PAD, width + 2 * _PAD), dtype=np.int32)
+
+        num_bands = max(num_threads, 1)
+        band_rows = (height // num_bands + 1) & ~1
+        self.__bands = [(r, min(r + band_rows, height)) for r in range(0, height, band_rows)]
+
+        # The accumulator and a temporary for each band
+        self.__scratch = [
+            (np.empty(((r1 - r0) // 2, width // 2), dtype=np.int32),
+             np.empty(((r1 - r0) // 2, width // 2), dtype=np.int32))
+            for r0, r1 in self.__bands
+        ]
+
+        self.__pool = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+
+    def close(self):
+        if self.__pool:
+            self.__pool.shutdown()
+            self.__pool = None
+
+    @property
+    def output_shape(self) -> tuple[int, int, int]:
+        if self.mode == 'binned':
+            return (self.height // 2, self.width // 2, 3)
+        return (self.height, self.width, 3)
+
+    def process(self, data: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Demosaic a frame, given as a (height, width) array of samples
+
+        The result is an RGB uint8 array of output_shape. If out is given,
+        the result is written to it.
+        """
+        if data.shape[0] < self.height or data.shape[1] < self.width:
+            raise ValueError(f'Frame is smaller than {self.width}x{self.height}')
+
+        data = data[:self.height, :self.width]
+
+        if out is None:
+            out = np.empty(self.output_shape, dtype=np.uint8)
+
+        if self.mode == 'binned':
+            self.__binned(data, out)
+            return out
+
+        self.__pad(data)
+
+        if self.__pool:
+            futures = [self.__pool.submit(self.__process_band, i, out)
+                       for i in range(len(self.__bands))]
+            for f in futures:
+                f.result()
+        else:
+            for i in range(len(self.__bands)):
+                self.__process_band(i, out)
+
+        return out
+
+    def __pad(self, data):
+        p = self.__padded
+        h = self.height
+        w = self.width
+
+        p[_PAD:_PAD + h, _PAD:_PAD + w] = data
+
+        # Mirror the edges without repeating the edge pixels, as with
+        # np.pad(mode='reflect'), which keeps the Bayer order
+        for i in range(1, _PAD + 1):
+            p[_PAD - i] = p[_PAD + i]
+            p[_PAD + h - 1 + i] = p[_PAD + h - 1 - i]
+        for i in range(1, _PAD + 1):
+            p[:, _PAD - i] = p[:, _PAD + i]
+            p[:, _PAD + w - 1 + i] = p[:, _PAD + w - 1 - i]
+
+    def __process_band(self, band, out):
+        r0, r1 = self.__bands[band]
+        acc, tmp = self.__scratch[band]
+        p = self.__padded
+
+        def tap(y, x, dy, dx):
+            # The samples at offset (dy, dx) from the pixels at (y, x) of
+            # each 2x2 quad of the band
+            y0 = _PAD + r0 + y + dy
+            x0 = _PAD + x + dx
+            return p[y0:y0 + r1 - r0:2, x0:x0 + self.width:2]
+
+        for c, filters in enumerate(self.__filters):
+            for (y, x), (filt, frac_bits) in filters:
+                dst = out[r0 + y:r1:2, x::2, c]
+
+                if frac_bits == 0 and self.__out_shift == 0:
+                    dst[...] = tap(y, x, 0, 0)
+                    continue
+
+                acc.fill(0)
+                for weight, taps in filt:
+                    np.copyto(tmp, tap(y, x, *taps[0]))
+                    for t in taps[1:]:
+                        np.add(tmp, tap(y, x, *t), out=tmp)
+                    if weight != 1:
+                        np.multiply(tmp, weight, out=tmp)
+                    np.add(acc, tmp, out=acc)
+
+                shift = frac_bits + self.__out_shift
+                if shift:
+                    np.add(acc, 1 << (shift - 1), out=acc)
+                    np.right_shift(acc, shift, out=acc)
+
+                np.clip(acc, 0, 255, out=acc)
+                dst[...] = acc
+
+    def __binned(self, data, out):
+        shift = self.__out_shift
+
+        def quad(y, x):
+            return data[y::2, x::2]
+
+        out[:, :, 0] = quad(*self.__r) >> shift
+        out[:, :, 2] = quad(*self.__b) >> shift
+
+        g = quad(*self.__gr).astype(np.uint32)
+        g += quad(*self.__gb)
+        out[:, :, 1] = g >> (shift + 1)
@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+#
+# Bounded queue of requests waiting to be displayed
+
+from collections import deque
+
+
+class DisplayQueue:
+    """
+    A bounded queue of completed requests waiting to be displayed
+
+    When the display is slower than the camera, requests are dropped
+    according to the policy, instead of letting the queue and the display
+    latency grow and the camera run out of buffers:
+
+    - 'drop-oldest': queue up to depth requests, dropping the oldest queued
+      request when full
+    - 'latest': keep only the newest request
+    - 'fifo': queue up to depth requests, dropping the new request when full
+
+    Dropped requests are released right away with request_processed(). The
+    queue holds (ctx, req) tuples.
+    """
+
+    POLICIES = ['drop-oldest', 'latest', 'fifo']
+
+    def __init__(self, state, policy: str = 'drop-oldest', depth: int = 2):
+        if policy not in DisplayQueue.POLICIES:
+            raise ValueError(f'Bad display queue policy {policy}')
+        if depth < 1:
+            raise ValueError(f'Bad display queue depth {depth}')
+
+        self.state = state
+        self.policy = policy
+        self.depth = 1 if policy == 'latest' else depth
+        self.dropped = 0
+
+        self.__queue = deque()
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def push(self, ctx, req):
+        if len(self.__queue) >= self.depth:
+            if self.policy == 'fifo':
+                self.__drop(ctx, req)
+                return
+
+            self.__drop(*self.__queue.popleft())
+
+        self.__queue.append((ctx, req))
+
+    def pop(self):
+        """Get the oldest queued (ctx, req), or None if the queue is empty"""
+        if not self.__queue:
+            return None
+        return self.__queue.popleft()
+
+    def clear(self):
+        """Release all the queued requests"""
+        while self.__queue:
+            ctx, req = self.__queue.popleft()
+            self.state.request_processed(ctx, req)
+
+    def __drop(self, ctx, req):
+        self.dropped += 1
+        self.state.request_processed(ctx, req)
@@ -0,0 +1,199 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+#
+# Matching of the frames of multiple cameras by their timestamps
+
+from collections import deque
+from sinks import Sink
+
+
+class _Frame:
+    def __init__(self, ctx, req, timestamp):
+        self.ctx = ctx
+        self.req = req
+        self.timestamp = timestamp
+
+
+class _FrameRing:
+    """
+    The held frames of a camera, in timestamp order, with an index of the
+    frames by timestamp
+
+    The index buckets the frames by timestamp // tolerance, so the frames
+    within the tolerance of a timestamp are in the bucket of the timestamp
+    or in the buckets next to it, and the nearest frame is found in O(1)
+    time.
+    """
+
+    def __init__(self, tolerance: int):
+        self.tolerance = tolerance
+        self.frames: deque[_Frame] = deque()
+        self.buckets: dict[int, list[_Frame]] = {}
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, frame: _Frame):
+        self.frames.append(frame)
+        self.buckets.setdefault(frame.timestamp // self.tolerance, []).append(frame)
+
+    def pop(self) -> _Frame:
+        frame = self.frames.popleft()
+
+        key = frame.timestamp // self.tolerance
+        bucket = self.buckets[key]
+        bucket.remove(frame)
+        if not bucket:
+            del self.buckets[key]
+
+        return frame
+
+    def nearest(self, timestamp: int):
+        """The frame nearest to timestamp, if within the tolerance"""
+        key = timestamp // self.tolerance
+        best = None
+
+        for k in (key - 1, key, key + 1):
+            for frame in self.buckets.get(k, ()):
+                d = abs(frame.timestamp - timestamp)
+                if d <= self.tolerance and (best is None or d < abs(best.timestamp - timestamp)):
+                    best = frame
+
+        return best
+
+
+class FrameSyncSink(Sink):
+    """
+    Matches the frames of the cameras by their timestamps
+
+    Each camera's completed requests are held in a ring of up to depth
+    frames. When a frame arrives, the frame nearest to its timestamp, within
+    tolerance nanoseconds, is looked up in the rings of the other cameras.
+    If all the cameras have one, and the frames found are also within the
+    tolerance of each other, the frames form a set, which is given to
+    the listeners, callables taking the list of (ctx, req) and the skew, the
+    difference of the latest and the earliest timestamp in the set, in
+    nanoseconds. The requests of the set, and all the older requests in the
+    rings, which can no longer be matched, are then released. Frames pushed
+    out of a full ring are released unmatched.
+
+    The depth must be less than the number of buffers of the cameras, as
+    the held requests are not available to the cameras.
+    """
+
+    def __init__(self, state, tolerance: int, depth: int = 2):
+        super().__init__(state)
+
+        if tolerance <= 0:
+            raise ValueError(f'Bad sync tolerance {tolerance}')
+
+        self.tolerance = tolerance
+        self.depth = depth
+        self.listeners = []
+
+        self.rings = {ctx: _FrameRing(tolerance) for ctx in state.contexts}
+
+        self.sets = 0
+        self.unmatched = {ctx: 0 for ctx in state.contexts}
+        self.skew_sum = 0
+        self.skew_max = 0
+        self.first_ts = None
+        self.last_ts = None
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        buffers = req.buffers
+        ts = buffers[next(iter(buffers))].metadata.timestamp
+
+        ring = self.rings[ctx]
+
+        if len(ring) >= self.depth:
+            self.__drop(ring.pop())
+
+        self.state.hold_request(req)
+        frame = _Frame(ctx, req, ts)
+        ring.push(frame)
+
+        matches = [frame]
+
+        for other, other_ring in self.rings.items():
+            if other is ctx:
+                continue
+
+            match = other_ring.nearest(ts)
+            if match is None:
+                return
+
+            matches.append(match)
+
+        # With three or more cameras, the frames found may be up to twice
+        # the tolerance apart
+        timestamps = [f.timestamp for f in matches]
+        if max(timestamps) - min(timestamps) > self.tolerance:
+            return
+
+        self.__emit(matches)
+
+    def __emit(self, matches):
+        timestamps = [f.timestamp for f in matches]
+        skew = max(timestamps) - min(timestamps)
+
+        self.sets += 1
+        self.skew_sum += skew
+        self.skew_max = max(self.skew_max, skew)
+
+        if self.first_ts is None:
+            self.first_ts = min(timestamps)
+        self.last_ts = max(timestamps)
+
+        frames = [(f.ctx, f.req) for f in sorted(matches, key=lambda f: f.ctx.idx)]
+
+        for listener in self.listeners:
+            listener(frames, skew)
+
+        # Release the matched frames, and the older frames which can no
+        # longer be matched
+        for f in matches:
+            ring = self.rings[f.ctx]
+
+            while True:
+                old = ring.pop()
+                if old is f:
+                    self.state.request_processed(f.ctx, f.req)
+                    break
+
+                self.__drop(old)
+
+    def __drop(self, frame):
+        self.unmatched[frame.ctx] += 1
+        self.state.request_processed(frame.ctx, frame.req)
+
+    def close(self):
+        for ring in self.rings.values():
+            while ring:
+                frame = ring.pop()
+                self.state.request_processed(frame.ctx, frame.req)
+
+        print(self.summary())
+
+    def summary(self) -> str:
+        line = 'sync: {} sets'.format(self.sets)
+
+        if self.sets:
+            line += ', skew mean {:.1f} us, max {:.1f} us'.format(
+                self.skew_sum / self.sets / 1000, self.skew_max / 1000)
+
+            if self.last_ts > self.first_ts:
+                line += ', {:.2f} sets/s'.format(
+                    (self.sets - 1) * 1000000000 / (self.last_ts - self.first_ts))
+
+        line += ', unmatched ' + ', '.join(f'{ctx.id} {n}' for ctx, n in self.unmatched.items())
+
+        return line
+
+
+def print_set(frames, skew):
+    """A FrameSyncSink listener printing a line per set"""
+    seqs = [(ctx, next(iter(req.buffers.values())).metadata.sequence) for ctx, req in frames]
+
+    print('sync: {}, skew {:.1f} us'.format(
+        ', '.join(f'{ctx.id} seq {seq}' for ctx, seq in seqs), skew / 1000))
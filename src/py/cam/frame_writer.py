@@ -0,0 +1,210 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# Background frame writer for the cam tool
+
+from collections import deque
+import errno
+import libcamera.utils
+import mmap
+import os
+import threading
+import time
+
+
+class FrameWriter:
+    """
+    Writes captured frames to files on a pool of worker threads
+
+    The frames of a request are written to the files on a worker thread, so
+    that the disk latency does not delay the requeuing of the request. While
+    there are less than max_queue requests waiting to be written, the frames
+    are copied and the request is released immediately. When the queue is
+    full, the behaviour depends on the policy:
+
+    - 'copy': the request is held until its frames have been written, which
+      applies backpressure to the camera as it runs out of requests
+    - 'drop': the frames are dropped
+    - 'hold': the frames are never copied, the request is always held until
+      written. This requires enough buffers to cover the disk latency.
+
+    With direct=True the files are written with O_DIRECT, bypassing the page
+    cache. Filesystems which don't support O_DIRECT fall back to buffered
+    writes.
+    """
+
+    POLICIES = ['copy', 'drop', 'hold']
+
+    # Buffer size for buffered writes
+    BUFFER_SIZE = 1 << 20
+
+    # Alignment of the O_DIRECT writes
+    DIRECT_ALIGN = 4096
+
+    def __init__(self, state, num_threads: int = 2, max_queue: int = 8,
+                 policy: str = 'copy', direct: bool = False):
+        if policy not in FrameWriter.POLICIES:
+            raise ValueError(f'Bad frame writer policy {policy}')
+
+        self.state = state
+        self.__max_queue = max_queue
+        self.__policy = policy
+        self.__direct = direct and hasattr(os, 'O_DIRECT')
+
+        self.__cond = threading.Condition()
+        self.__jobs: deque = deque()
+        self.__queued = 0
+        self.__closing = False
+        self.__local = threading.local()
+
+        self.frames = 0
+        self.bytes = 0
+        self.drops = 0
+        self.delayed = 0
+        self.errors = 0
+        self.__first_write = 0
+        self.__last_write = 0
+
+        self.__threads = [threading.Thread(target=self.__worker, daemon=True)
+                          for _ in range(num_threads)]
+        for t in self.__threads:
+            t.start()
+
+    def submit(self, ctx, req, frames: list[tuple[str, libcamera.FrameBuffer]]):
+        """Queue the frames of a request, as (filename, FrameBuffer) pairs, for writing"""
+        with self.__cond:
+            full = self.__queued >= self.__max_queue
+
+        if full and self.__policy == 'drop':
+            self.drops += len(frames)
+            return
+
+        hold = full or self.__policy == 'hold'
+
+        if hold:
+            # The planes are mapped on the worker thread and the request is
+            # released after the frames have been written
+            self.state.hold_request(req)
+            job = (ctx, req, frames)
+            if full:
+                self.delayed += 1
+        else:
+            copies = []
+            for filename, fb in frames:
+                with libcamera.utils.MappedFrameBuffer(fb, self.state.mfb_pool) as mfb:
+                    copies.append((filename, [bytes(p) for p in mfb.planes]))
+            job = (None, None, copies)
+
+        with self.__cond:
+            self.__jobs.append(job)
+            self.__queued += 1
+            self.__cond.notify()
+
+    def close(self):
+        """Write the queued frames, stop the worker threads and print a summary"""
+        with self.__cond:
+            self.__closing = True
+            self.__cond.notify_all()
+
+        for t in self.__threads:
+            t.join()
+
+        duration = (self.__last_write - self.__first_write) / 1000000000
+        rate = self.bytes / duration / 1000000 if duration > 0 else 0
+
+        print('Frame writer: {} frames, {:.1f} MB, {:.1f} MB/s, {} dropped, {} delayed, {} errors'
+              .format(self.frames, self.bytes / 1000000, rate, self.drops,
+                      self.delayed, self.errors))
+
+    def __worker(self):
+        while True:
+            with self.__cond:
+                while not self.__jobs and not self.__closing:
+                    self.__cond.wait()
+
+                if not self.__jobs:
+                    return
+
+                ctx, req, frames = self.__jobs.popleft()
+
+            try:
+                for filename, data in frames:
+                    if req is not None:
+                        with libcamera.utils.MappedFrameBuffer(data, self.state.mfb_pool) as mfb:
+                            self.__write(filename, mfb.planes)
+                    else:
+                        self.__write(filename, data)
+            except OSError as e:
+                print(f'Frame writer: failed to write frame: {e}')
+                with self.__cond:
+                    self.errors += 1
+            finally:
+                with self.__cond:
+                    self.__queued -= 1
+
+                if req is not None:
+                    self.state.request_processed(ctx, req)
+
+    def __write(self, filename, planes):
+        start = time.monotonic_ns()
+
+        if self.__direct:
+            size = self.__write_direct(filename, planes)
+        else:
+            size = 0
+            with open(filename, 'wb', buffering=FrameWriter.BUFFER_SIZE) as f:
+                for p in planes:
+                    f.write(p)
+                    size += len(p)
+
+        end = time.monotonic_ns()
+
+        with self.__cond:
+            if self.frames == 0:
+                self.__first_write = start
+            self.__last_write = max(self.__last_write, end)
+            self.frames += 1
+            self.bytes += size
+
+    def __write_direct(self, filename, planes) -> int:
+        size = sum(len(p) for p in planes)
+        align = FrameWriter.DIRECT_ALIGN
+        padded = (size + align - 1) // align * align
+
+        # O_DIRECT needs an aligned source buffer, so the planes are gathered
+        # to a page aligned per-thread bounce buffer
+        buf = getattr(self.__local, 'buf', None)
+        if buf is None or len(buf) < padded:
+            buf = mmap.mmap(-1, padded)
+            self.__local.buf = buf
+
+        offset = 0
+        for p in planes:
+            buf[offset:offset + len(p)] = p
+            offset += len(p)
+
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+
+            print('Frame writer: O_DIRECT not supported, using buffered writes')
+            self.__direct = False
+            with open(filename, 'wb', buffering=FrameWriter.BUFFER_SIZE) as f:
+                for p in planes:
+                    f.write(p)
+            return size
+
+        try:
+            with memoryview(buf) as mv:
+                written = 0
+                while written < padded:
+                    written += os.write(fd, mv[written:padded])
+
+            # Drop the padding
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+        return size
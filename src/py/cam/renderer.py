@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+#
+# Base classes of the cam tool renderers
+
+import selectors
+import sys
+
+
+class Renderer:
+    """
+    Base class of the renderers
+
+    Runs the event loop, passing the camera events to the CaptureState and
+    exiting when enter is pressed on key_input, if not None, or the capture
+    is done. Renderers add their own event sources with event_sources(), and
+    handle the completed requests, after the sinks of the CaptureState, in
+    request_handler(). The renderer is the last holder of the request it is
+    given, and releases it with CaptureState.request_processed().
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+        self.cm = state.cm
+        self.contexts = state.contexts
+
+        self.key_input = sys.stdin
+
+        self.running = False
+
+    def setup(self):
+        pass
+
+    def event_sources(self):
+        """Additional (fileobj, callback) pairs to wait for in the event loop"""
+        return []
+
+    def run(self):
+        print('Capturing...')
+
+        self.running = True
+
+        sel = selectors.DefaultSelector()
+        sel.register(self.cm.event_fd, selectors.EVENT_READ, self.readcam)
+
+        if self.key_input is not None:
+            sel.register(self.key_input, selectors.EVENT_READ, self.readkey)
+
+        for fileobj, callback in self.event_sources():
+            sel.register(fileobj, selectors.EVENT_READ, callback)
+
+        if self.key_input is not None:
+            print('Press enter to exit')
+
+        while self.running:
+            events = sel.select()
+            for key, mask in events:
+                callback = key.data
+                callback(key.fileobj)
+
+        sel.close()
+
+        print('Exiting...')
+
+    def stop(self):
+        self.running = False
+
+    def readcam(self, fileobj):
+        running = self.state.event_handler()
+
+        if not running:
+            self.stop()
+
+    def readkey(self, fileobj):
+        fileobj.readline()
+        self.stop()
+
+    def request_handler(self, ctx, req):
+        self.state.request_processed(ctx, req)
+
+
+class QtEventLoopRenderer(Renderer):
+    """Base class of the renderers running the Qt event loop"""
+
+    def setup(self):
+        from PyQt5 import QtWidgets
+
+        self.app = QtWidgets.QApplication([])
+
+    def run(self):
+        from PyQt5 import QtCore
+
+        camnotif = QtCore.QSocketNotifier(self.cm.event_fd, QtCore.QSocketNotifier.Read)
+        camnotif.activated.connect(lambda _: self.readcam(self.cm.event_fd))
+
+        notifiers = []
+
+        if self.key_input is not None:
+            keynotif = QtCore.QSocketNotifier(self.key_input.fileno(), QtCore.QSocketNotifier.Read)
+            keynotif.activated.connect(lambda _: self.readkey(self.key_input))
+            notifiers.append(keynotif)
+
+        for fileobj, callback in self.event_sources():
+            fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+            notif = QtCore.QSocketNotifier(fd, QtCore.QSocketNotifier.Read)
+            notif.activated.connect(lambda _, f=fileobj, cb=callback: cb(f))
+            notifiers.append(notif)
+
+        print('Capturing...')
+
+        self.app.exec()
+
+        print('Exiting...')
+
+    def stop(self):
+        self.app.quit()
@@ -0,0 +1,331 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+#
+# Consumers of the completed requests in the cam tool
+
+from frame_writer import FrameWriter
+from stats import CaptureStats
+from typing import Optional
+import abc
+import libcamera.utils
+import struct
+
+
+class Sink(abc.ABC):
+    """
+    Base class of the consumers of the completed requests
+
+    handle() is called in the event loop for each completed request, before
+    the renderer gets the request. A sink using the frames after handle()
+    returns takes a hold of the request with CaptureState.hold_request(),
+    and releases it with CaptureState.request_processed() when done with the
+    buffers, possibly from another thread. The request is queued to the
+    camera again when the last holder has released it, so the frames can be
+    fanned out to multiple sinks without copying.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def start(self):
+        """Called when the cameras have been configured, before starting the capture"""
+        pass
+
+    @abc.abstractmethod
+    def handle(self, ctx, req, completion, dispatch_ts: int):
+        pass
+
+    def close(self):
+        """Called when the capture is stopping. The sink releases its remaining holds."""
+        pass
+
+
+def frame_line(ctx, stream, fb):
+    meta = fb.metadata
+
+    return '{:.6f} ({:.2f} fps) {}-{}: seq {}, bytes {}'.format(
+        ctx.last / 1000000000, ctx.fps, ctx.id, ctx.stream_names[stream], meta.sequence,
+        '/'.join([str(p.bytes_used) for p in meta.planes]))
+
+
+class InfoSink(Sink):
+    """Prints a line per frame, for the cameras without --crc or --stats"""
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        if ctx.opt_crc or ctx.opt_stats:
+            return
+
+        for stream, fb in req.buffers.items():
+            print(frame_line(ctx, stream, fb) + ', CRCs []')
+
+
+class StatsSink(Sink):
+    """Collects the frame pacing and latency statistics"""
+
+    def __init__(self, state):
+        super().__init__(state)
+
+        self.stats = CaptureStats()
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        for stream, fb in req.buffers.items():
+            meta = fb.metadata
+            self.stats.add(ctx.id, ctx.stream_names[stream], meta.sequence, meta.timestamp,
+                           completion.timestamp, dispatch_ts)
+
+        self.stats.maybe_print_summary(dispatch_ts)
+
+
+class ChecksumSink(Sink):
+    """
+    Prints a line with the checksums of the planes per frame, for the cameras
+    with --crc
+
+    The checksums are computed on the threads of a ChecksumEngine, and the
+    request is held until they are ready.
+    """
+
+    def __init__(self, state, algorithm: str, num_threads: int):
+        super().__init__(state)
+
+        self.engine = libcamera.utils.ChecksumEngine(algorithm, num_threads)
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        if not ctx.opt_crc:
+            return
+
+        for stream, fb in req.buffers.items():
+            self.__submit(ctx, req, fb, frame_line(ctx, stream, fb))
+
+    def __submit(self, ctx, req, fb, line):
+        self.state.hold_request(req)
+
+        mfb = libcamera.utils.MappedFrameBuffer(fb, self.state.mfb_pool).mmap()
+
+        def done(fut):
+            mfb.munmap()
+
+            if not ctx.opt_stats:
+                try:
+                    print(f'{line}, CRCs [{fut.result().checksums}]')
+                except Exception as e:
+                    print(f'{line}, checksum failed: {e}')
+
+            self.state.request_processed(ctx, req)
+
+        fut = self.engine.submit(mfb.planes, fb.metadata.sequence)
+        fut.add_done_callback(done)
+
+    def close(self):
+        self.engine.close()
+
+
+class RecordSink(Sink):
+    """Records the frames and the request metadata to a frame store file"""
+
+    def __init__(self, state, filename: str):
+        super().__init__(state)
+
+        self.filename = filename
+        self.recorder = None
+
+    def start(self):
+        streams = []
+        self.__streams = {}
+
+        for ctx in self.state.contexts:
+            for stream in ctx.streams:
+                cfg = stream.configuration
+                self.__streams[(ctx, stream)] = len(streams)
+                streams.append(libcamera.utils.FrameStoreStream(
+                    f'{ctx.id}-{ctx.stream_names[stream]}', str(cfg.pixel_format),
+                    cfg.size.width, cfg.size.height, cfg.stride))
+
+        self.recorder = libcamera.utils.FrameStoreWriter(self.filename, streams)
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        metadata = {id.name: val for id, val in req.metadata.items()}
+
+        for stream, fb in req.buffers.items():
+            meta = fb.metadata
+
+            with libcamera.utils.MappedFrameBuffer(fb, self.state.mfb_pool) as mfb:
+                self.recorder.append(self.__streams[(ctx, stream)],
+                                     meta.sequence, meta.timestamp, mfb.planes,
+                                     [p.bytes_used for p in meta.planes], metadata)
+
+    def close(self):
+        if self.recorder is None:
+            return
+
+        print('Recorded {} frames to {}'.format(len(self.recorder), self.filename))
+        self.recorder.close()
+
+
+class MetadataRecordSink(Sink):
+    """
+    Records the per-frame metadata to a metadata store file per camera
+
+    With multiple cameras, the camera id is appended to the file name, e.g.
+    meta-cam1.lcmd.
+    """
+
+    DEFAULT_CONTROLS = ['ExposureTime', 'AnalogueGain', 'DigitalGain', 'ColourGains',
+                        'ColourTemperature', 'Lux', 'FrameDuration']
+
+    # The number of elements of the array controls
+    SHAPES = {'ColourGains': 2}
+
+    def __init__(self, state, filename: str, control_names: Optional[list[str]] = None):
+        super().__init__(state)
+
+        self.filename = filename
+        self.control_names = control_names or self.DEFAULT_CONTROLS
+        self.writers = {}
+
+        backend = state.backend
+        self.ids = []
+        for name in self.control_names:
+            id = getattr(backend.controls, name, None)
+            if not isinstance(id, backend.ControlId):
+                raise ValueError(f'Unknown control {name}')
+            self.ids.append(id)
+
+    def start(self):
+        import os
+
+        ids = self.ids
+        shapes = {id: self.SHAPES[id.name] for id in ids if id.name in self.SHAPES}
+
+        for ctx in self.state.contexts:
+            filename = self.filename
+            if len(self.state.contexts) > 1:
+                base, ext = os.path.splitext(filename)
+                filename = f'{base}-{ctx.id}{ext}'
+
+            streams = [ctx.stream_names[stream] for stream in ctx.streams]
+            self.writers[ctx] = (libcamera.utils.MetadataStoreWriter(filename, streams, ids,
+                                                                     shapes), filename)
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        writer, _ = self.writers[ctx]
+        writer.append(req, [req.buffers[stream] for stream in ctx.streams])
+
+    def close(self):
+        for writer, filename in self.writers.values():
+            print('Recorded metadata of {} frames to {}'.format(len(writer), filename))
+            writer.close()
+
+        self.writers = {}
+
+
+class SaveSink(Sink):
+    """Saves the frames of the cameras with --save-frames to files with a FrameWriter"""
+
+    def __init__(self, state, *writer_args):
+        super().__init__(state)
+
+        self.writer = FrameWriter(state, *writer_args)
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        if not ctx.opt_save_frames:
+            return
+
+        frames = []
+
+        for stream, fb in req.buffers.items():
+            filename = 'frame-{}-{}-{}.data'.format(ctx.id, ctx.stream_names[stream],
+                                                    ctx.reqs_completed)
+            frames.append((filename, fb))
+
+        self.writer.submit(ctx, req, frames)
+
+    def close(self):
+        self.writer.close()
+
+
+class ShmPublisherSink(Sink):
+    """
+    Publishes the frames in POSIX shared memory for other local processes
+
+    Each stream gets a shared memory segment named
+    '<prefix>-<camera>-<stream>', holding a header and a ring of slots
+    each fitting one frame. The header is:
+
+    - magic 'LCSM', version, number of slots, slot size, width, height,
+      stride and the pixel format name (16 bytes)
+    - the number of frames published so far, as a 64-bit counter
+
+    Each slot starts with the sequence number, the timestamp and the number
+    of bytes of the frame, followed by the planes of the frame stored
+    contiguously. Frame n is written to slot n % slots before the counter is
+    updated to n + 1. Readers read the counter, copy the newest slot, and
+    read the counter again: if it advanced by the number of slots minus one
+    or more, the slot may have been overwritten while copying.
+    """
+
+    HEADER = struct.Struct('<4sIIIIII16s')
+    COUNTER = struct.Struct('<Q')
+    SLOT_HEADER = struct.Struct('<QQQ')
+
+    MAGIC = b'LCSM'
+    VERSION = 1
+
+    def __init__(self, state, prefix: str, num_slots: int = 3):
+        super().__init__(state)
+
+        self.prefix = prefix
+        self.num_slots = num_slots
+        self.__segments = {}
+
+    def start(self):
+        from multiprocessing import shared_memory
+
+        for ctx in self.state.contexts:
+            for stream in ctx.streams:
+                cfg = stream.configuration
+
+                frame_size = max(sum(p.length for p in fb.planes)
+                                 for fb in ctx.allocator.buffers(stream))
+                slot_size = self.SLOT_HEADER.size + frame_size
+                header_size = self.HEADER.size + self.COUNTER.size
+
+                name = f'{self.prefix}-{ctx.id}-{ctx.stream_names[stream]}'
+                shm = shared_memory.SharedMemory(name, create=True,
+                                                 size=header_size + self.num_slots * slot_size)
+
+                self.HEADER.pack_into(shm.buf, 0, self.MAGIC, self.VERSION, self.num_slots,
+                                      slot_size, cfg.size.width, cfg.size.height,
+                                      cfg.stride, str(cfg.pixel_format).encode())
+                self.COUNTER.pack_into(shm.buf, self.HEADER.size, 0)
+
+                self.__segments[stream] = [shm, header_size, slot_size, 0]
+
+                print(f'{ctx.id}-{ctx.stream_names[stream]}: Publishing frames to /dev/shm/{name}')
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        for stream, fb in req.buffers.items():
+            seg = self.__segments[stream]
+            shm, header_size, slot_size, count = seg
+            meta = fb.metadata
+
+            offset = header_size + (count % self.num_slots) * slot_size
+            pos = offset + self.SLOT_HEADER.size
+
+            with libcamera.utils.MappedFrameBuffer(fb, self.state.mfb_pool) as mfb:
+                for p in mfb.planes:
+                    shm.buf[pos:pos + len(p)] = p
+                    pos += len(p)
+
+            self.SLOT_HEADER.pack_into(shm.buf, offset, meta.sequence, meta.timestamp,
+                                       pos - offset - self.SLOT_HEADER.size)
+
+            seg[3] = count + 1
+            self.COUNTER.pack_into(shm.buf, self.HEADER.size, count + 1)
+
+    def close(self):
+        for shm, *_ in self.__segments.values():
+            shm.close()
+            shm.unlink()
+
+        self.__segments = {}
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# Streaming frame pacing and latency statistics for the cam tool
+
+from typing import Optional
+import time
+
+
+class LogHistogram:
+    """
+    Fixed size histogram of non-negative integer values
+
+    Values are counted in logarithmic buckets: each power of two is split in
+    2 ** sub_bits linear sub-buckets, which gives a relative error of at most
+    2 ** -sub_bits for the percentiles. The memory use depends only on the
+    value range, not on the number of values.
+    """
+
+    def __init__(self, sub_bits: int = 4, max_bits: int = 40):
+        self.__sub_bits = sub_bits
+        self.__sub_count = 1 << sub_bits
+        # The first sub_count values have their own buckets, then one group
+        # of sub-buckets per power of two up to max_bits
+        self.__counts = [0] * (self.__sub_count * (max_bits - sub_bits + 1))
+        self.__max_value = (1 << max_bits) - 1
+
+        self.count = 0
+        self.min = 0
+        self.max = 0
+        self.sum = 0
+
+    def __index(self, value: int) -> int:
+        bits = value.bit_length()
+        if bits <= self.__sub_bits:
+            return value
+
+        shift = bits - self.__sub_bits - 1
+        sub = (value >> shift) - self.__sub_count
+        return (shift + 1) * self.__sub_count + sub
+
+    def __value(self, index: int) -> int:
+        """Upper bound of the values counted in the bucket"""
+        if index < self.__sub_count:
+            return index
+
+        shift = index // self.__sub_count - 1
+        sub = index % self.__sub_count
+        return ((self.__sub_count + sub + 1) << shift) - 1
+
+    def add(self, value: int):
+        value = min(max(value, 0), self.__max_value)
+
+        self.__counts[self.__index(value)] += 1
+
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p: float) -> int:
+        if self.count == 0:
+            return 0
+
+        target = max(1, int(self.count * p / 100 + 0.5))
+        seen = 0
+
+        for index, count in enumerate(self.__counts):
+            seen += count
+            if seen >= target:
+                return min(self.__value(index), self.max)
+
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def buckets(self) -> list[tuple[int, int]]:
+        """Non-empty buckets, as (upper bound, count) pairs"""
+        return [(self.__value(i), c) for i, c in enumerate(self.__counts) if c]
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class StreamStats:
+    """Frame pacing and latency statistics of a single stream"""
+
+    def __init__(self, prev: Optional['StreamStats'] = None):
+        self.frames = 0
+        self.dropped = 0
+        self.intervals = LogHistogram()
+        self.completion_latency = LogHistogram()
+        self.dispatch_latency = LogHistogram()
+
+        # Continue from the previous period, so that the interval and the
+        # drops between the periods are not lost
+        self.__last_seq: Optional[int] = prev.__last_seq if prev else None
+        self.__last_ts = prev.__last_ts if prev else 0
+
+    def add(self, seq: int, ts: int, completion_ts: int, dispatch_ts: int):
+        """
+        Record a completed frame. seq and ts are the buffer's sequence
+        number and sensor timestamp, completion_ts is the time the request
+        completed in libcamera and dispatch_ts the time it was handed to the
+        Python code, all in nanoseconds of CLOCK_MONOTONIC.
+        """
+        if self.__last_seq is not None:
+            # Sequence gaps are frames dropped by the pipeline
+            self.dropped += max(seq - self.__last_seq - 1, 0)
+
+            if ts > self.__last_ts:
+                self.intervals.add(ts - self.__last_ts)
+
+        self.__last_seq = seq
+        self.__last_ts = ts
+
+        self.completion_latency.add(completion_ts - ts)
+        self.dispatch_latency.add(dispatch_ts - ts)
+
+        self.frames += 1
+
+    @property
+    def fps(self) -> float:
+        mean = self.intervals.mean
+        return 1000000000.0 / mean if mean else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'fps': self.fps,
+            'interval_ns': self.intervals.to_dict(),
+            'interval_histogram': self.intervals.buckets(),
+            'completion_latency_ns': self.completion_latency.to_dict(),
+            'dispatch_latency_ns': self.dispatch_latency.to_dict(),
+        }
+
+
+class CaptureStats:
+    """
+    Statistics of all the captured streams
+
+    A summary line per stream is printed every period seconds, covering the
+    frames captured since the previous summary. The totals for the whole
+    capture are returned by to_dict().
+    """
+
+    def __init__(self, period: float = 1.0):
+        self.__period_ns = int(period * 1000000000)
+        self.__totals: dict[tuple[str, str], StreamStats] = {}
+        self.__current: dict[tuple[str, str], StreamStats] = {}
+        self.__last_summary = time.monotonic_ns()
+
+    def add(self, ctx_id: str, stream_name: str, seq: int, ts: int,
+            completion_ts: int, dispatch_ts: int):
+        key = (ctx_id, stream_name)
+
+        for stats in (self.__totals, self.__current):
+            if key not in stats:
+                stats[key] = StreamStats()
+
+            stats[key].add(seq, ts, completion_ts, dispatch_ts)
+
+    def maybe_print_summary(self, now: int):
+        if now - self.__last_summary < self.__period_ns:
+            return
+
+        self.__last_summary = now
+
+        for (ctx_id, stream_name), st in self.__current.items():
+            print('{}-{}: {} frames, {:.2f} fps, {} dropped, interval p50/p99/max {:.2f}/{:.2f}/{:.2f} ms, '
+                  'latency p50/p99/max {:.2f}/{:.2f}/{:.2f} ms'
+                  .format(ctx_id, stream_name, st.frames, st.fps, st.dropped,
+                          st.intervals.percentile(50) / 1000000,
+                          st.intervals.percentile(99) / 1000000,
+                          st.intervals.max / 1000000,
+                          st.dispatch_latency.percentile(50) / 1000000,
+                          st.dispatch_latency.percentile(99) / 1000000,
+                          st.dispatch_latency.max / 1000000))
+
+        self.__current = {key: StreamStats(st) for key, st in self.__current.items()}
+
+    def to_dict(self) -> dict:
+        res: dict[str, dict] = {}
+
+        for (ctx_id, stream_name), st in self.__totals.items():
+            res.setdefault(ctx_id, {})[stream_name] = st.to_dict()
+
+        return res
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# A simple capture example using asyncio:
+# - Capture frames from multiple cameras, each in its own asyncio task
+# - Listening events from stdin to exit the application
+#
+# The capture shares the event loop with any other asyncio code, e.g.
+# network I/O, without threads or a hand-written select loop.
+
+import asyncio
+import libcamera as libcam
+import libcamera.utils
+import sys
+
+
+async def capture(acm: libcamera.utils.AsyncCameraManager, cam: libcam.Camera, idx: int):
+    cam.acquire()
+
+    cam_config = cam.generate_configuration([libcam.StreamRole.Viewfinder])
+    stream_config = cam_config.at(0)
+    cam.configure(cam_config)
+
+    stream = stream_config.stream
+
+    allocator = libcam.FrameBufferAllocator(cam)
+    ret = allocator.allocate(stream)
+    assert ret > 0
+
+    print(f'cam{idx} ({cam.id}): capturing with {stream_config}')
+
+    # Use the camera index as the cookie, so that each task only receives the
+    # requests of its own camera
+
+    reqs = []
+    for buffer in allocator.buffers(stream):
+        req = cam.create_request(idx)
+        req.add_buffer(stream, buffer)
+        reqs.append(req)
+
+    cam.start()
+
+    for req in reqs:
+        cam.queue_request(req)
+
+    try:
+        # As the camera is passed to requests(), each request is reused and
+        # queued back to the camera after the loop body has handled it.
+        async for req in acm.requests(cookie=idx, camera=cam):
+            stream, fb = next(iter(req.buffers.items()))
+            meta = fb.metadata
+
+            print('cam{:<6} seq {:<6} bytes {}'
+                  .format(idx, meta.sequence,
+                          '/'.join([str(p.bytes_used) for p in meta.planes])))
+    finally:
+        cam.stop()
+        cam.release()
+
+
+async def main():
+    cm = libcam.CameraManager.singleton()
+
+    loop = asyncio.get_running_loop()
+
+    with libcamera.utils.AsyncCameraManager(cm) as acm:
+        tasks = [asyncio.create_task(capture(acm, cam, idx))
+                 for idx, cam in enumerate(cm.cameras)]
+
+        # Wait for enter on stdin
+
+        key_pressed = asyncio.Event()
+        loop.add_reader(sys.stdin, key_pressed.set)
+        await key_pressed.wait()
+        loop.remove_reader(sys.stdin)
+
+        print('Exiting...')
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -6,9 +6,9 @@
 # A simple capture example extending the simple-capture.py example:
 # - Capture frames using events from multiple cameras
 # - Listening events from stdin to exit the application
-# - Memory mapping the frames and calculating CRC
+# - Memory mapping the frames and calculating CRC on worker threads
+# - Requeuing the completed requests with a RequestPool
 
-import binascii
 import libcamera as libcam
 import libcamera.utils
 import selectors
@@ -19,7 +19,7 @@ import sys
 class CameraCaptureContext:
     idx: int
     cam: libcam.Camera
-    reqs: list[libcam.Request]
+    pool: libcamera.utils.RequestPool
     mfbs: dict[libcam.FrameBuffer, libcamera.utils.MappedFrameBuffer]
 
     def __init__(self, cam, idx):
@@ -40,38 +40,34 @@ class CameraCaptureContext:
 
         stream = stream_config.stream
 
-        # Allocate the buffers for capture
+        # Allocate the buffers and create a request for each buffer. The
+        # RequestPool queues the requests to the camera again when we release
+        # them. Use the camera index as the "cookie".
 
-        allocator = libcam.FrameBufferAllocator(cam)
-        ret = allocator.allocate(stream)
-        assert ret > 0
+        self.pool = libcamera.utils.RequestPool(cam, [stream], idx)
 
-        num_bufs = len(allocator.buffers(stream))
+        buffers = self.pool.buffers(stream)
 
-        print(f'cam{idx} ({cam.id}): capturing {num_bufs} buffers with {stream_config}')
+        print(f'cam{idx} ({cam.id}): capturing {len(buffers)} buffers with {stream_config}')
 
-        # Create the requests and assign a buffer for each request
+        # Save a mmapped buffer so we can calculate the CRC later
 
-        self.reqs = []
         self.mfbs = {}
 
-        for i in range(num_bufs):
-            # Use the buffer index as the "cookie"
-            req = cam.create_request(idx)
-
-            buffer = allocator.buffers(stream)[i]
-            req.add_buffer(stream, buffer)
-
-            self.reqs.append(req)
-
-            # Save a mmapped buffer so we can calculate the CRC later
+        for buffer in buffers:
             self.mfbs[buffer] = libcamera.utils.MappedFrameBuffer(buffer).mmap()
 
     def uninit_camera(self):
-        # Stop the camera
+        # Stop queuing the requests, and stop the camera
 
+        self.pool.stop()
         self.cam.stop()
 
+        print(f'cam{self.idx}: out of requests {self.pool.starved_count} times, '
+              f'{self.pool.starved_time * 1000:.1f} ms in total')
+
+        self.pool.close()
+
         # Release the camera
 
         self.cam.release()
@@ -81,6 +77,7 @@ class CameraCaptureContext:
 class CaptureContext:
     cm: libcam.CameraManager
     camera_contexts: list[CameraCaptureContext] = []
+    checksum: libcamera.utils.ChecksumEngine
 
     def handle_camera_event(self):
         # cm.get_ready_requests() returns the ready requests, which in our case
@@ -110,25 +107,36 @@ class CaptureContext:
         stream, fb = next(iter(buffers.items()))
 
         # Use the MappedFrameBuffer to access the pixel data with CPU. We calculate
-        # the crc for each plane.
+        # the crc for each plane on the ChecksumEngine's worker threads, so
+        # that the event loop is free to handle the other cameras meanwhile.
 
         mfb = cam_ctx.mfbs[fb]
-        crcs = [binascii.crc32(p) for p in mfb.planes]
-
         meta = fb.metadata
 
-        print('cam{:<6} seq {:<6} bytes {:10} CRCs {}'
-              .format(cam_ctx.idx,
-                      meta.sequence,
-                      '/'.join([str(p.bytes_used) for p in meta.planes]),
-                      crcs))
+        # Take the request from the pool. The pool queues it to the camera
+        # again when it is released, after the checksum has been computed.
+
+        pooled = cam_ctx.pool.take(req)
+
+        fut = self.checksum.submit(mfb.planes, meta.sequence)
+        fut.add_done_callback(lambda fut: self.handle_checksum(pooled, fut.result()))
 
-        # We want to re-queue the buffer we just handled. Instead of creating
-        # a new Request, we re-use the old one. We need to call req.reuse()
-        # to re-initialize the Request before queuing.
+    # Called on a ChecksumEngine worker thread
+    def handle_checksum(self, pooled: libcamera.utils.PooledRequest,
+                        result: libcamera.utils.ChecksumResult):
+        # Releasing the request when leaving the with block re-uses it and
+        # re-queues it to the camera. Queuing requests is allowed from any
+        # thread.
 
-        req.reuse()
-        cam_ctx.cam.queue_request(req)
+        with pooled as req:
+            stream, fb = next(iter(req.buffers.items()))
+            meta = fb.metadata
+
+            print('cam{:<6} seq {:<6} bytes {:10} CRCs {}'
+                  .format(req.cookie,
+                          result.tag,
+                          '/'.join([str(p.bytes_used) for p in meta.planes]),
+                          result.checksums))
 
     def handle_key_event(self):
         sys.stdin.readline()
@@ -139,8 +147,7 @@ class CaptureContext:
         # Queue the requests to the camera
 
         for cam_ctx in self.camera_contexts:
-            for req in cam_ctx.reqs:
-                cam_ctx.cam.queue_request(req)
+            cam_ctx.pool.start()
 
         # Use Selector to wait for events from the camera and from the keyboard
 
@@ -163,6 +170,7 @@ def main():
 
     ctx = CaptureContext()
     ctx.cm = cm
+    ctx.checksum = libcamera.utils.ChecksumEngine('crc32')
 
     for idx, cam in enumerate(cm.cameras):
         cam_ctx = CameraCaptureContext(cam, idx)
@@ -175,6 +183,9 @@ def main():
 
     ctx.capture()
 
+    # Wait for the pending checksums before stopping the cameras
+    ctx.checksum.close()
+
     for cam_ctx in ctx.camera_contexts:
         cam_ctx.uninit_camera()
 
@@ -0,0 +1,612 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# A fake camera backend, implemented in Python
+#
+# The classes mirror the API of the libcamera bindings, so that capture code
+# can be run without camera hardware, e.g. by importing this module in place
+# of libcamera:
+#
+#     import libcamera.fake as libcam
+#
+# The frames are produced by a thread per camera, at the configured rate,
+# into memfd backed buffers. The enums, PixelFormat, Size and the control ids
+# are the real libcamera classes.
+
+from collections import deque
+from typing import Any, NamedTuple, Optional, Sequence
+import libcamera
+import os
+import random
+import threading
+import time
+import weakref
+
+from libcamera import (  # noqa: F401
+    ColorSpace, ControlId, ControlType, PixelFormat, Point, Rectangle, Size,
+    SizeRange, StreamRole, Transform, controls, formats, log_set_level,
+    properties,
+)
+
+
+class FakeCameraOptions(NamedTuple):
+    """
+    Configuration of a fake camera
+
+    The frame interval varies randomly by up to +/- jitter times the nominal
+    interval. The default format and size are used for all the stream roles.
+    """
+    fps: float = 30.0
+    jitter: float = 0.0
+    width: int = 640
+    height: int = 480
+    pixel_format: str = 'XRGB8888'
+    buffer_count: int = 4
+    pixel_formats: tuple[str, ...] = ('XRGB8888', 'RGB888', 'BGR888', 'YUYV', 'UYVY',
+                                      'NV12', 'NV21', 'YUV420', 'SRGGB10_CSI2P')
+    max_width: int = 4096
+    max_height: int = 2160
+
+
+class CompletedRequest(NamedTuple):
+    request: 'Request'
+    cookie: int
+    timestamp: int
+    wall_time: int
+
+
+class CameraManager:
+    """A CameraManager with fake cameras, see FakeCameraOptions"""
+
+    __singleton: Optional[weakref.ref] = None
+
+    version = 'fake'
+
+    def __init__(self, cameras: Sequence[FakeCameraOptions] = (FakeCameraOptions(),)):
+        self.__efd = os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+        self.__lock = threading.Lock()
+        self.__cond = threading.Condition(self.__lock)
+        self.__completed: list[CompletedRequest] = []
+        self.__cameras = [Camera(self, f'fake/{i}', opts) for i, opts in enumerate(cameras)]
+
+    def __del__(self):
+        os.close(self.__efd)
+
+    @staticmethod
+    def singleton() -> 'CameraManager':
+        cm = CameraManager.__singleton() if CameraManager.__singleton else None
+
+        if cm is None:
+            cm = CameraManager()
+            CameraManager.__singleton = weakref.ref(cm)
+
+        return cm
+
+    @property
+    def cameras(self) -> list['Camera']:
+        return list(self.__cameras)
+
+    def get(self, id: str) -> Optional['Camera']:
+        return next((c for c in self.__cameras if c.id == id), None)
+
+    @property
+    def event_fd(self) -> int:
+        return self.__efd
+
+    def get_ready_requests(self) -> list['Request']:
+        return [c.request for c in self.__take_completed()]
+
+    def get_ready_request_batch(self) -> dict[int, list[CompletedRequest]]:
+        batch: dict[int, list[CompletedRequest]] = {}
+
+        for c in self.__take_completed():
+            batch.setdefault(c.cookie, []).append(c)
+
+        return batch
+
+    def wait_for_requests(self, timeout: Optional[float] = None,
+                          max_count: int = 0) -> list['Request']:
+        if timeout is not None and timeout < 0:
+            raise ValueError('Negative timeout')
+
+        with self.__cond:
+            self.__cond.wait_for(lambda: self.__completed, timeout)
+
+            count = len(self.__completed)
+            if max_count:
+                count = min(count, max_count)
+
+            completed = self.__completed[:count]
+            del self.__completed[:count]
+
+            if not self.__completed:
+                try:
+                    os.eventfd_read(self.__efd)
+                except BlockingIOError:
+                    pass
+
+        return [c.request for c in completed]
+
+    def _push_request(self, req: 'Request'):
+        with self.__cond:
+            self.__completed.append(CompletedRequest(req, req.cookie, time.monotonic_ns(),
+                                                     time.time_ns()))
+            self.__cond.notify_all()
+
+        os.eventfd_write(self.__efd, 1)
+
+    def __take_completed(self) -> list[CompletedRequest]:
+        try:
+            os.eventfd_read(self.__efd)
+        except BlockingIOError:
+            pass
+
+        with self.__lock:
+            completed = self.__completed
+            self.__completed = []
+
+        return completed
+
+
+class StreamFormats:
+    def __init__(self, opts: FakeCameraOptions):
+        self.__opts = opts
+
+    @property
+    def pixel_formats(self) -> list[PixelFormat]:
+        return [PixelFormat(f) for f in self.__opts.pixel_formats]
+
+    def sizes(self, fmt: PixelFormat) -> list[Size]:
+        return [Size(self.__opts.width, self.__opts.height)]
+
+    def range(self, fmt: PixelFormat) -> SizeRange:
+        return SizeRange(Size(16, 16), Size(self.__opts.max_width, self.__opts.max_height))
+
+
+class Stream:
+    def __init__(self, config: 'StreamConfiguration'):
+        self.__config = config
+
+    @property
+    def configuration(self) -> 'StreamConfiguration':
+        return self.__config
+
+
+class StreamConfiguration:
+    def __init__(self, opts: FakeCameraOptions):
+        self.size = Size(opts.width, opts.height)
+        self.pixel_format = PixelFormat(opts.pixel_format)
+        self.stride = 0
+        self.frame_size = 0
+        self.buffer_count = opts.buffer_count
+        self.color_space = ColorSpace.Sycc() if self.__is_yuv() else ColorSpace.Srgb()
+        self.formats = StreamFormats(opts)
+        self._stream: Optional[Stream] = None
+
+    def __str__(self):
+        return f'{self.size}-{self.pixel_format}'
+
+    @property
+    def stream(self) -> Optional[Stream]:
+        return self._stream
+
+    def __is_yuv(self) -> bool:
+        from .utils import PixelFormatInfo
+        info = PixelFormatInfo.info(self.pixel_format)
+        return info.colour_encoding == PixelFormatInfo.ColourEncodingYUV
+
+
+class CameraConfiguration:
+    Status = libcamera.CameraConfiguration.Status
+
+    def __init__(self, camera: 'Camera', roles: Sequence[StreamRole]):
+        self.__camera = camera
+        self.__configs = [StreamConfiguration(camera._opts) for _ in roles]
+        self.transform = Transform()
+
+    def __iter__(self):
+        return iter(self.__configs)
+
+    def __len__(self):
+        return len(self.__configs)
+
+    def at(self, index: int) -> StreamConfiguration:
+        return self.__configs[index]
+
+    @property
+    def size(self) -> int:
+        return len(self.__configs)
+
+    @property
+    def empty(self) -> bool:
+        return not self.__configs
+
+    def validate(self):
+        from .utils import PixelFormatInfo
+
+        opts = self.__camera._opts
+        status = CameraConfiguration.Status.Valid
+
+        for cfg in self.__configs:
+            if str(cfg.pixel_format) not in opts.pixel_formats:
+                cfg.pixel_format = PixelFormat(opts.pixel_format)
+                status = CameraConfiguration.Status.Adjusted
+
+            # Keep the sizes even, for the subsampled formats
+            width = min(max(cfg.size.width, 16), opts.max_width) & ~1
+            height = min(max(cfg.size.height, 16), opts.max_height) & ~1
+            if (width, height) != (cfg.size.width, cfg.size.height):
+                cfg.size = Size(width, height)
+                status = CameraConfiguration.Status.Adjusted
+
+            if cfg.buffer_count < 1:
+                cfg.buffer_count = opts.buffer_count
+                status = CameraConfiguration.Status.Adjusted
+
+            info = PixelFormatInfo.info(cfg.pixel_format)
+            cfg.stride = info.stride(width, 0, 64)
+            cfg.frame_size = sum(info.plane_size(height, cfg.stride, p)
+                                 for p in range(info.num_planes))
+
+        return status
+
+
+class FrameMetadata:
+    Status = libcamera.FrameMetadata.Status
+
+    class Plane:
+        def __init__(self, bytes_used: int):
+            self.bytes_used = bytes_used
+
+    def __init__(self, num_planes: int):
+        self.status = FrameMetadata.Status.Success
+        self.sequence = 0
+        self.timestamp = 0
+        self.planes = [FrameMetadata.Plane(0) for _ in range(num_planes)]
+
+
+class FrameBuffer:
+    """
+    A FrameBuffer backed by a memfd
+
+    The planes are the real libcamera FrameBuffer.Plane objects, so
+    MappedFrameBuffer can be used to access the data.
+    """
+
+    Plane = libcamera.FrameBuffer.Plane
+
+    def __init__(self, planes: Sequence[libcamera.FrameBuffer.Plane], cookie: int = 0):
+        self.__planes = list(planes)
+        self.__metadata = FrameMetadata(len(self.__planes))
+        self.cookie = cookie
+
+    @property
+    def planes(self) -> list[libcamera.FrameBuffer.Plane]:
+        return self.__planes
+
+    @property
+    def metadata(self) -> FrameMetadata:
+        return self.__metadata
+
+
+class FrameBufferAllocator:
+    def __init__(self, camera: 'Camera'):
+        self.__camera = camera
+        self.__buffers: dict[Stream, list[FrameBuffer]] = {}
+
+    def allocate(self, stream: Stream) -> int:
+        from .utils import PixelFormatInfo
+
+        if stream not in self.__camera._streams:
+            raise RuntimeError('Failed to allocate buffers')
+
+        cfg = stream.configuration
+        info = PixelFormatInfo.info(cfg.pixel_format)
+
+        buffers = []
+
+        for i in range(cfg.buffer_count):
+            fd = os.memfd_create(f'fake-{self.__camera.id}-{i}', os.MFD_CLOEXEC)
+            try:
+                os.ftruncate(fd, cfg.frame_size)
+
+                # All the planes are stored in the same memfd. The Plane dups
+                # the fd.
+                planes = []
+                for p in range(info.num_planes):
+                    offset = info.plane_offset(cfg.size.height, cfg.stride, p)
+                    length = info.plane_size(cfg.size.height, cfg.stride, p)
+                    planes.append(FrameBuffer.Plane(fd, offset, length))
+            finally:
+                os.close(fd)
+
+            fb = FrameBuffer(planes)
+            self.__camera._fill_pattern(fb, i)
+            buffers.append(fb)
+
+        self.__buffers[stream] = buffers
+
+        return len(buffers)
+
+    def free(self, stream: Stream):
+        self.__buffers.pop(stream, None)
+
+    @property
+    def allocated(self) -> bool:
+        return bool(self.__buffers)
+
+    def buffers(self, stream: Stream) -> list[FrameBuffer]:
+        return self.__buffers.get(stream, [])
+
+
+class RequestMetadata(dict):
+    """The request metadata, a dict keyed by the ControlIds"""
+
+    # The NumPy dtypes of the control types, as used by the bindings
+    __DTYPES = {
+        ControlType.Bool: 'bool',
+        ControlType.Byte: 'uint8',
+        ControlType.Integer32: 'int32',
+        ControlType.Integer64: 'int64',
+        ControlType.Float: 'float32',
+    }
+
+    def get_many(self, ids: Sequence[ControlId], default: Any = None) -> list[Any]:
+        return [self.get(id, default) for id in ids]
+
+    def get_array(self, id: ControlId, copy: bool = True):
+        """
+        Return the value of the control as a NumPy array of the control's dtype
+
+        Without copy, the array is read-only, like the views returned by the
+        bindings.
+        """
+        import numpy as np
+
+        val = self[id]
+
+        dtype = RequestMetadata.__DTYPES.get(id.type)
+        if dtype is None:
+            raise TypeError("ControlValue type can't be converted to an array")
+
+        arr = np.array(val if isinstance(val, (tuple, list)) else [val], dtype=dtype)
+        if not copy:
+            arr.setflags(write=False)
+
+        return arr
+
+
+class Request:
+    Status = libcamera.Request.Status
+    Reuse = libcamera.Request.Reuse
+
+    def __init__(self, camera: 'Camera', cookie: int):
+        self.__camera = camera
+        self.__cookie = cookie
+        self.__buffers: dict[Stream, FrameBuffer] = {}
+        self._controls: dict[ControlId, Any] = {}
+        self._status = Request.Status.Pending
+        self._sequence = 0
+        self._metadata = RequestMetadata()
+
+    def __str__(self):
+        return f'Request({self._sequence}:{self._status}:{self.__cookie})'
+
+    def add_buffer(self, stream: Stream, buffer: FrameBuffer):
+        if stream not in self.__camera._streams or stream in self.__buffers:
+            raise RuntimeError('Failed to add buffer')
+
+        self.__buffers[stream] = buffer
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def buffers(self) -> dict[Stream, FrameBuffer]:
+        return dict(self.__buffers)
+
+    @property
+    def cookie(self) -> int:
+        return self.__cookie
+
+    @property
+    def sequence(self) -> int:
+        return self._sequence
+
+    @property
+    def has_pending_buffers(self) -> bool:
+        return self._status == Request.Status.Pending and bool(self.__buffers)
+
+    def set_control(self, id: ControlId, value: Any):
+        self._controls[id] = value
+
+    @property
+    def controls(self) -> dict[ControlId, Any]:
+        return dict(self._controls)
+
+    @property
+    def metadata(self) -> RequestMetadata:
+        return self._metadata
+
+    def reuse(self):
+        self._status = Request.Status.Pending
+        self._controls = {}
+        self._metadata = RequestMetadata()
+
+
+class Camera:
+    """
+    A fake camera, producing frames on a thread while started
+
+    To follow a set of metadata controls of the completed requests, see
+    libcamera.utils.MetadataSubscription.
+    """
+
+    def __init__(self, cm: CameraManager, id: str, opts: FakeCameraOptions):
+        # Like in libcamera, the cameras keep the CameraManager alive
+        self.__cm = cm
+        self.__id = id
+        self._opts = opts
+        self._streams: list[Stream] = []
+
+        self.__acquired = False
+        self.__running = False
+        self.__thread: Optional[threading.Thread] = None
+        self.__cond = threading.Condition()
+        self.__queue: deque[Request] = deque()
+        self.__request_sequence = 0
+
+    def __str__(self):
+        return f"<libcamera.fake.Camera '{self.__id}'>"
+
+    @property
+    def id(self) -> str:
+        return self.__id
+
+    @property
+    def streams(self) -> set[Stream]:
+        return set(self._streams)
+
+    @property
+    def controls(self) -> dict:
+        return {}
+
+    @property
+    def properties(self) -> dict:
+        return {properties.Model: 'fake'}
+
+    def acquire(self):
+        if self.__acquired:
+            raise RuntimeError('Failed to acquire camera')
+        self.__acquired = True
+
+    def release(self):
+        if self.__running:
+            raise RuntimeError('Failed to release camera')
+        self.__acquired = False
+
+    def generate_configuration(self, roles: Sequence[StreamRole]) -> CameraConfiguration:
+        return CameraConfiguration(self, roles)
+
+    def configure(self, config: CameraConfiguration):
+        if not self.__acquired or self.__running or \
+           config.validate() == CameraConfiguration.Status.Invalid:
+            raise RuntimeError('Failed to configure camera')
+
+        self._streams = []
+        for cfg in config:
+            cfg._stream = Stream(cfg)
+            self._streams.append(cfg._stream)
+
+    def create_request(self, cookie: int = 0) -> Request:
+        return Request(self, cookie)
+
+    def start(self, controls: Optional[dict] = None):
+        if not self.__acquired or not self._streams or self.__running:
+            raise RuntimeError('Failed to start camera')
+
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if not self.__running:
+            return
+
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify()
+
+        self.__thread.join()
+        self.__thread = None
+
+        # Like libcamera, complete the pending requests as cancelled
+        with self.__cond:
+            reqs = list(self.__queue)
+            self.__queue.clear()
+
+        for req in reqs:
+            self.__complete(req, Request.Status.Cancelled, 0, 0)
+
+    def queue_request(self, req: Request):
+        if not self.__running or req.status != Request.Status.Pending or \
+           not req.buffers:
+            raise RuntimeError('Failed to queue request')
+
+        with self.__cond:
+            req._sequence = self.__request_sequence
+            self.__request_sequence += 1
+            self.__queue.append(req)
+            self.__cond.notify()
+
+    def _fill_pattern(self, fb: FrameBuffer, index: int):
+        """Fill the buffer with a diagonal gradient, offset by the buffer index"""
+        fd = fb.planes[0].fd
+        size = os.lseek(fd, 0, os.SEEK_END)
+        line = bytes((index * 16 + x) & 0xff for x in range(256 + 1024))
+        data = bytearray()
+        row = 0
+        while len(data) < size:
+            start = (row * 3) % 256
+            data += line[start:start + 1024]
+            row += 1
+        os.pwrite(fd, bytes(data[:size]), 0)
+
+    def __run(self):
+        opts = self._opts
+        interval = 1000000000 / opts.fps
+        next_frame = time.monotonic_ns()
+        sequence = 0
+
+        while True:
+            jitter = random.uniform(-opts.jitter, opts.jitter) if opts.jitter else 0
+            next_frame += int(interval * (1 + jitter))
+
+            with self.__cond:
+                while self.__running:
+                    timeout = (next_frame - time.monotonic_ns()) / 1000000000
+                    if timeout <= 0:
+                        break
+                    self.__cond.wait(timeout)
+
+                if not self.__running:
+                    return
+
+                # Without a queued request the frame is lost, which shows as
+                # a gap in the sequence numbers
+                req = self.__queue.popleft() if self.__queue else None
+
+            if req is not None:
+                self.__complete(req, Request.Status.Complete, sequence, time.monotonic_ns())
+
+            sequence += 1
+
+            # Don't try to catch up if we have fallen behind
+            now = time.monotonic_ns()
+            if next_frame < now - interval:
+                next_frame = now
+
+    def __complete(self, req: Request, status, sequence: int, timestamp: int):
+        for fb in req.buffers.values():
+            md = fb.metadata
+
+            if status == Request.Status.Complete:
+                md.status = FrameMetadata.Status.Success
+                md.sequence = sequence
+                md.timestamp = timestamp
+                for mdp, p in zip(md.planes, fb.planes):
+                    mdp.bytes_used = p.length
+
+                # Stamp the sequence in the frame, so that the frames differ
+                os.pwrite(fb.planes[0].fd, sequence.to_bytes(4, 'little'), fb.planes[0].offset)
+            else:
+                md.status = FrameMetadata.Status.Cancelled
+
+        if status == Request.Status.Complete:
+            req._metadata[controls.SensorTimestamp] = timestamp
+            req._metadata[controls.FrameDuration] = int(1000000 / self._opts.fps)
+
+        req._status = status
+
+        self.__cm._push_request(req)
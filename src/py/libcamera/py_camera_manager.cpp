@@ -5,8 +5,11 @@
 
 #include "py_camera_manager.h"
 
+#include <algorithm>
+#include <chrono>
 #include <errno.h>
 #include <memory>
+#include <stdexcept>
 #include <sys/eventfd.h>
 #include <system_error>
 #include <unistd.h>
@@ -72,13 +75,121 @@ std::vector<py::object> PyCameraManager::getReadyRequests()
 
 	std::vector<py::object> py_reqs;
 
-	for (Request *request : getCompletedRequests()) {
-		py::object o = py::cast(request);
-		/* Decrease the ref increased in Camera.queue_request() */
-		o.dec_ref();
-		py_reqs.push_back(o);
+	for (const CompletedRequest &completed : getCompletedRequests())
+		py_reqs.push_back(toPyRequest(completed.request));
+
+	return py_reqs;
+}
+
+/*
+ * Return the completed requests as a dict of lists of CompletedRequests, keyed
+ * by the request cookie. The requests are in completion order in each list.
+ */
+py::dict PyCameraManager::getReadyRequestBatch()
+{
+	int ret = readFd();
+
+	if (ret == -EAGAIN)
+		return py::dict();
+
+	if (ret != 0)
+		throw std::system_error(-ret, std::generic_category());
+
+	py::dict batch;
+
+	for (const CompletedRequest &completed : getCompletedRequests()) {
+		Request *request = completed.request;
+
+		PyCompletedRequest c{
+			toPyRequest(request),
+			request->cookie(),
+			completed.timestamp,
+			completed.wallTime,
+		};
+
+		py::object key = py::int_(c.cookie);
+
+		if (!batch.contains(key))
+			batch[key] = py::list();
+
+		batch[key].cast<py::list>().append(py::cast(std::move(c)));
 	}
 
+	return batch;
+}
+
+/*
+ * Wait until there are completed requests, or until timeout seconds have
+ * passed, and return up to maxCount of them, or all of them if maxCount is 0.
+ * A timeout of std::nullopt waits forever. The GIL is released while waiting,
+ * and reacquired periodically to handle signals, so that a waiting thread can
+ * be interrupted with Ctrl-C.
+ *
+ * The eventfd is cleared when all the completed requests have been taken, so
+ * that waiting and polling the eventfd can be mixed.
+ */
+std::vector<py::object> PyCameraManager::waitForRequests(std::optional<double> timeout,
+							 unsigned int maxCount)
+{
+	using namespace std::chrono;
+
+	constexpr auto signalInterval = milliseconds(100);
+
+	if (timeout && *timeout < 0)
+		throw std::invalid_argument("Negative timeout");
+
+	auto deadline = steady_clock::now();
+	if (timeout)
+		deadline += duration_cast<steady_clock::duration>(duration<double>(*timeout));
+
+	std::vector<CompletedRequest> completed;
+
+	while (true) {
+		{
+			py::gil_scoped_release release;
+
+			MutexLocker guard(completedRequestsMutex_);
+
+			auto slice = signalInterval;
+			if (timeout) {
+				auto left = duration_cast<milliseconds>(deadline - steady_clock::now());
+				slice = std::clamp(left, milliseconds(0), slice);
+			}
+
+			completedRequestsCv_.wait_for(guard, slice,
+						      [this]() LIBCAMERA_TSA_REQUIRES(completedRequestsMutex_) {
+							      return !completedRequests_.empty();
+						      });
+
+			size_t count = completedRequests_.size();
+			if (maxCount && maxCount < count)
+				count = maxCount;
+
+			if (count) {
+				completed.assign(completedRequests_.begin(),
+						 completedRequests_.begin() + count);
+				completedRequests_.erase(completedRequests_.begin(),
+							 completedRequests_.begin() + count);
+
+				if (completedRequests_.empty())
+					readFd();
+
+				break;
+			}
+		}
+
+		if (timeout && steady_clock::now() >= deadline)
+			break;
+
+		if (PyErr_CheckSignals() != 0)
+			throw py::error_already_set();
+	}
+
+	std::vector<py::object> py_reqs;
+
+	for (const CompletedRequest &c : completed)
+		py_reqs.push_back(toPyRequest(c.request));
+
 	return py_reqs;
 }
 
@@ -89,6 +200,14 @@ void PyCameraManager::handleRequestCompleted(Request *req)
 	writeFd();
 }
 
+py::object PyCameraManager::toPyRequest(Request *req)
+{
+	py::object o = py::cast(req);
+	/* Decrease the ref increased in Camera.queue_request() */
+	o.dec_ref();
+	return o;
+}
+
 void PyCameraManager::writeFd()
 {
 	uint64_t v = 1;
@@ -118,13 +237,27 @@ int PyCameraManager::readFd()
 
 void PyCameraManager::pushRequest(Request *req)
 {
-	MutexLocker guard(completedRequestsMutex_);
-	completedRequests_.push_back(req);
+	using namespace std::chrono;
+
+	CompletedRequest completed{
+		req,
+		static_cast<uint64_t>(duration_cast<nanoseconds>(
+			steady_clock::now().time_since_epoch()).count()),
+		static_cast<uint64_t>(duration_cast<nanoseconds>(
+			system_clock::now().time_since_epoch()).count()),
+	};
+
+	{
+		MutexLocker guard(completedRequestsMutex_);
+		completedRequests_.push_back(completed);
+	}
+
+	completedRequestsCv_.notify_all();
 }
 
-std::vector<Request *> PyCameraManager::getCompletedRequests()
+std::vector<PyCameraManager::CompletedRequest> PyCameraManager::getCompletedRequests()
 {
-	std::vector<Request *> v;
+	std::vector<CompletedRequest> v;
 	MutexLocker guard(completedRequestsMutex_);
 	swap(v, completedRequests_);
 	return v;
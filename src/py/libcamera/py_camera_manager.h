@@ -9,10 +9,25 @@
 
 #include <libcamera/libcamera.h>
 
+#include <optional>
+
 #include <pybind11/pybind11.h>
 
 using namespace libcamera;
 
+/*
+ * A completed request, with the time of completion recorded on the libcamera
+ * thread in PyCameraManager::handleRequestCompleted().
+ */
+struct PyCompletedRequest {
+	pybind11::object request;
+	uint64_t cookie;
+	/* CLOCK_MONOTONIC, in nanoseconds */
+	uint64_t timestamp;
+	/* CLOCK_REALTIME, in nanoseconds */
+	uint64_t wallTime;
+};
+
 class PyCameraManager
 {
 public:
@@ -27,19 +42,30 @@ public:
 	int eventFd() const { return eventFd_.get(); }
 
 	std::vector<pybind11::object> getReadyRequests();
+	pybind11::dict getReadyRequestBatch();
+	std::vector<pybind11::object> waitForRequests(std::optional<double> timeout,
+						      unsigned int maxCount);
 
 	void handleRequestCompleted(Request *req);
 
 private:
+	struct CompletedRequest {
+		Request *request;
+		uint64_t timestamp;
+		uint64_t wallTime;
+	};
+
 	std::unique_ptr<CameraManager> cameraManager_;
 
 	UniqueFD eventFd_;
 	libcamera::Mutex completedRequestsMutex_;
-	std::vector<Request *> completedRequests_
+	std::vector<CompletedRequest> completedRequests_
 		LIBCAMERA_TSA_GUARDED_BY(completedRequestsMutex_);
+	libcamera::ConditionVariable completedRequestsCv_;
 
 	void writeFd();
 	int readFd();
 	void pushRequest(Request *req);
-	std::vector<Request *> getCompletedRequests();
+	std::vector<CompletedRequest> getCompletedRequests();
+	static pybind11::object toPyRequest(Request *req);
 };
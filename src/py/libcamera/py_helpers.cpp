@@ -5,9 +5,12 @@
 
 #include "py_helpers.h"
 
+#include <type_traits>
+
 #include <libcamera/libcamera.h>
 
 #include <pybind11/functional.h>
+#include <pybind11/numpy.h>
 #include <pybind11/stl.h>
 #include <pybind11/stl_bind.h>
 
@@ -59,9 +62,67 @@ py::object controlValueToPy(const ControlValue &cv)
 	}
 }
 
+template<typename T>
+static py::object arrayFromValue(const ControlValue &cv, py::handle base)
+{
+	const T *data = reinterpret_cast<const T *>(cv.data().data());
+	ssize_t count = cv.isArray() ? cv.numElements() : 1;
+
+	if (!base)
+		return py::array_t<T>(count, data);
+
+	/* A read-only view of the ControlValue data, kept valid by base */
+	py::array_t<T> array({ count }, { static_cast<ssize_t>(sizeof(T)) }, data, base);
+	array.attr("setflags")(py::arg("write") = false);
+	return std::move(array);
+}
+
+py::object controlValueToArray(const ControlValue &cv, py::handle base)
+{
+	switch (cv.type()) {
+	case ControlTypeBool:
+		return arrayFromValue<bool>(cv, base);
+	case ControlTypeByte:
+		return arrayFromValue<uint8_t>(cv, base);
+	case ControlTypeInteger32:
+		return arrayFromValue<int32_t>(cv, base);
+	case ControlTypeInteger64:
+		return arrayFromValue<int64_t>(cv, base);
+	case ControlTypeFloat:
+		return arrayFromValue<float>(cv, base);
+	default:
+		throw py::type_error("ControlValue type can't be converted to an array");
+	}
+}
+
+/*
+ * Create an array ControlValue from an object supporting the buffer protocol,
+ * e.g. a NumPy array. C-contiguous NumPy arrays of the right dtype are used
+ * directly, other buffers are converted with NumPy first. Multi-dimensional
+ * buffers are flattened.
+ */
+template<typename T>
+static ControlValue controlValueFromBuffer(const py::buffer &buf)
+{
+	auto array = py::array_t<T, py::array::c_style | py::array::forcecast>::ensure(buf);
+	if (!array)
+		throw py::type_error("Unable to convert buffer to a control array");
+
+	return ControlValue(Span<const T>(array.data(), array.size()));
+}
+
 template<typename T>
 static ControlValue controlValueMaybeArray(const py::object &ob)
 {
+	/* Zero-dimensional buffers, e.g. NumPy scalars, are handled as scalars */
+	if constexpr (std::is_arithmetic_v<T>) {
+		if (py::isinstance<py::buffer>(ob)) {
+			py::buffer buf = ob.cast<py::buffer>();
+			if (buf.request().ndim > 0)
+				return controlValueFromBuffer<T>(buf);
+		}
+	}
+
 	if (py::isinstance<py::list>(ob) || py::isinstance<py::tuple>(ob)) {
 		std::vector<T> vec = ob.cast<std::vector<T>>();
 		return ControlValue(Span<const T>(vec));
@@ -10,4 +10,6 @@
 #include <pybind11/pybind11.h>
 
 pybind11::object controlValueToPy(const libcamera::ControlValue &cv);
+pybind11::object controlValueToArray(const libcamera::ControlValue &cv,
+				     pybind11::handle base = pybind11::handle());
 libcamera::ControlValue pyToControlValue(const pybind11::object &ob, libcamera::ControlType type);
@@ -23,6 +23,7 @@
 
 #include "py_camera_manager.h"
 #include "py_helpers.h"
+#include "py_request_metadata.h"
 
 namespace py = pybind11;
 
@@ -111,7 +112,10 @@ PYBIND11_MODULE(_libcamera, m)
 	 */
 
 	auto pyCameraManager = py::class_<PyCameraManager, std::shared_ptr<PyCameraManager>>(m, "CameraManager");
-	auto pyCamera = py::class_<Camera, PyCameraSmartPtr<Camera>>(m, "Camera");
+	auto pyCompletedRequest = py::class_<PyCompletedRequest>(m, "CompletedRequest");
+	auto pyCamera = py::class_<Camera, PyCameraSmartPtr<Camera>>(m, "Camera",
+		"A camera. To follow a set of metadata controls of the completed\n"
+		"requests, see libcamera.utils.MetadataSubscription.");
 	auto pyCameraConfiguration = py::class_<CameraConfiguration>(m, "CameraConfiguration");
 	auto pyCameraConfigurationStatus = py::enum_<CameraConfiguration::Status>(pyCameraConfiguration, "Status");
 	auto pyStreamConfiguration = py::class_<StreamConfiguration>(m, "StreamConfiguration");
@@ -122,9 +126,10 @@ PYBIND11_MODULE(_libcamera, m)
 	auto pyStream = py::class_<Stream>(m, "Stream");
 	auto pyControlId = py::class_<ControlId>(m, "ControlId");
 	auto pyControlInfo = py::class_<ControlInfo>(m, "ControlInfo");
-	auto pyRequest = py::class_<Request>(m, "Request");
+	auto pyRequest = py::class_<Request>(m, "Request", py::dynamic_attr());
 	auto pyRequestStatus = py::enum_<Request::Status>(pyRequest, "Status");
 	auto pyRequestReuse = py::enum_<Request::ReuseFlag>(pyRequest, "Reuse");
+	auto pyRequestMetadata = py::class_<PyRequestMetadata>(m, "RequestMetadata");
 	auto pyFrameMetadata = py::class_<FrameMetadata>(m, "FrameMetadata");
 	auto pyFrameMetadataStatus = py::enum_<FrameMetadata::Status>(pyFrameMetadata, "Status");
 	auto pyFrameMetadataPlane = py::class_<FrameMetadata::Plane>(pyFrameMetadata, "Plane");
@@ -153,7 +158,16 @@ PYBIND11_MODULE(_libcamera, m)
 		.def_property_readonly("cameras", &PyCameraManager::cameras)
 
 		.def_property_readonly("event_fd", &PyCameraManager::eventFd)
-		.def("get_ready_requests", &PyCameraManager::getReadyRequests);
+		.def("get_ready_requests", &PyCameraManager::getReadyRequests)
+		.def("get_ready_request_batch", &PyCameraManager::getReadyRequestBatch)
+		.def("wait_for_requests", &PyCameraManager::waitForRequests,
+		     py::arg("timeout") = py::none(), py::arg("max_count") = 0);
+
+	pyCompletedRequest
+		.def_readonly("request", &PyCompletedRequest::request)
+		.def_readonly("cookie", &PyCompletedRequest::cookie)
+		.def_readonly("timestamp", &PyCompletedRequest::timestamp)
+		.def_readonly("wall_time", &PyCompletedRequest::wallTime);
 
 	pyCamera
 		.def_property_readonly("id", &Camera::id)
@@ -416,24 +430,27 @@ PYBIND11_MODULE(_libcamera, m)
 		.def("set_control", [](Request &self, const ControlId &id, py::object value) {
 			self.controls().set(id.id(), pyToControlValue(value, id.type()));
 		})
-		.def_property_readonly("metadata", [](Request &self) {
-			/* Convert ControlList to std container */
-
+		.def_property_readonly("controls", [](Request &self) {
 			std::unordered_map<const ControlId *, py::object> ret;
 
-			for (const auto &[key, cv] : self.metadata()) {
-				const ControlId *id = controls::controls.at(key);
-				py::object ob = controlValueToPy(cv);
-				ret[id] = ob;
+			for (const auto &[k, cv] : self.controls()) {
+				const ControlId *id = controls::controls.at(k);
+				ret[id] = controlValueToPy(cv);
 			}
 
 			return ret;
 		})
+		.def_property_readonly("metadata", [](py::object self) {
+			return PyRequestMetadata::fromRequest(self);
+		})
 		/*
 		 * \todo As we add a keep_alive to the fb in addBuffers(), we
 		 * can only allow reuse with ReuseBuffers.
 		 */
-		.def("reuse", [](Request &self) { self.reuse(Request::ReuseFlag::ReuseBuffers); })
+		.def("reuse", [](py::object self) {
+			PyRequestMetadata::invalidateRequest(self);
+			self.cast<Request &>().reuse(Request::ReuseFlag::ReuseBuffers);
+		})
 		.def("__str__", &Request::toString);
 
 	pyRequestStatus
@@ -445,6 +462,22 @@ PYBIND11_MODULE(_libcamera, m)
 		.value("Default", Request::ReuseFlag::Default)
 		.value("ReuseBuffers", Request::ReuseFlag::ReuseBuffers);
 
+	pyRequestMetadata
+		.def("__getitem__", &PyRequestMetadata::getItem)
+		.def("__contains__", &PyRequestMetadata::contains)
+		.def("__len__", &PyRequestMetadata::size)
+		.def("get_array", &PyRequestMetadata::getArray, py::arg("id"), py::arg("copy") = true)
+		.def("__iter__", [](PyRequestMetadata &self) {
+			return py::iter(self.keys());
+		})
+		.def("get", &PyRequestMetadata::get,
+		     py::arg("id"), py::arg("default") = py::none())
+		.def("get_many", &PyRequestMetadata::getMany,
+		     py::arg("ids"), py::arg("default") = py::none())
+		.def("keys", &PyRequestMetadata::keys)
+		.def("values", &PyRequestMetadata::values)
+		.def("items", &PyRequestMetadata::items);
+
 	pyFrameMetadata
 		.def_readonly("status", &FrameMetadata::status)
 		.def_readonly("sequence", &FrameMetadata::sequence)
@@ -0,0 +1,212 @@
+/* SPDX-License-Identifier: LGPL-2.1-or-later */
+/*
+ * Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+ */
+
+#include "py_request_metadata.h"
+
+#include <stdexcept>
+
+#include "py_helpers.h"
+
+namespace py = pybind11;
+
+using namespace libcamera;
+
+PyRequestMetadata::PyRequestMetadata(py::weakref request)
+	: request_(request), exports_(std::make_shared<unsigned int>(0))
+{
+}
+
+namespace {
+
+/*
+ * The base object of the arrays viewing the metadata. It keeps the Request
+ * alive, and counts the live views in the exports count of the metadata.
+ */
+struct ArrayExport {
+	py::object request;
+	std::shared_ptr<unsigned int> exports;
+};
+
+void releaseArrayExport(void *p)
+{
+	ArrayExport *e = static_cast<ArrayExport *>(p);
+	--*e->exports;
+	delete e;
+}
+
+} /* namespace */
+
+Request *PyRequestMetadata::request()
+{
+	py::object request = request_();
+	if (request.is_none())
+		throw std::runtime_error("Request has been deleted");
+
+	return request.cast<Request *>();
+}
+
+/*
+ * Return the converted value of the control, or an invalid py::object if the
+ * control is not present in the metadata.
+ */
+py::object PyRequestMetadata::lookup(Request *request, unsigned int id)
+{
+	auto it = cache_.find(id);
+	if (it != cache_.end())
+		return it->second;
+
+	const ControlList &metadata = request->metadata();
+	if (!metadata.contains(id))
+		return py::object();
+
+	py::object ob = controlValueToPy(metadata.get(id));
+
+	/*
+	 * The metadata is filled in by the pipeline handler until the request
+	 * completes, so only cache the values of completed requests.
+	 */
+	if (request->status() != Request::RequestPending)
+		cache_[id] = ob;
+
+	return ob;
+}
+
+py::object PyRequestMetadata::getItem(const ControlId &id)
+{
+	py::object ob = lookup(request(), id.id());
+	if (!ob)
+		throw py::key_error(id.name());
+
+	return ob;
+}
+
+py::object PyRequestMetadata::get(const ControlId &id, py::object def)
+{
+	py::object ob = lookup(request(), id.id());
+	return ob ? ob : def;
+}
+
+py::list PyRequestMetadata::getMany(const std::vector<const ControlId *> &ids,
+				    py::object def)
+{
+	Request *req = request();
+	py::list l;
+
+	for (const ControlId *id : ids) {
+		py::object ob = lookup(req, id->id());
+		l.append(ob ? ob : def);
+	}
+
+	return l;
+}
+
+/*
+ * Return the value of the control as a NumPy array. Unless a copy is
+ * requested, the array is a read-only view of the metadata. Reusing the
+ * request raises a BufferError while such views are alive.
+ */
+py::object PyRequestMetadata::getArray(const ControlId &id, bool copy)
+{
+	py::object request = request_();
+	if (request.is_none())
+		throw std::runtime_error("Request has been deleted");
+
+	const ControlList &metadata = request.cast<Request *>()->metadata();
+	if (!metadata.contains(id.id()))
+		throw py::key_error(id.name());
+
+	if (copy)
+		return controlValueToArray(metadata.get(id.id()));
+
+	py::capsule base(new ArrayExport{ request, exports_ }, releaseArrayExport);
+	++*exports_;
+
+	return controlValueToArray(metadata.get(id.id()), base);
+}
+
+bool PyRequestMetadata::contains(const ControlId &id)
+{
+	return request()->metadata().contains(id.id());
+}
+
+size_t PyRequestMetadata::size()
+{
+	return request()->metadata().size();
+}
+
+py::list PyRequestMetadata::keys()
+{
+	py::list l;
+
+	for (const auto &[key, cv] : request()->metadata()) {
+		const ControlId *id = controls::controls.at(key);
+		l.append(py::cast(id, py::return_value_policy::reference));
+	}
+
+	return l;
+}
+
+py::list PyRequestMetadata::values()
+{
+	Request *req = request();
+	py::list l;
+
+	for (const auto &[key, cv] : req->metadata())
+		l.append(lookup(req, key));
+
+	return l;
+}
+
+py::list PyRequestMetadata::items()
+{
+	Request *req = request();
+	py::list l;
+
+	for (const auto &[key, cv] : req->metadata()) {
+		const ControlId *id = controls::controls.at(key);
+		l.append(py::make_tuple(py::cast(id, py::return_value_policy::reference),
+					lookup(req, key)));
+	}
+
+	return l;
+}
+
+void PyRequestMetadata::invalidate()
+{
+	cache_.clear();
+}
+
+/*
+ * Get the metadata view stored in the Request's Python object, creating it on
+ * first use.
+ */
+py::object PyRequestMetadata::fromRequest(py::object request)
+{
+	py::dict dict = request.attr("__dict__");
+
+	if (!dict.contains("_metadata"))
+		dict["_metadata"] = py::cast(PyRequestMetadata(py::weakref(request)));
+
+	return dict["_metadata"];
+}
+
+/*
+ * Drop the cached values of the Request's metadata view, if it has one. Raise
+ * a BufferError if arrays viewing the metadata are alive.
+ */
+void PyRequestMetadata::invalidateRequest(py::object request)
+{
+	py::dict dict = request.attr("__dict__");
+
+	if (!dict.contains("_metadata"))
+		return;
+
+	PyRequestMetadata &md = dict["_metadata"].cast<PyRequestMetadata &>();
+
+	if (md.hasExports())
+		throw py::buffer_error("Arrays viewing the request metadata are alive");
+
+	md.invalidate();
+}
@@ -0,0 +1,61 @@
+/* SPDX-License-Identifier: LGPL-2.1-or-later */
+/*
+ * Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+ */
+
+#pragma once
+
+#include <memory>
+#include <unordered_map>
+#include <vector>
+
+#include <libcamera/libcamera.h>
+
+#include <pybind11/pybind11.h>
+
+using namespace libcamera;
+
+/*
+ * A read-only mapping view of a Request's metadata ControlList. The values
+ * are converted to Python objects only when they are accessed, and cached
+ * until the request is reused.
+ *
+ * The view is stored in the Request's Python object, and holds a weak
+ * reference to it to avoid a reference cycle.
+ *
+ * Arrays viewing the metadata without a copy are counted, and the request
+ * can't be reused while any of them is alive, as reusing the request clears
+ * the metadata.
+ */
+class PyRequestMetadata
+{
+public:
+	PyRequestMetadata(pybind11::weakref request);
+
+	pybind11::object getItem(const ControlId &id);
+	pybind11::object get(const ControlId &id, pybind11::object def);
+	pybind11::list getMany(const std::vector<const ControlId *> &ids,
+			       pybind11::object def);
+	pybind11::object getArray(const ControlId &id, bool copy);
+	bool contains(const ControlId &id);
+	size_t size();
+
+	pybind11::list keys();
+	pybind11::list values();
+	pybind11::list items();
+
+	void invalidate();
+	bool hasExports() const { return *exports_ > 0; }
+
+	static pybind11::object fromRequest(pybind11::object request);
+	static void invalidateRequest(pybind11::object request);
+
+private:
+	pybind11::weakref request_;
+	std::unordered_map<unsigned int, pybind11::object> cache_;
+	/* Number of live arrays viewing the metadata, see getArray() */
+	std::shared_ptr<unsigned int> exports_;
+
+	Request *request();
+	pybind11::object lookup(Request *request, unsigned int id);
+};
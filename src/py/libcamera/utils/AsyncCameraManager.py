@@ -0,0 +1,156 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+from collections import deque
+from typing import AsyncIterator, Optional
+import asyncio
+import libcamera
+
+
+class AsyncCameraManager:
+    """
+    asyncio adapter for the CameraManager's request completion events
+
+    The CameraManager's event fd is watched with loop.add_reader(), and the
+    completed requests are handed to the coroutines waiting in get_request()
+    or iterating requests(). Requests can be filtered by their cookie, which
+    allows one consumer per camera when the cameras use distinct cookies.
+
+    If max_pending is set, the event fd is not read while max_pending or more
+    completed requests are waiting to be consumed. The completed requests
+    then accumulate in the CameraManager, and the camera runs out of queued
+    requests, instead of the application accumulating latency. Note that the
+    limit is shared by all cookies, so all of them have to be consumed.
+    """
+
+    def __init__(self, cm: libcamera.CameraManager, max_pending: int = 0,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.cm = cm
+        self.__loop = loop if loop is not None else asyncio.get_running_loop()
+        self.__max_pending = max_pending
+        self.__pending: deque[libcamera.Request] = deque()
+        self.__waiters: list[asyncio.Future] = []
+        self.__reading = False
+        self.__closed = False
+
+        self.__start_reading()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self) -> list[libcamera.Request]:
+        """
+        Stop watching the event fd and wake up the waiting consumers with
+        asyncio.CancelledError. Returns the requests which were completed but
+        not consumed.
+        """
+        self.__closed = True
+        self.__stop_reading()
+
+        for fut in self.__waiters:
+            if not fut.done():
+                fut.cancel()
+        self.__waiters.clear()
+
+        reqs = list(self.__pending)
+        self.__pending.clear()
+        return reqs
+
+    @property
+    def num_pending(self) -> int:
+        """Number of completed requests waiting to be consumed"""
+        return len(self.__pending)
+
+    async def get_request(self, cookie: Optional[int] = None) -> libcamera.Request:
+        """Wait for a completed request, optionally with a matching cookie"""
+        while True:
+            if self.__closed:
+                raise asyncio.CancelledError()
+
+            req = self.__pop(cookie)
+            if req is not None:
+                return req
+
+            fut = self.__loop.create_future()
+            self.__waiters.append(fut)
+            try:
+                await fut
+            finally:
+                if fut in self.__waiters:
+                    self.__waiters.remove(fut)
+
+    async def requests(self, cookie: Optional[int] = None,
+                       camera: Optional[libcamera.Camera] = None) -> AsyncIterator[libcamera.Request]:
+        """
+        Iterate over completed requests, optionally with a matching cookie
+
+        If a camera is given, each request is reused and queued back to the
+        camera when the consumer asks for the next request. The last request
+        is also queued back if the iteration is stopped with break or the
+        consuming task is cancelled, so that no buffers are lost. Note that
+        Python finalizes an abandoned async generator only when it is garbage
+        collected; wrap the iterator in contextlib.aclosing() to requeue the
+        last request deterministically.
+        """
+        req = None
+        try:
+            while True:
+                req = await self.get_request(cookie)
+                yield req
+
+                if camera is not None:
+                    r, req = req, None
+                    r.reuse()
+                    camera.queue_request(r)
+        finally:
+            if req is not None and camera is not None and not self.__closed:
+                req.reuse()
+                camera.queue_request(req)
+
+    def __pop(self, cookie: Optional[int]) -> Optional[libcamera.Request]:
+        req = None
+
+        if cookie is None:
+            if self.__pending:
+                req = self.__pending.popleft()
+        else:
+            for r in self.__pending:
+                if r.cookie == cookie:
+                    req = r
+                    break
+
+            if req is not None:
+                self.__pending.remove(req)
+
+        if req is not None and not self.__reading and not self.__closed and \
+           len(self.__pending) < self.__max_pending:
+            self.__start_reading()
+
+        return req
+
+    def __start_reading(self):
+        self.__loop.add_reader(self.cm.event_fd, self.__read_event)
+        self.__reading = True
+
+    def __stop_reading(self):
+        if self.__reading:
+            self.__loop.remove_reader(self.cm.event_fd)
+            self.__reading = False
+
+    def __read_event(self):
+        reqs = self.cm.get_ready_requests()
+        if not reqs:
+            return
+
+        self.__pending.extend(reqs)
+
+        if self.__max_pending and len(self.__pending) >= self.__max_pending:
+            self.__stop_reading()
+
+        for fut in self.__waiters:
+            if not fut.done():
+                fut.set_result(None)
+        self.__waiters.clear()
@@ -0,0 +1,191 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, NamedTuple, Sequence
+import importlib.util
+import threading
+import zlib
+
+
+class ChecksumResult(NamedTuple):
+    tag: Any
+    checksums: list[int]
+
+
+class ChecksumEngine:
+    """
+    Computes checksums of frame planes on a pool of worker threads
+
+    The planes are split in chunks of chunk_size bytes, which are hashed in
+    parallel. The hash functions release the GIL while processing the data,
+    so the chunks are processed concurrently with each other and with the
+    Python code. The supported algorithms are:
+
+    - 'crc32': the CRC32 of the whole plane, the same value as given by
+      binascii.crc32() and zlib.crc32(). The chunk CRCs are combined, so the
+      result does not depend on the chunk size.
+    - 'xxhash': a 64-bit XXH3 hash. This requires the xxhash module, and is
+      listed in ALGORITHMS only if the module is installed. The chunk hashes
+      are hashed again, so the result depends on the chunk size.
+    - 'sampled': the CRC32 of every sample_step'th 4 kB block of the plane.
+      This only detects changes in the sampled blocks.
+
+    The planes must stay valid until the checksums have been computed.
+    """
+
+    ALGORITHMS = ['crc32', 'sampled']
+    if importlib.util.find_spec('xxhash') is not None:
+        ALGORITHMS.insert(1, 'xxhash')
+
+    SAMPLE_BLOCK_SIZE = 4096
+
+    def __init__(self, algorithm: str = 'crc32', num_threads: int = 0,
+                 chunk_size: int = 1 << 20, sample_step: int = 16):
+        if algorithm == 'xxhash' and algorithm not in ChecksumEngine.ALGORITHMS:
+            raise RuntimeError('The xxhash checksum algorithm requires the xxhash module')
+
+        if algorithm not in ChecksumEngine.ALGORITHMS:
+            raise RuntimeError(f'Unknown checksum algorithm {algorithm}')
+
+        if algorithm == 'xxhash':
+            import xxhash
+            self.__xxh3 = xxhash.xxh3_64_intdigest
+
+        self.algorithm = algorithm
+        self.__chunk_size = chunk_size
+        self.__sample_step = sample_step
+        self.__executor = ThreadPoolExecutor(num_threads if num_threads > 0 else None,
+                                             thread_name_prefix='checksum')
+
+        # Per chunk length tables for combining CRCs, see __crc32_shift()
+        self.__shift_tables: dict[int, list[list[int]]] = {}
+        self.__shift_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """Wait for the pending checksums and stop the worker threads"""
+        self.__executor.shutdown(wait=True)
+
+    def submit(self, planes: Sequence[memoryview], tag: Any = None) -> Future:
+        """
+        Compute the checksums of the planes asynchronously
+
+        Returns a Future which resolves to a ChecksumResult holding the tag,
+        e.g. the frame sequence number, and a checksum per plane. Callbacks
+        added with Future.add_done_callback() are run on a worker thread.
+        """
+        result: Future = Future()
+
+        if self.algorithm == 'sampled':
+            # Sampling touches only a fraction of the data, a job per plane
+            # is enough
+            jobs = [(i, 0, self.__sampled_crc32, p) for i, p in enumerate(planes)]
+        else:
+            hasher = zlib.crc32 if self.algorithm == 'crc32' else self.__xxh3
+            jobs = []
+            for i, p in enumerate(planes):
+                chunks = [p[o:o + self.__chunk_size]
+                          for o in range(0, len(p), self.__chunk_size)] or [p]
+                jobs += [(i, n, hasher, c) for n, c in enumerate(chunks)]
+
+        # Chunk results, per plane
+        values: list[list] = [[] for _ in planes]
+        for i, n, _, _ in jobs:
+            values[i].append(None)
+
+        remaining = [len(jobs)]
+        lock = threading.Lock()
+
+        def done(i, n, length, fut):
+            exc = fut.exception()
+
+            # The result is checked and set under the lock, as the chunks
+            # complete concurrently on the worker threads
+            with lock:
+                if result.done():
+                    return
+
+                if exc is not None:
+                    result.set_exception(exc)
+                    return
+
+                values[i][n] = (fut.result(), length)
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+
+                try:
+                    checksums = [self.__combine(v) for v in values]
+                    result.set_result(ChecksumResult(tag, checksums))
+                except Exception as e:
+                    result.set_exception(e)
+
+        if not jobs:
+            result.set_result(ChecksumResult(tag, []))
+            return result
+
+        for i, n, func, data in jobs:
+            fut = self.__executor.submit(func, data)
+            fut.add_done_callback(lambda f, i=i, n=n, length=len(data): done(i, n, length, f))
+
+        return result
+
+    def checksum(self, planes: Sequence[memoryview]) -> list[int]:
+        """Compute the checksums of the planes, waiting for the result"""
+        return self.submit(planes).result().checksums
+
+    def __combine(self, chunks: list[tuple[int, int]]) -> int:
+        if len(chunks) == 1:
+            return chunks[0][0]
+
+        if self.algorithm == 'xxhash':
+            return self.__xxh3(b''.join(v.to_bytes(8, 'little') for v, _ in chunks))
+
+        crc = chunks[0][0]
+        for value, length in chunks[1:]:
+            crc = self.__crc32_shift(crc, length) ^ value
+        return crc
+
+    def __crc32_shift(self, crc: int, length: int) -> int:
+        """
+        Advance a CRC32 over length zero bytes, without the pre and post
+        conditioning
+
+        crc32(A + B) == shift(crc32(A), len(B)) ^ crc32(B), where shift() is
+        linear over GF(2) in the CRC. It is tabulated per byte of the CRC, as
+        the chunks mostly have the same length.
+        """
+        tables = self.__shift_tables.get(length)
+
+        if tables is None:
+            zeros = bytes(length)
+            base = zlib.crc32(zeros, 0)
+            bits = [zlib.crc32(zeros, 1 << b) ^ base for b in range(32)]
+
+            tables = []
+            for byte in range(4):
+                table = [0] * 256
+                for v in range(1, 256):
+                    low = v & -v
+                    table[v] = table[v ^ low] ^ bits[byte * 8 + low.bit_length() - 1]
+                tables.append(table)
+
+            with self.__shift_lock:
+                self.__shift_tables[length] = tables
+
+        return (tables[0][crc & 0xff] ^ tables[1][(crc >> 8) & 0xff]
+                ^ tables[2][(crc >> 16) & 0xff] ^ tables[3][crc >> 24])
+
+    def __sampled_crc32(self, data: memoryview) -> int:
+        block = ChecksumEngine.SAMPLE_BLOCK_SIZE
+        step = block * self.__sample_step
+        crc = 0
+        for o in range(0, len(data), step):
+            crc = zlib.crc32(data[o:o + block], crc)
+        return crc
@@ -0,0 +1,297 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# A container file for recorded frames
+#
+# The file consists of:
+#
+# - The file header: magic, version, length of the stream description and
+#   the stream description as JSON
+# - The frame records: a record header with the stream index, the buffer
+#   sequence number and timestamp, the number of planes and the length of
+#   the request metadata, followed by bytes_used and length of each plane,
+#   the request metadata as JSON and the plane data
+# - The index: an entry per frame record with the record offset, timestamp,
+#   stream index and sequence number
+# - The footer: magic, index offset and number of index entries
+#
+# The file header, the record headers and the plane data are aligned to
+# ALIGN bytes. All the integers are little-endian. If the footer is missing,
+# e.g. as the recording was interrupted, the reader rebuilds the index by
+# scanning the records.
+
+from typing import Any, NamedTuple, Optional, Sequence
+import json
+import struct
+
+_FILE_HEADER = struct.Struct('<4sII')
+_RECORD_HEADER = struct.Struct('<4sIIQII')
+_RECORD_PLANE = struct.Struct('<II')
+_INDEX_ENTRY = struct.Struct('<QQII')
+_FOOTER = struct.Struct('<4sQQ')
+
+_FILE_MAGIC = b'LCFS'
+_RECORD_MAGIC = b'LCFR'
+_FOOTER_MAGIC = b'LCFI'
+
+_VERSION = 1
+
+ALIGN = 64
+
+
+def _align(v: int) -> int:
+    return (v + ALIGN - 1) // ALIGN * ALIGN
+
+
+class FrameStoreStream(NamedTuple):
+    name: str
+    pixel_format: str
+    width: int
+    height: int
+    stride: int
+
+
+class FrameStoreWriter:
+    """
+    Appends frames to a frame store file
+
+    The streams are described when the file is created, and the frames refer
+    to the streams by their index. close() writes the index, which makes
+    opening the file fast, but the file is readable without it.
+    """
+
+    def __init__(self, filename: str, streams: Sequence[FrameStoreStream]):
+        self.streams = list(streams)
+        self.__f = open(filename, 'wb', buffering=1 << 20)
+        self.__offset = 0
+        self.__index: list[bytes] = []
+
+        desc = json.dumps({'streams': [s._asdict() for s in self.streams]}).encode()
+        self.__write(_FILE_HEADER.pack(_FILE_MAGIC, _VERSION, len(desc)))
+        self.__write(desc)
+        self.__pad()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.__index)
+
+    def append(self, stream: int, sequence: int, timestamp: int,
+               planes: Sequence[memoryview], bytes_used: Sequence[int],
+               metadata: Optional[dict] = None) -> int:
+        """
+        Append a frame, returning its index in the file
+
+        The metadata values which are not supported by JSON are stored as
+        strings.
+        """
+        if stream >= len(self.streams):
+            raise IndexError(f'Bad stream index {stream}')
+
+        md = json.dumps(metadata, default=str).encode() if metadata else b''
+
+        offset = self.__offset
+
+        self.__write(_RECORD_HEADER.pack(_RECORD_MAGIC, stream, sequence, timestamp,
+                                         len(planes), len(md)))
+        for p, used in zip(planes, bytes_used):
+            self.__write(_RECORD_PLANE.pack(used, len(p)))
+        self.__write(md)
+        self.__pad()
+
+        for p in planes:
+            self.__write(p)
+            self.__pad()
+
+        self.__index.append(_INDEX_ENTRY.pack(offset, timestamp, stream, sequence))
+
+        return len(self.__index) - 1
+
+    def close(self):
+        if self.__f.closed:
+            return
+
+        index_offset = self.__offset
+        self.__write(b''.join(self.__index))
+        self.__write(_FOOTER.pack(_FOOTER_MAGIC, index_offset, len(self.__index)))
+
+        self.__f.close()
+
+    def __write(self, data):
+        self.__f.write(data)
+        self.__offset += len(data)
+
+    def __pad(self):
+        pad = _align(self.__offset) - self.__offset
+        if pad:
+            self.__write(bytes(pad))
+
+
+class FrameStoreFrame:
+    """A frame in a frame store, with memoryviews of the plane data in the file"""
+
+    def __init__(self, stream: FrameStoreStream, stream_index: int, sequence: int,
+                 timestamp: int, bytes_used: list[int], planes: list[memoryview],
+                 metadata: memoryview):
+        self.stream = stream
+        self.stream_index = stream_index
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.bytes_used = bytes_used
+        self.planes = planes
+        self.__metadata = metadata
+
+    @property
+    def metadata(self) -> dict[str, Any]:
+        """The request metadata, keyed by control name"""
+        if not self.__metadata:
+            return {}
+        return json.loads(bytes(self.__metadata))
+
+    def as_ndarray(self, plane: int):
+        """
+        Get a NumPy array view of a plane, without copying the data. See
+        MappedFrameBuffer.as_ndarray().
+        """
+        from .PixelFormatInfo import PixelFormatInfo
+
+        s = self.stream
+        info = PixelFormatInfo.info(s.pixel_format)
+        return info.ndarray(self.planes, plane, s.width, s.height, s.stride)
+
+
+class FrameStoreReader:
+    """
+    Reads a frame store file
+
+    The file is mmapped and the frames are returned as views of the mapping,
+    so they are only valid until the reader is closed. Looking up a frame by
+    its index is O(1).
+    """
+
+    def __init__(self, filename: str):
+        import mmap
+
+        with open(filename, 'rb') as f:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__view = memoryview(self.__map)
+
+        magic, version, desc_len = _FILE_HEADER.unpack_from(self.__view, 0)
+        if magic != _FILE_MAGIC:
+            raise RuntimeError(f'{filename} is not a frame store file')
+        if version != _VERSION:
+            raise RuntimeError(f'Unsupported frame store version {version}')
+
+        desc = json.loads(bytes(self.__view[_FILE_HEADER.size:_FILE_HEADER.size + desc_len]))
+        self.streams = [FrameStoreStream(**s) for s in desc['streams']]
+
+        self.__data_start = _align(_FILE_HEADER.size + desc_len)
+        self.__index_offset, self.__count = self.__read_footer()
+
+        if self.__index_offset is None:
+            self.__index = self.__scan()
+            self.__count = len(self.__index) // _INDEX_ENTRY.size
+            self.__index_offset = 0
+        else:
+            self.__index = self.__view
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        self.__index = b''
+
+        try:
+            self.__view.release()
+            self.__map.close()
+        except BufferError:
+            # The user still holds views of the frames. The mapping goes
+            # away when the last of them is garbage collected.
+            pass
+
+    def __len__(self):
+        return self.__count
+
+    def __getitem__(self, n: int) -> FrameStoreFrame:
+        return self.frame(n)
+
+    def index_entry(self, n: int) -> tuple[int, int, int, int]:
+        """The (offset, timestamp, stream index, sequence) of the frame"""
+        if n < 0:
+            n += self.__count
+        if n < 0 or n >= self.__count:
+            raise IndexError('Frame index out of range')
+
+        return _INDEX_ENTRY.unpack_from(self.__index, self.__index_offset + n * _INDEX_ENTRY.size)
+
+    def frame(self, n: int) -> FrameStoreFrame:
+        offset = self.index_entry(n)[0]
+        return self.__read_record(offset)[0]
+
+    def __read_footer(self):
+        if len(self.__view) < self.__data_start + _FOOTER.size:
+            return None, 0
+
+        magic, index_offset, count = _FOOTER.unpack_from(self.__view, len(self.__view) - _FOOTER.size)
+        if magic != _FOOTER_MAGIC or \
+           index_offset + count * _INDEX_ENTRY.size + _FOOTER.size != len(self.__view):
+            return None, 0
+
+        return index_offset, count
+
+    def __read_record(self, offset: int) -> tuple[FrameStoreFrame, int]:
+        """Parse the record at offset, returning the frame and the offset of the next record"""
+        view = self.__view
+
+        magic, stream, sequence, timestamp, num_planes, md_len = \
+            _RECORD_HEADER.unpack_from(view, offset)
+        if magic != _RECORD_MAGIC:
+            raise RuntimeError(f'Bad frame record at offset {offset}')
+
+        pos = offset + _RECORD_HEADER.size
+        plane_info = []
+        for _ in range(num_planes):
+            plane_info.append(_RECORD_PLANE.unpack_from(view, pos))
+            pos += _RECORD_PLANE.size
+
+        metadata = view[pos:pos + md_len]
+        pos = _align(pos + md_len)
+
+        planes = []
+        for _, length in plane_info:
+            if pos + length > len(view):
+                raise RuntimeError(f'Truncated frame record at offset {offset}')
+            planes.append(view[pos:pos + length])
+            pos = _align(pos + length)
+
+        frame = FrameStoreFrame(self.streams[stream], stream, sequence, timestamp,
+                                [used for used, _ in plane_info], planes, metadata)
+
+        return frame, pos
+
+    def __scan(self) -> bytes:
+        entries = []
+        offset = self.__data_start
+
+        while offset + _RECORD_HEADER.size <= len(self.__view):
+            if bytes(self.__view[offset:offset + 4]) != _RECORD_MAGIC:
+                break
+
+            try:
+                frame, next_offset = self.__read_record(offset)
+            except (RuntimeError, struct.error):
+                # A partially written last record
+                break
+
+            entries.append(_INDEX_ENTRY.pack(offset, frame.timestamp, frame.stream_index,
+                                             frame.sequence))
+            offset = next_offset
+
+        return b''.join(entries)
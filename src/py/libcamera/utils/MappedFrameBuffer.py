@@ -7,9 +7,13 @@ from typing import Tuple
 class MappedFrameBuffer:
     """
     Provides memoryviews for the FrameBuffer's planes
+
+    If a MappedFrameBufferPool is given, the mappings are taken from the pool
+    and are left mapped when the MappedFrameBuffer is unmapped.
     """
-    def __init__(self, fb: libcamera.FrameBuffer):
+    def __init__(self, fb: libcamera.FrameBuffer, pool=None):
         self.__fb = fb
+        self.__pool = pool
         self.__planes = ()
         self.__maps = ()
 
@@ -23,6 +27,10 @@ class MappedFrameBuffer:
         if self.__planes:
             raise RuntimeError('MappedFrameBuffer already mmapped')
 
+        if self.__pool is not None:
+            self.__planes = self.__pool.planes(self.__fb)
+            return self
+
         import os
         import mmap
 
@@ -83,6 +91,12 @@ class MappedFrameBuffer:
         if not self.__planes:
             raise RuntimeError('MappedFrameBuffer not mmapped')
 
+        if self.__pool is not None:
+            # The pool owns the mappings. The memoryviews are released when
+            # no longer referenced.
+            self.__planes = ()
+            return
+
         for p in self.__planes:
             p.release()
 
@@ -103,3 +117,22 @@ class MappedFrameBuffer:
     @property
     def fb(self):
         return self.__fb
+
+    def as_ndarray(self, plane: int, stream_config: libcamera.StreamConfiguration):
+        """
+        Get a NumPy array view of a plane, without copying the data
+
+        The shape, strides and dtype are computed from the stream
+        configuration's pixel format, size and stride. See
+        PixelFormatInfo.ndarray_layout() for a description of the shapes.
+        Compressed formats are returned as a flat array of bytes.
+
+        The array is only valid while the MappedFrameBuffer is mapped.
+        """
+        from .PixelFormatInfo import PixelFormatInfo
+
+        cfg = stream_config
+        info = PixelFormatInfo.info(cfg.pixel_format)
+
+        return info.ndarray(self.planes, plane, cfg.size.width, cfg.size.height,
+                            cfg.stride)
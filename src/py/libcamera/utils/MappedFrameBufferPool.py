@@ -0,0 +1,130 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+from collections import OrderedDict
+from typing import Tuple
+import libcamera
+import threading
+
+
+class _DmabufMapping:
+    def __init__(self, fd: int):
+        import os
+        import mmap
+
+        self.length = os.lseek(fd, 0, os.SEEK_END)
+        self.map = mmap.mmap(fd, self.length, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.view = memoryview(self.map)
+
+    def plane(self, offset: int, length: int) -> memoryview:
+        if offset > self.length or offset + length > self.length:
+            raise RuntimeError(f'plane is out of buffer: buffer length={self.length}, '
+                               f'plane offset={offset}, plane length={length}')
+
+        return self.view[offset:offset + length]
+
+    def close(self):
+        self.view.release()
+
+        try:
+            self.map.close()
+        except BufferError:
+            # The user still holds views of the map. The mapping goes away
+            # when the last of them is garbage collected.
+            pass
+
+
+class MappedFrameBufferPool:
+    """
+    Caches dmabuf mappings, keyed by the dmabuf fd
+
+    Each dmabuf is mapped once, on first use, and the mapping is reused for
+    all later lookups. Mappings are kept until they are explicitly unmapped,
+    or evicted in LRU order when max_maps is exceeded. Each lookup returns
+    new memoryviews of the mapping, so the views held by the caller stay
+    valid when the mapping is unmapped or evicted: the memory is unmapped
+    when the last of them is released.
+
+    The fd is used as the key, so the buffers must be unmapped (with unmap()
+    or clear()) before their FrameBufferAllocator is freed, as the fd numbers
+    may be reused for new dmabufs afterwards.
+    """
+
+    __singleton = None
+    __singleton_lock = threading.Lock()
+
+    def __init__(self, max_maps: int = 0):
+        self.__maps: OrderedDict[int, _DmabufMapping] = OrderedDict()
+        self.__max_maps = max_maps
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    @staticmethod
+    def singleton() -> 'MappedFrameBufferPool':
+        """The process-wide pool"""
+        with MappedFrameBufferPool.__singleton_lock:
+            if MappedFrameBufferPool.__singleton is None:
+                MappedFrameBufferPool.__singleton = MappedFrameBufferPool()
+
+        return MappedFrameBufferPool.__singleton
+
+    def planes(self, fb: libcamera.FrameBuffer) -> Tuple[memoryview, ...]:
+        """Get memoryviews for the FrameBuffer's planes, mapping the dmabufs if needed"""
+        with self.__lock:
+            return tuple(self.__get(plane.fd).plane(plane.offset, plane.length)
+                         for plane in fb.planes)
+
+    def unmap(self, fb: libcamera.FrameBuffer):
+        """Unmap the dmabufs used by the FrameBuffer"""
+        with self.__lock:
+            for plane in fb.planes:
+                mapping = self.__maps.pop(plane.fd, None)
+                if mapping is not None:
+                    mapping.close()
+
+    def clear(self):
+        """Unmap all the dmabufs"""
+        with self.__lock:
+            for mapping in self.__maps.values():
+                mapping.close()
+
+            self.__maps.clear()
+
+    def __get(self, fd: int) -> _DmabufMapping:
+        mapping = self.__maps.get(fd)
+
+        if mapping is not None:
+            self.__maps.move_to_end(fd)
+            self.__hits += 1
+            return mapping
+
+        mapping = _DmabufMapping(fd)
+        self.__maps[fd] = mapping
+        self.__misses += 1
+
+        if self.__max_maps and len(self.__maps) > self.__max_maps:
+            _, evicted = self.__maps.popitem(last=False)
+            evicted.close()
+            self.__evictions += 1
+
+        return mapping
+
+    def __len__(self):
+        return len(self.__maps)
+
+    @property
+    def hits(self) -> int:
+        """Number of lookups served from an existing mapping"""
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        """Number of lookups which required a new mmap"""
+        return self.__misses
+
+    @property
+    def evictions(self) -> int:
+        """Number of mappings unmapped due to the max_maps limit"""
+        return self.__evictions
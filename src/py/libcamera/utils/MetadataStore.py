@@ -0,0 +1,264 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# A file for recorded per-frame metadata
+#
+# The file consists of:
+#
+# - The file header: magic, version, length of the description and the
+#   description as JSON. The description has the NumPy dtype of the rows, and
+#   the streams and the controls recorded.
+# - The rows, a row per request, stored as a NumPy structured array, starting
+#   at the first ALIGN aligned offset after the header
+#
+# The row has the request sequence number, a bitmask of the controls found in
+# the request metadata, and the columns:
+#
+# - '<stream>.sequence', '<stream>.timestamp' and '<stream>.bytes_used' from
+#   the FrameMetadata of the buffer of each stream, bytes_used being the sum
+#   over the planes
+# - '<control>' for each control
+#
+# All the integers are little-endian. The number of rows is given by the file
+# size, so a file with an interrupted recording is readable up to the last
+# complete row.
+
+from typing import Optional, Sequence
+import json
+import libcamera
+import struct
+
+_FILE_HEADER = struct.Struct('<4sII')
+
+_FILE_MAGIC = b'LCMD'
+
+_VERSION = 1
+
+ALIGN = 64
+
+# The maximum number of controls, given by the size of the 'present' bitmask
+MAX_CONTROLS = 64
+
+
+def _align(v: int) -> int:
+    return (v + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _dtype_from_descr(descr):
+    import numpy as np
+
+    # JSON turns the tuples of the dtype description to lists
+    return np.dtype([tuple(tuple(f) if isinstance(f, list) else f for f in field)
+                     for field in descr])
+
+
+class MetadataStoreWriter:
+    """
+    Records per-frame metadata to a metadata store file
+
+    The rows are collected in a preallocated chunk of chunk_rows rows, which
+    is written to the file when full, so the memory use does not grow with
+    the length of the recording.
+
+    The controls must be of the numeric or bool types. The array controls
+    need their number of elements in shapes, e.g.
+    {controls.ColourGains: 2}. A control missing from the metadata of a
+    request is stored as zeros, and its bit in the 'present' column is
+    cleared.
+    """
+
+    def __init__(self, filename: str, streams: Sequence[str],
+                 controls: Sequence[libcamera.ControlId],
+                 shapes: Optional[dict] = None, chunk_rows: int = 4096):
+        import numpy as np
+
+        if len(controls) > MAX_CONTROLS:
+            raise ValueError(f'Too many controls, the maximum is {MAX_CONTROLS}')
+
+        types = {
+            libcamera.ControlType.Bool: '|b1',
+            libcamera.ControlType.Byte: '|u1',
+            libcamera.ControlType.Integer32: '<i4',
+            libcamera.ControlType.Integer64: '<i8',
+            libcamera.ControlType.Float: '<f4',
+        }
+
+        shapes = shapes or {}
+
+        fields = [('sequence', '<u4'), ('present', '<u8')]
+
+        for s in streams:
+            fields += [(f'{s}.sequence', '<u4'), (f'{s}.timestamp', '<u8'),
+                       (f'{s}.bytes_used', '<u8')]
+
+        for id in controls:
+            t = types.get(id.type)
+            if t is None:
+                raise ValueError(f'Control {id.name} of type {id.type} is not supported')
+
+            if id in shapes:
+                fields.append((id.name, t, (shapes[id],)))
+            else:
+                fields.append((id.name, t))
+
+        self.streams = list(streams)
+        self.controls = list(controls)
+        self.dtype = np.dtype(fields)
+
+        self.__chunk = np.zeros(chunk_rows, self.dtype)
+        self.__pos = 0
+        self.__count = 0
+
+        # The columns of the chunk, to avoid looking them up for every row
+        self.__stream_columns = [(self.__chunk[f'{s}.sequence'], self.__chunk[f'{s}.timestamp'],
+                                  self.__chunk[f'{s}.bytes_used']) for s in self.streams]
+        self.__control_columns = [self.__chunk[id.name] for id in self.controls]
+        self.__sequence_column = self.__chunk['sequence']
+        self.__present_column = self.__chunk['present']
+
+        desc = json.dumps({
+            'dtype': self.dtype.descr,
+            'streams': self.streams,
+            'controls': [{'id': id.id, 'name': id.name, 'type': str(id.type)}
+                         for id in self.controls],
+        }).encode()
+
+        self.__f = open(filename, 'wb')
+        header = _FILE_HEADER.pack(_FILE_MAGIC, _VERSION, len(desc)) + desc
+        self.__f.write(header + bytes(_align(len(header)) - len(header)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __len__(self):
+        return self.__count
+
+    def append(self, req: libcamera.Request,
+               buffers: Optional[Sequence[libcamera.FrameBuffer]] = None) -> int:
+        """
+        Append a row for a completed request, returning its index in the file
+
+        buffers are the buffers of the streams, in the order of the streams
+        given when creating the writer, and default to the buffers of the
+        request in the order of req.buffers.
+        """
+        if buffers is None:
+            buffers = list(req.buffers.values())
+
+        if len(buffers) != len(self.streams):
+            raise ValueError(f'Expected {len(self.streams)} buffers, got {len(buffers)}')
+
+        i = self.__pos
+
+        self.__sequence_column[i] = req.sequence
+
+        for (seq, ts, used), fb in zip(self.__stream_columns, buffers):
+            meta = fb.metadata
+            seq[i] = meta.sequence
+            ts[i] = meta.timestamp
+            used[i] = sum(p.bytes_used for p in meta.planes)
+
+        present = 0
+
+        values = req.metadata.get_many(self.controls)
+        for bit, (col, val) in enumerate(zip(self.__control_columns, values)):
+            if val is None:
+                col[i] = 0
+            else:
+                col[i] = val
+                present |= 1 << bit
+
+        self.__present_column[i] = present
+
+        self.__pos += 1
+        self.__count += 1
+
+        if self.__pos == len(self.__chunk):
+            self.__write_chunk()
+
+        return self.__count - 1
+
+    def flush(self):
+        """Write the collected rows to the file"""
+        if self.__pos:
+            self.__write_chunk()
+        self.__f.flush()
+
+    def close(self):
+        if self.__f.closed:
+            return
+
+        self.flush()
+        self.__f.close()
+
+    def __write_chunk(self):
+        self.__f.write(memoryview(self.__chunk[:self.__pos]).cast('B'))
+        self.__pos = 0
+
+
+class MetadataStoreReader:
+    """
+    Reads a metadata store file
+
+    The rows are memory mapped with a single np.memmap, so opening the file
+    does not depend on its size, and the columns are views of the mapping.
+    """
+
+    def __init__(self, filename: str):
+        import numpy as np
+        import os
+
+        with open(filename, 'rb') as f:
+            header = f.read(_FILE_HEADER.size)
+            if len(header) != _FILE_HEADER.size:
+                raise RuntimeError(f'{filename} is not a metadata store file')
+
+            magic, version, desc_len = _FILE_HEADER.unpack(header)
+            if magic != _FILE_MAGIC:
+                raise RuntimeError(f'{filename} is not a metadata store file')
+            if version != _VERSION:
+                raise RuntimeError(f'Unsupported metadata store version {version}')
+
+            desc = json.loads(f.read(desc_len))
+
+        self.dtype = _dtype_from_descr(desc['dtype'])
+        self.streams: list[str] = desc['streams']
+        self.controls: list[str] = [c['name'] for c in desc['controls']]
+
+        offset = _align(_FILE_HEADER.size + desc_len)
+        count = max(os.path.getsize(filename) - offset, 0) // self.dtype.itemsize
+
+        if count:
+            self.rows = np.memmap(filename, self.dtype, 'r', offset, (count,))
+        else:
+            self.rows = np.zeros(0, self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        self.rows = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, column: str):
+        """A column, as a view of the mapping"""
+        return self.rows[column]
+
+    @property
+    def columns(self) -> tuple[str, ...]:
+        return self.dtype.names
+
+    def present(self, control: str):
+        """A bool array telling the rows in which the control was in the metadata"""
+        import numpy as np
+
+        mask = np.uint64(1 << self.controls.index(control))
+        return self.rows['present'] & mask != 0
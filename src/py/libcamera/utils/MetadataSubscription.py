@@ -0,0 +1,97 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+from collections import namedtuple
+from typing import Any, Optional, Sequence
+import libcamera
+
+
+class MetadataSubscription:
+    """
+    Reads a fixed set of controls from the metadata of completed requests
+
+    The values of the subscribed controls are fetched with a single
+    RequestMetadata.get_many() call, without converting the rest of the
+    metadata. read() returns them as a record, a named tuple with the
+    request sequence number and a field per control, named after the
+    control. Controls missing from the metadata get the default value.
+
+    With changes_only, read() returns None when none of the values has
+    changed since the last returned record, so e.g. the AE and AWB state
+    can be followed without handling a record per frame. Do not subscribe
+    to controls changing every frame, like SensorTimestamp, in this mode.
+
+    to_numpy() converts a list of records to a NumPy structured array, for
+    a time series of the values.
+    """
+
+    def __init__(self, ids: Sequence[libcamera.ControlId], changes_only: bool = False,
+                 default: Any = None):
+        self.ids = list(ids)
+        self.changes_only = changes_only
+        self.default = default
+
+        self.Record = namedtuple('MetadataRecord', ['sequence'] + [id.name for id in self.ids],
+                                 rename=True)
+
+        self.__last: Optional[list] = None
+
+    def read(self, req: libcamera.Request) -> Optional[tuple]:
+        """Get the record of the request, or None if changes_only and nothing changed"""
+        values = req.metadata.get_many(self.ids, self.default)
+
+        if self.changes_only:
+            if values == self.__last:
+                return None
+            self.__last = values
+
+        return self.Record(req.sequence, *values)
+
+    def reset(self):
+        """Forget the last values, so that the next read() returns a record"""
+        self.__last = None
+
+    def dtype(self, records: Sequence[tuple]):
+        """
+        The NumPy dtype of the records
+
+        The shapes of the array controls are taken from the first record
+        having a value for the control. The controls of other than numeric
+        types are stored as Python objects.
+        """
+        import numpy as np
+
+        types = {
+            libcamera.ControlType.Bool: np.bool_,
+            libcamera.ControlType.Byte: np.uint8,
+            libcamera.ControlType.Integer32: np.int32,
+            libcamera.ControlType.Integer64: np.int64,
+            libcamera.ControlType.Float: np.float32,
+        }
+
+        fields = [('sequence', np.uint32)]
+
+        for i, (name, id) in enumerate(zip(self.Record._fields[1:], self.ids), 1):
+            t = types.get(id.type, object)
+            val = next((r[i] for r in records if r[i] is not None), None)
+
+            if isinstance(val, (list, tuple)) and t is not object:
+                fields.append((name, t, (len(val),)))
+            else:
+                fields.append((name, t))
+
+        return np.dtype(fields)
+
+    def to_numpy(self, records: Sequence[tuple]):
+        """
+        Convert the records to a NumPy structured array, with the dtype
+        given by dtype(). The missing values are stored as zeros.
+        """
+        import numpy as np
+
+        arr = np.zeros(len(records), self.dtype(records))
+
+        for i, r in enumerate(records):
+            arr[i] = tuple(0 if v is None else v for v in r)
+
+        return arr
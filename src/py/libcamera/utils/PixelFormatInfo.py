@@ -0,0 +1,233 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+from typing import NamedTuple, Sequence, Tuple
+
+
+class PixelFormatPlaneInfo(NamedTuple):
+    bytes_per_group: int
+    vertical_subsampling: int
+
+
+class PixelFormatInfo:
+    """
+    Describes the memory layout of a pixel format
+
+    This mirrors the libcamera C++ PixelFormatInfo class. The plane strides
+    follow the V4L2 convention, where the stride of the first plane is given
+    and the strides of the other planes are derived from it.
+    """
+
+    ColourEncodingRGB = 'RGB'
+    ColourEncodingYUV = 'YUV'
+    ColourEncodingRAW = 'RAW'
+
+    def __init__(self, name: str, bits_per_pixel: int, colour_encoding: str,
+                 packed: bool, pixels_per_group: int,
+                 planes: Tuple[Tuple[int, int], ...], sample_size: int = 1,
+                 big_endian: bool = False):
+        self.name = name
+        self.bits_per_pixel = bits_per_pixel
+        self.colour_encoding = colour_encoding
+        self.packed = packed
+        self.pixels_per_group = pixels_per_group
+        self.planes = tuple(PixelFormatPlaneInfo(*p) for p in planes)
+        # Size of a single colour sample in bytes, for unpacked formats
+        self.sample_size = sample_size
+        # Byte order of the multi-byte samples
+        self.big_endian = big_endian
+
+    def __repr__(self):
+        return f'libcamera.utils.PixelFormatInfo({self.name})'
+
+    @staticmethod
+    def info(fmt) -> 'PixelFormatInfo':
+        """Look up the PixelFormatInfo for a PixelFormat or a format name"""
+        info = _pixel_format_infos.get(str(fmt))
+        if info is None:
+            raise ValueError(f'Unsupported pixel format {fmt}')
+        return info
+
+    @property
+    def num_planes(self) -> int:
+        return len(self.planes)
+
+    def stride(self, width: int, plane: int = 0, align: int = 1) -> int:
+        """Minimum number of bytes per line for the plane"""
+        groups = (width + self.pixels_per_group - 1) // self.pixels_per_group
+        stride = groups * self.planes[plane].bytes_per_group
+        return (stride + align - 1) // align * align
+
+    def plane_stride(self, stride: int, plane: int) -> int:
+        """Stride of the plane, given the stride of the first plane"""
+        return stride * self.planes[plane].bytes_per_group // self.planes[0].bytes_per_group
+
+    def plane_height(self, height: int, plane: int) -> int:
+        vsub = self.planes[plane].vertical_subsampling
+        return (height + vsub - 1) // vsub
+
+    def plane_size(self, height: int, stride: int, plane: int) -> int:
+        return self.plane_height(height, plane) * self.plane_stride(stride, plane)
+
+    def plane_offset(self, height: int, stride: int, plane: int) -> int:
+        """Offset of the plane when all the planes are stored contiguously"""
+        return sum(self.plane_size(height, stride, p) for p in range(plane))
+
+    def ndarray_layout(self, plane: int, width: int, height: int, stride: int):
+        """
+        Get the NumPy dtype, shape and strides describing a plane
+
+        Packed formats are described as bytes. For unpacked formats the last
+        axis holds the interleaved colour samples when there are more than
+        one per pixel, e.g. (height, width, 2) for YUYV and
+        (height / 2, width / 2, 2) for the CbCr plane of NV12.
+        """
+        if self.bits_per_pixel == 0:
+            raise ValueError(f'Compressed pixel format {self.name} has no fixed layout')
+
+        rows = self.plane_height(height, plane)
+        plane_stride = self.plane_stride(stride, plane)
+        line_size = self.stride(width, plane)
+
+        if self.packed:
+            return ('u1', (rows, line_size), (plane_stride, 1))
+
+        if self.sample_size == 2:
+            dtype = '>u2' if self.big_endian else '<u2'
+        else:
+            dtype = 'u1'
+        samples = line_size // self.sample_size
+
+        if plane == 0:
+            channels = self.planes[0].bytes_per_group // self.pixels_per_group // self.sample_size
+        elif self.num_planes == 2:
+            # Semi-planar formats interleave the two chroma components
+            channels = 2
+        else:
+            channels = 1
+
+        if channels == 1:
+            return (dtype, (rows, samples), (plane_stride, self.sample_size))
+
+        return (dtype, (rows, samples // channels, channels),
+                (plane_stride, self.sample_size * channels, self.sample_size))
+
+    def ndarray(self, planes: Sequence, plane: int, width: int, height: int, stride: int):
+        """
+        Get a NumPy array view of a plane, without copying the data
+
+        planes holds the buffers of the frame, either one per format plane or
+        a single buffer with all the format planes stored contiguously.
+        Compressed formats are returned as a flat array of bytes.
+        """
+        import numpy as np
+
+        if plane >= self.num_planes:
+            raise IndexError(f'{self.name} has only {self.num_planes} planes')
+
+        if self.bits_per_pixel == 0:
+            return np.frombuffer(planes[plane], dtype=np.uint8)
+
+        if len(planes) == self.num_planes:
+            data = planes[plane]
+            offset = 0
+        elif len(planes) == 1:
+            # All the format planes are stored contiguously in one buffer plane
+            data = planes[0]
+            offset = self.plane_offset(height, stride, plane)
+        else:
+            raise RuntimeError(f'Frame has {len(planes)} planes, '
+                               f'{self.name} requires {self.num_planes}')
+
+        dtype, shape, strides = self.ndarray_layout(plane, width, height, stride)
+
+        return np.ndarray(shape, dtype=dtype, buffer=data, offset=offset,
+                          strides=strides)
+
+    def unpack(self, data, width: int, out=None):
+        """
+        Unpack a MIPI CSI-2 packed plane to 16-bit samples
+
+        data is the packed plane as a (height, stride) uint8 array, as
+        returned by ndarray(), and can have any strides. The result is a
+        (height, width) uint16 array, with the samples in the low bits. If out
+        is given, the result is written to it. See csi2.unpack_csi2p().
+        """
+        from .csi2 import unpack_csi2p
+
+        if not self.name.endswith('_CSI2P'):
+            raise ValueError(f'{self.name} is not a CSI-2 packed format')
+
+        return unpack_csi2p(data, width, self.bits_per_pixel, out)
+
+
+def _build_infos():
+    RGB = PixelFormatInfo.ColourEncodingRGB
+    YUV = PixelFormatInfo.ColourEncodingYUV
+    RAW = PixelFormatInfo.ColourEncodingRAW
+
+    infos = [
+        # RGB formats
+        PixelFormatInfo('RGB565', 16, RGB, False, 1, ((2, 1),), sample_size=2),
+        PixelFormatInfo('RGB565_BE', 16, RGB, False, 1, ((2, 1),), sample_size=2,
+                        big_endian=True),
+        PixelFormatInfo('BGR888', 24, RGB, False, 1, ((3, 1),)),
+        PixelFormatInfo('RGB888', 24, RGB, False, 1, ((3, 1),)),
+    ]
+
+    for name in ['XRGB8888', 'XBGR8888', 'RGBX8888', 'BGRX8888',
+                 'ABGR8888', 'ARGB8888', 'BGRA8888', 'RGBA8888']:
+        infos.append(PixelFormatInfo(name, 32, RGB, False, 1, ((4, 1),)))
+
+    # YUV packed formats
+    for name in ['YUYV', 'YVYU', 'UYVY', 'VYUY']:
+        infos.append(PixelFormatInfo(name, 16, YUV, False, 2, ((4, 1),)))
+    for name in ['AVUY8888', 'XVUY8888']:
+        infos.append(PixelFormatInfo(name, 32, YUV, False, 1, ((4, 1),)))
+
+    # YUV planar formats
+    infos += [
+        PixelFormatInfo('NV12', 12, YUV, False, 2, ((2, 1), (2, 2))),
+        PixelFormatInfo('NV21', 12, YUV, False, 2, ((2, 1), (2, 2))),
+        PixelFormatInfo('NV16', 16, YUV, False, 2, ((2, 1), (2, 1))),
+        PixelFormatInfo('NV61', 16, YUV, False, 2, ((2, 1), (2, 1))),
+        PixelFormatInfo('NV24', 24, YUV, False, 1, ((1, 1), (2, 1))),
+        PixelFormatInfo('NV42', 24, YUV, False, 1, ((1, 1), (2, 1))),
+        PixelFormatInfo('YUV420', 12, YUV, False, 2, ((2, 1), (1, 2), (1, 2))),
+        PixelFormatInfo('YVU420', 12, YUV, False, 2, ((2, 1), (1, 2), (1, 2))),
+        PixelFormatInfo('YUV422', 16, YUV, False, 2, ((2, 1), (1, 1), (1, 1))),
+        PixelFormatInfo('YVU422', 16, YUV, False, 2, ((2, 1), (1, 1), (1, 1))),
+        PixelFormatInfo('YUV444', 24, YUV, False, 1, ((1, 1), (1, 1), (1, 1))),
+        PixelFormatInfo('YVU444', 24, YUV, False, 1, ((1, 1), (1, 1), (1, 1))),
+    ]
+
+    # Greyscale formats
+    infos += [
+        PixelFormatInfo('R8', 8, YUV, False, 1, ((1, 1),)),
+        PixelFormatInfo('R10', 10, YUV, False, 1, ((2, 1),), sample_size=2),
+        PixelFormatInfo('R12', 12, YUV, False, 1, ((2, 1),), sample_size=2),
+        PixelFormatInfo('R10_CSI2P', 10, YUV, True, 4, ((5, 1),)),
+    ]
+
+    # Bayer formats
+    for order in ['BGGR', 'GBRG', 'GRBG', 'RGGB']:
+        infos.append(PixelFormatInfo(f'S{order}8', 8, RAW, False, 2, ((2, 1),)))
+
+        for bits in [10, 12, 14, 16]:
+            infos.append(PixelFormatInfo(f'S{order}{bits}', bits, RAW, False, 2,
+                                         ((4, 1),), sample_size=2))
+
+        infos += [
+            PixelFormatInfo(f'S{order}10_CSI2P', 10, RAW, True, 4, ((5, 1),)),
+            PixelFormatInfo(f'S{order}12_CSI2P', 12, RAW, True, 2, ((3, 1),)),
+            PixelFormatInfo(f'S{order}14_CSI2P', 14, RAW, True, 4, ((7, 1),)),
+            PixelFormatInfo(f'S{order}10_IPU3', 10, RAW, True, 25, ((32, 1),)),
+        ]
+
+    # Compressed formats
+    infos.append(PixelFormatInfo('MJPEG', 0, YUV, False, 1, ((1, 1),)))
+
+    return {info.name: info for info in infos}
+
+
+_pixel_format_infos = _build_infos()
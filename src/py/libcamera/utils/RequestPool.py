@@ -0,0 +1,224 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+from typing import Optional, Sequence
+import libcamera
+import threading
+import time
+
+
+class PooledRequest:
+    """
+    A completed request taken from a RequestPool
+
+    Used as a context manager, gives the Request, and releases the hold on
+    it on exit, queuing the request to the camera again if it was the last
+    hold.
+    """
+
+    def __init__(self, pool: 'RequestPool', request: libcamera.Request):
+        self.pool = pool
+        self.request = request
+
+    def __enter__(self) -> libcamera.Request:
+        return self.request
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+
+    def release(self):
+        self.pool.release(self.request)
+
+
+class RequestPool:
+    """
+    The buffers and requests of a camera, queued to the camera continuously
+
+    The buffers are allocated for the streams, and a request is created for
+    each set of buffers, once. The requests are queued with start(), and
+    after that each completed request is queued again when the application
+    releases it:
+
+        for req in cm.get_ready_requests():
+            with pool.take(req) as req:
+                process(req)
+
+    A completed request can be held by several consumers, possibly on other
+    threads, with hold() and release(). The request is reused and queued
+    again when the last hold is released. If limit is not 0, no more than
+    limit requests are queued in total.
+
+    The pool keeps track of the requests queued to the camera. When the
+    camera runs out of requests because the application holds all of them,
+    the pipeline stalls waiting for the application. The number of such
+    stalls and their total length are available in starved_count and
+    starved_time.
+
+    The allocator defaults to a libcamera.FrameBufferAllocator for the
+    camera. The camera must be configured before creating the pool, and
+    started before calling start(). Call stop() before stopping the camera,
+    so that the requests are not queued to the stopped camera.
+    """
+
+    def __init__(self, camera: libcamera.Camera, streams: Sequence[libcamera.Stream],
+                 cookie: int = 0, allocator=None, limit: int = 0):
+        if allocator is None:
+            allocator = libcamera.FrameBufferAllocator(camera)
+
+        for stream in streams:
+            if allocator.allocate(stream) <= 0:
+                raise RuntimeError('Failed to allocate buffers')
+
+        self.camera = camera
+        self.streams = list(streams)
+        self.allocator = allocator
+        self.limit = limit
+
+        # The stream with the least buffers sets the number of requests
+        num_bufs = min(len(allocator.buffers(stream)) for stream in self.streams)
+
+        self.requests: list[libcamera.Request] = []
+
+        for i in range(num_bufs):
+            req = camera.create_request(cookie)
+            if req is None:
+                raise RuntimeError('Failed to create request')
+
+            for stream in self.streams:
+                req.add_buffer(stream, allocator.buffers(stream)[i])
+
+            self.requests.append(req)
+
+        self.__lock = threading.Lock()
+        self.__holds: dict[libcamera.Request, int] = {}
+        self.__running = False
+        self.__in_flight = 0
+        self.__queued = 0
+        self.__completed = 0
+        self.__starved_since: Optional[int] = None
+        self.__starved_ns = 0
+        self.__starved_count = 0
+
+    def buffers(self, stream: libcamera.Stream) -> list[libcamera.FrameBuffer]:
+        return self.allocator.buffers(stream)
+
+    def start(self):
+        """Queue all the requests to the camera"""
+        with self.__lock:
+            self.__running = True
+
+        for req in self.requests:
+            if not self.__begin_queue():
+                break
+
+            self.camera.queue_request(req)
+
+    def stop(self):
+        """Stop queuing the completed requests"""
+        with self.__lock:
+            self.__running = False
+            self.__starved_since = None
+
+    def close(self):
+        """Free the buffers. The camera must have been stopped."""
+        self.stop()
+
+        self.requests = []
+        self.__holds = {}
+
+        for stream in self.streams:
+            self.allocator.free(stream)
+
+    def take(self, req: libcamera.Request, timestamp: Optional[int] = None) -> PooledRequest:
+        """
+        Take a completed request, holding it until the returned
+        PooledRequest is released
+
+        timestamp is the time the request completed, in CLOCK_MONOTONIC
+        nanoseconds as given by CameraManager.get_ready_request_batch(), and
+        defaults to the current time.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+
+        with self.__lock:
+            self.__completed += 1
+            self.__in_flight -= 1
+            self.__holds[req] = self.__holds.get(req, 0) + 1
+
+            if self.__in_flight == 0 and self.__running:
+                self.__starved_since = timestamp
+
+        return PooledRequest(self, req)
+
+    def hold(self, req: libcamera.Request):
+        """Take an additional hold of a completed request. May be called from any thread."""
+        with self.__lock:
+            self.__holds[req] += 1
+
+    def release(self, req: libcamera.Request):
+        """
+        Release a hold of a completed request, queuing the request again if
+        this was the last hold. May be called from any thread.
+        """
+        with self.__lock:
+            count = self.__holds[req] - 1
+            if count:
+                self.__holds[req] = count
+                return
+
+            del self.__holds[req]
+
+        if not self.__begin_queue():
+            return
+
+        req.reuse()
+        self.camera.queue_request(req)
+
+    def __begin_queue(self) -> bool:
+        with self.__lock:
+            if not self.__running or (self.limit and self.__queued >= self.limit):
+                return False
+
+            if self.__in_flight == 0 and self.__starved_since is not None:
+                self.__starved_ns += time.monotonic_ns() - self.__starved_since
+                self.__starved_count += 1
+                self.__starved_since = None
+
+            self.__in_flight += 1
+            self.__queued += 1
+
+            return True
+
+    @property
+    def in_flight(self) -> int:
+        """Number of requests queued to the camera and not yet taken"""
+        return self.__in_flight
+
+    @property
+    def held(self) -> int:
+        """Number of completed requests held by the application"""
+        return len(self.__holds)
+
+    @property
+    def queued(self) -> int:
+        """Number of times a request has been queued to the camera"""
+        return self.__queued
+
+    @property
+    def completed(self) -> int:
+        """Number of completed requests taken"""
+        return self.__completed
+
+    @property
+    def starved_count(self) -> int:
+        """Number of times the camera ran out of requests while running"""
+        return self.__starved_count
+
+    @property
+    def starved_time(self) -> float:
+        """
+        Total time in seconds the camera had no requests queued while
+        running, i.e. the pipeline was waiting on the application
+        """
+        return self.__starved_ns / 1000000000
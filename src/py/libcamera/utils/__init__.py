@@ -1,4 +1,12 @@
 # SPDX-License-Identifier: LGPL-2.1-or-later
 # Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
 
+from .AsyncCameraManager import AsyncCameraManager
+from .ChecksumEngine import ChecksumEngine, ChecksumResult
+from .FrameStore import FrameStoreFrame, FrameStoreReader, FrameStoreStream, FrameStoreWriter
 from .MappedFrameBuffer import MappedFrameBuffer
+from .MappedFrameBufferPool import MappedFrameBufferPool
+from .MetadataStore import MetadataStoreReader, MetadataStoreWriter
+from .MetadataSubscription import MetadataSubscription
+from .PixelFormatInfo import PixelFormatInfo
+from .RequestPool import PooledRequest, RequestPool
@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# Unpacking of the MIPI CSI-2 packed raw formats
+#
+# This module does not depend on the libcamera bindings, and is also used by
+# the Raspberry Pi camera tuning tool.
+
+# Pixels per packing group, for the supported bit depths
+PIXELS_PER_GROUP = {10: 4, 12: 2, 14: 4}
+
+
+def group_bytes(bits: int) -> int:
+    """Number of bytes of a packing group"""
+    ppg = PIXELS_PER_GROUP[bits]
+    return ppg * bits // 8
+
+
+def unpack_csi2p(data, width: int, bits: int, out=None):
+    """
+    Unpack a MIPI CSI-2 packed plane to 16-bit samples
+
+    data is the packed plane as a (height, stride) uint8 array, and can have
+    any strides. bits is the bit depth, 10, 12 or 14. The result is a
+    (height, width) uint16 array, with the samples in the low bits. If out is
+    given, the result is written to it, and it must be a C-contiguous
+    (height, width) uint16 array.
+
+    In CSI-2 packing the 8 most significant bits of each pixel of a group
+    are stored in one byte each, followed by the remaining least significant
+    bits of all the pixels of the group.
+    """
+    import numpy as np
+
+    if bits not in PIXELS_PER_GROUP:
+        raise ValueError(f'Unsupported CSI-2 packed bit depth {bits}')
+
+    height = data.shape[0]
+    ppg = PIXELS_PER_GROUP[bits]
+    gbytes = group_bytes(bits)
+    lsb_bits = bits - 8
+    lsb_mask = (1 << lsb_bits) - 1
+    groups = (width + ppg - 1) // ppg
+
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint16)
+    elif out.shape != (height, width) or out.dtype != np.uint16 or not out.flags.c_contiguous:
+        # The groups are unpacked through a reshaped view of out, which would
+        # be a copy for other layouts
+        raise ValueError(f'out must be a C-contiguous ({height}, {width}) uint16 array')
+
+    # Without a whole number of groups per line, unpack to a temporary array
+    # and copy the visible pixels
+    if groups * ppg == width:
+        dst = out
+    else:
+        dst = np.empty((height, groups * ppg), dtype=np.uint16)
+
+    src = data[:, :groups * gbytes].reshape(height, groups, gbytes)
+    dst_groups = dst.reshape(height, groups, ppg)
+
+    # The least significant bits of all the pixels of the group
+    lsb = src[:, :, ppg].astype(np.uint32)
+    for i in range(1, gbytes - ppg):
+        lsb |= src[:, :, ppg + i].astype(np.uint32) << (8 * i)
+
+    tmp = np.empty((height, groups), dtype=np.uint32)
+
+    for i in range(ppg):
+        np.left_shift(src[:, :, i], lsb_bits, out=dst_groups[:, :, i], dtype=np.uint16)
+        np.right_shift(lsb, lsb_bits * i, out=tmp)
+        np.bitwise_and(tmp, lsb_mask, out=tmp)
+        np.bitwise_or(dst_groups[:, :, i], tmp, out=dst_groups[:, :, i], casting='unsafe')
+
+    if dst is not out:
+        out[...] = dst[:, :width]
+
+    return out
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# Capture path benchmarks for the Python bindings
+#
+# Measures the per-call overhead of the capture API and the sustained request
+# rate for 1, 4 and 16 streams. vimc is used if found, otherwise the fake
+# camera backend. Cases which the camera can't be configured for are skipped.
+# The results are written as JSON, and can be compared to earlier results
+# with --compare.
+
+import argparse
+import json
+import libcamera as libcam
+import platform
+import selectors
+import sys
+import time
+
+
+class Bench:
+    def __init__(self, libcam_mod, cm, cam, num_streams):
+        self.libcam = libcam_mod
+        self.cm = cm
+        self.cam = cam
+
+        cam.acquire()
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.Viewfinder] * num_streams)
+        if camconfig is None or len(camconfig) != num_streams or \
+           camconfig.validate() == libcam.CameraConfiguration.Status.Invalid:
+            cam.release()
+            raise RuntimeError(f'{num_streams} streams not supported')
+
+        cam.configure(camconfig)
+
+        self.streams = [cfg.stream for cfg in camconfig]
+        self.allocator = libcam_mod.FrameBufferAllocator(cam)
+
+        for stream in self.streams:
+            self.allocator.allocate(stream)
+
+        self.num_bufs = min(len(self.allocator.buffers(s)) for s in self.streams)
+
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(cm.event_fd, selectors.EVENT_READ)
+
+    def close(self):
+        self.sel.close()
+        self.cam.release()
+
+    def create_requests(self):
+        reqs = []
+        for i in range(self.num_bufs):
+            req = self.cam.create_request(i)
+            for stream in self.streams:
+                req.add_buffer(stream, self.allocator.buffers(stream)[i])
+            reqs.append(req)
+        return reqs
+
+    def wait_requests(self):
+        while True:
+            self.sel.select()
+            reqs = self.cm.get_ready_requests()
+            if reqs:
+                return reqs
+
+    def calls(self, iterations):
+        """Per-call overhead of the capture API, in ns"""
+        res = {}
+        cam = self.cam
+        buffers = [self.allocator.buffers(s)[0] for s in self.streams]
+
+        t = time.perf_counter_ns()
+        for i in range(iterations):
+            cam.create_request(i)
+        res['create_request'] = (time.perf_counter_ns() - t) / iterations
+
+        reqs = [cam.create_request(i) for i in range(iterations)]
+        t = time.perf_counter_ns()
+        for req in reqs:
+            for stream, fb in zip(self.streams, buffers):
+                req.add_buffer(stream, fb)
+        res['add_buffer'] = (time.perf_counter_ns() - t) / iterations / len(self.streams)
+        del reqs
+
+        # The rest need a completed request
+
+        cam.start()
+
+        reqs = self.create_requests()
+        cam.queue_request(reqs[0])
+        req = self.wait_requests()[0]
+
+        t = time.perf_counter_ns()
+        for _ in range(iterations):
+            req.buffers
+        res['Request.buffers'] = (time.perf_counter_ns() - t) / iterations
+
+        fb = next(iter(req.buffers.values()))
+        t = time.perf_counter_ns()
+        for _ in range(iterations):
+            fb.metadata.planes
+        res['FrameMetadata.planes'] = (time.perf_counter_ns() - t) / iterations
+
+        t = time.perf_counter_ns()
+        for _ in range(iterations):
+            dict(req.metadata.items())
+        res['Request.metadata'] = (time.perf_counter_ns() - t) / iterations
+
+        ts_id = libcam.controls.SensorTimestamp
+        t = time.perf_counter_ns()
+        for _ in range(iterations):
+            req.metadata.get(ts_id)
+        res['Request.metadata.get'] = (time.perf_counter_ns() - t) / iterations
+
+        # Round trips through the camera, measuring the Python side only
+
+        queue_ns = 0
+        ready_ns = 0
+        reuse_ns = 0
+        rounds = min(iterations, 200)
+
+        for _ in range(rounds):
+            t = time.perf_counter_ns()
+            req.reuse()
+            reuse_ns += time.perf_counter_ns() - t
+
+            t = time.perf_counter_ns()
+            cam.queue_request(req)
+            queue_ns += time.perf_counter_ns() - t
+
+            self.sel.select()
+
+            t = time.perf_counter_ns()
+            req = self.cm.get_ready_requests()[0]
+            ready_ns += time.perf_counter_ns() - t
+
+        res['reuse'] = reuse_ns / rounds
+        res['queue_request'] = queue_ns / rounds
+        res['get_ready_requests'] = ready_ns / rounds
+
+        cam.stop()
+        self.cm.get_ready_requests()
+
+        return res
+
+    def sustained(self, duration):
+        """Requests per second with all the buffers kept queued"""
+        cam = self.cam
+
+        reqs = self.create_requests()
+
+        cam.start()
+        for req in reqs:
+            cam.queue_request(req)
+
+        count = 0
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        end = start + duration
+
+        while time.perf_counter() < end:
+            for req in self.wait_requests():
+                for fb in req.buffers.values():
+                    fb.metadata.planes
+                req.metadata.get(libcam.controls.SensorTimestamp)
+
+                req.reuse()
+                cam.queue_request(req)
+                count += 1
+
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+
+        cam.stop()
+        self.cm.get_ready_requests()
+
+        return {
+            'requests_per_sec': count / elapsed,
+            'cpu_us_per_request': cpu / count * 1000000 if count else 0,
+        }
+
+
+def open_backend(backend):
+    if backend in ['auto', 'vimc']:
+        try:
+            cm = libcam.CameraManager.singleton()
+            cam = next((c for c in cm.cameras if 'platform/vimc' in c.id), None)
+            if cam is not None:
+                return 'vimc', libcam, cm, cam
+        except RuntimeError:
+            pass
+
+        if backend == 'vimc':
+            raise RuntimeError('No vimc found')
+
+    import libcamera.fake as fake
+
+    # A frame rate high enough for the Python side to be the bottleneck
+    cm = fake.CameraManager([fake.FakeCameraOptions(fps=100000, width=320, height=240,
+                                                    buffer_count=8)])
+    return 'fake', fake, cm, cm.cameras[0]
+
+
+def compare(results, baseline):
+    base = {(r['name'], r['streams']): r for r in baseline['results']}
+
+    print(f'{"benchmark":<32} {"streams":>7} {"baseline":>12} {"current":>12} {"change":>8}')
+
+    for r in results['results']:
+        b = base.get((r['name'], r['streams']))
+        if b is None:
+            continue
+
+        old = b['value']
+        new = r['value']
+        change = (new - old) / old * 100 if old else 0
+        print(f'{r["name"]:<32} {r["streams"]:>7} {old:>12.1f} {new:>12.1f} {change:>+7.1f}%')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', default='auto', choices=['auto', 'vimc', 'fake'])
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=2.0, help='Duration of the sustained capture per case, in seconds')
+    parser.add_argument('--iterations', type=int, default=10000, help='Iterations of the per-call benchmarks')
+    parser.add_argument('-o', '--output', help='Write the results to a JSON file instead of stdout')
+    parser.add_argument('--compare', metavar='FILE', help='Compare the results to earlier results')
+    args = parser.parse_args()
+
+    backend, libcam_mod, cm, cam = open_backend(args.backend)
+
+    results = {
+        'backend': backend,
+        'camera': cam.id,
+        'libcamera_version': cm.version,
+        'python': platform.python_version(),
+        'results': [],
+    }
+
+    for num_streams in args.streams:
+        try:
+            bench = Bench(libcam_mod, cm, cam, num_streams)
+        except RuntimeError as e:
+            print(f'Skipping {num_streams} streams: {e}', file=sys.stderr)
+            continue
+
+        try:
+            for name, value in bench.calls(args.iterations).items():
+                results['results'].append({'name': name, 'streams': num_streams,
+                                           'unit': 'ns/call', 'value': value})
+
+            res = bench.sustained(args.duration)
+            results['results'].append({'name': 'requests_per_sec', 'streams': num_streams,
+                                       'unit': 'req/s', 'value': res['requests_per_sec']})
+            results['results'].append({'name': 'cpu_per_request', 'streams': num_streams,
+                                       'unit': 'us/req', 'value': res['cpu_us_per_request']})
+        finally:
+            bench.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1162 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+# Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
+
+# Tests of the cam tool modules, capturing from the fake camera backend
+
+import contextlib
+import io
+import numpy as np
+import random
+import libcamera
+import libcamera.fake as fake
+import libcamera.utils
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/py/cam'))
+
+import cam  # noqa: E402
+from cam import CameraContext, CaptureState  # noqa: E402
+import cam_null  # noqa: E402
+import convert_yuv  # noqa: E402
+import demosaic  # noqa: E402
+import display_queue  # noqa: E402
+import frame_sync  # noqa: E402
+import renderer  # noqa: E402
+import frame_writer  # noqa: E402
+import sinks  # noqa: E402
+import stats  # noqa: E402
+
+
+def create_state(num_cameras=1, capture=8, fps=200.0):
+    opts = fake.FakeCameraOptions(fps=fps, width=64, height=48)
+    cm = fake.CameraManager([opts] * num_cameras)
+
+    contexts = []
+
+    for idx, camera in enumerate(cm.cameras, 1):
+        ctx = CameraContext(camera, idx, fake)
+        ctx.opt_capture = capture
+        ctx.opt_crc = False
+        ctx.opt_save_frames = False
+        ctx.opt_metadata = False
+        ctx.opt_stats = False
+        ctx.opt_strict_formats = False
+        ctx.opt_stream = ['role=viewfinder']
+        contexts.append(ctx)
+
+    state = CaptureState(cm, contexts, fake)
+
+    state.renderer = cam_null.NullRenderer(state)
+    state.renderer.key_input = None
+
+    return state
+
+
+def run_capture(state):
+    """Run the capture, returning the output"""
+    out = io.StringIO()
+
+    with contextlib.redirect_stdout(out):
+        state.do_cmd_capture()
+
+    return out.getvalue()
+
+
+def run_main(*argv):
+    """Run cam with the given arguments, returning the exit code and the output"""
+    out = io.StringIO()
+
+    with unittest.mock.patch.object(sys, 'argv', ['cam.py', *argv]):
+        with contextlib.redirect_stdout(out):
+            ret = cam.main()
+
+    return ret, out.getvalue()
+
+
+class LoggingSink(sinks.Sink):
+    """
+    Holds each request until depth newer requests have been handled,
+    logging the handled and released requests
+    """
+
+    def __init__(self, state, log, depth):
+        super().__init__(state)
+
+        self.log = log
+        self.depth = depth
+        self.held = []
+
+    def handle(self, ctx, req, completion, dispatch_ts):
+        self.log.append(('handle', self, req))
+
+        self.state.hold_request(req)
+        self.held.append((ctx, req))
+
+        while len(self.held) > self.depth:
+            self.__release(*self.held.pop(0))
+
+    def __release(self, ctx, req):
+        self.log.append(('release', self, req))
+        self.state.request_processed(ctx, req)
+
+    def close(self):
+        while self.held:
+            self.__release(*self.held.pop(0))
+
+
+class SinkTestMethods(unittest.TestCase):
+    def test_abstract(self):
+        state = create_state()
+
+        with self.assertRaises(TypeError):
+            sinks.Sink(state)
+
+    def test_requeue_after_last_release(self):
+        state = create_state(capture=20)
+        ctx = state.contexts[0]
+
+        log = []
+
+        state.sinks = [LoggingSink(state, log, 1), LoggingSink(state, log, 2),
+                       LoggingSink(state, log, 0)]
+
+        camera = ctx.camera
+        queue_request = camera.queue_request
+
+        def logging_queue_request(req):
+            log.append(('queue', None, req))
+            queue_request(req)
+
+        camera.queue_request = logging_queue_request
+
+        run_capture(state)
+
+        self.assertEqual(ctx.reqs_completed, 20)
+        self.assertEqual(ctx.reqs_queued, 20)
+
+        # When a request is queued again, every sink has released the
+        # request since handling it
+        holders = {}
+
+        for event, sink, req in log:
+            if event == 'handle':
+                holders.setdefault(req, set()).add(sink)
+            elif event == 'release':
+                holders[req].remove(sink)
+            else:
+                self.assertFalse(holders.get(req), 'request queued while held')
+
+        # All the holds were released at close()
+        self.assertFalse(any(holders.values()))
+
+        # The sinks got every request, in the order of the sinks
+        handles = [(sink, req) for event, sink, req in log if event == 'handle']
+        self.assertEqual(len(handles), 20 * 3)
+        for i in range(0, len(handles), 3):
+            self.assertEqual([s for s, _ in handles[i:i + 3]], state.sinks)
+            self.assertEqual(len({r for _, r in handles[i:i + 3]}), 1)
+
+    def test_publisher(self):
+        state = create_state(capture=7)
+        ctx = state.contexts[0]
+
+        prefix = f'camtests-{os.getpid()}'
+        publisher = sinks.ShmPublisherSink(state, prefix, 3)
+
+        test = self
+
+        class CheckSink(sinks.Sink):
+            """Copies the frames, and checks the segment before the publisher is closed"""
+
+            def __init__(self, state):
+                super().__init__(state)
+                self.frames = []
+
+            def handle(self, ctx, req, completion, dispatch_ts):
+                fb = next(iter(req.buffers.values()))
+                meta = fb.metadata
+
+                with libcamera.utils.MappedFrameBuffer(fb, state.mfb_pool) as mfb:
+                    data = b''.join(bytes(p) for p in mfb.planes)
+
+                self.frames.append((meta.sequence, meta.timestamp, data))
+
+            def close(self):
+                stream = ctx.streams[0]
+                cfg = stream.configuration
+
+                with open(f'/dev/shm/{prefix}-cam1-stream0', 'rb') as f:
+                    seg = f.read()
+
+                cls = sinks.ShmPublisherSink
+
+                magic, version, num_slots, slot_size, width, height, stride, fmt = \
+                    cls.HEADER.unpack_from(seg, 0)
+                test.assertEqual(magic, b'LCSM')
+                test.assertEqual(version, 1)
+                test.assertEqual(num_slots, 3)
+                test.assertEqual((width, height, stride), (64, 48, cfg.stride))
+                test.assertEqual(fmt.rstrip(b'\0').decode(), str(cfg.pixel_format))
+
+                header_size = cls.HEADER.size + cls.COUNTER.size
+                test.assertEqual(len(seg), header_size + num_slots * slot_size)
+
+                count, = cls.COUNTER.unpack_from(seg, cls.HEADER.size)
+                test.assertEqual(count, len(self.frames))
+
+                # The last num_slots frames are in the slots n % num_slots
+                for n in range(count - num_slots, count):
+                    seq, ts, data = self.frames[n]
+                    offset = header_size + (n % num_slots) * slot_size
+
+                    test.assertEqual(cls.SLOT_HEADER.unpack_from(seg, offset),
+                                     (seq, ts, len(data)))
+
+                    pos = offset + cls.SLOT_HEADER.size
+                    test.assertEqual(seg[pos:pos + len(data)], data)
+
+                self.checked = True
+
+        check = CheckSink(state)
+
+        # The sinks are closed in order, so the segment is checked before
+        # the publisher unlinks it
+        state.sinks = [check, publisher]
+
+        run_capture(state)
+
+        self.assertEqual(len(check.frames), 7)
+        self.assertTrue(check.checked)
+        self.assertFalse(os.path.exists(f'/dev/shm/{prefix}-cam1-stream0'))
+
+    def test_metadata_record_unknown_control(self):
+        state = create_state()
+
+        with self.assertRaises(ValueError):
+            sinks.MetadataRecordSink(state, 'meta.lcmd', ['ExposureTime', 'NoSuchControl'])
+
+        # The control enums are not controls
+        with self.assertRaises(ValueError):
+            sinks.MetadataRecordSink(state, 'meta.lcmd', ['AeMeteringModeEnum'])
+
+
+class MainTestMethods(unittest.TestCase):
+    def test_unknown_metadata_control(self):
+        for opt in ('--metadata', '--record-metadata=meta.lcmd'):
+            ret, out = run_main('--fake', '-c', '1', '-C', '1', opt,
+                                '--metadata-controls', 'SensorTimestamp,NoSuchControl')
+
+            self.assertEqual(ret, -1)
+            self.assertEqual(out, 'Unknown control NoSuchControl\n')
+
+    def test_bad_sync_tolerance(self):
+        for tolerance in ('0', '-5'):
+            ret, out = run_main('--fake', '-c', '1', '-C', '1', '-c', '2', '-C', '1',
+                                '--sync', tolerance)
+
+            self.assertEqual(ret, -1)
+            self.assertEqual(out, f'Bad --sync tolerance {float(tolerance)}\n')
+
+
+class RendererTestMethods(unittest.TestCase):
+    def test_capture_done(self):
+        state = create_state(num_cameras=2, capture=5)
+
+        out = run_capture(state)
+
+        self.assertEqual([ctx.reqs_completed for ctx in state.contexts], [5, 5])
+        self.assertNotIn('Press enter', out)
+        self.assertIn('Exiting...', out)
+
+    def test_key_input(self):
+        # Capture "forever", until enter is pressed
+        state = create_state(capture=1000000)
+
+        r, w = os.pipe()
+
+        with os.fdopen(r) as key_input, os.fdopen(w, 'w') as key_output:
+            state.renderer.key_input = key_input
+            key_output.write('\n')
+            key_output.flush()
+
+            out = run_capture(state)
+
+        self.assertIn('Press enter to exit', out)
+        self.assertLess(state.contexts[0].reqs_completed, 1000000)
+
+    def test_event_sources(self):
+        state = create_state(capture=1000000)
+
+        r, w = os.pipe()
+
+        class SourceRenderer(renderer.Renderer):
+            def __init__(self, state):
+                super().__init__(state)
+                self.key_input = None
+                self.events = 0
+
+            def event_sources(self):
+                return [(r, self.read)]
+
+            def read(self, fd):
+                os.read(fd, 1)
+                self.events += 1
+                self.stop()
+
+        state.renderer = SourceRenderer(state)
+
+        os.write(w, b'x')
+
+        try:
+            run_capture(state)
+        finally:
+            os.close(r)
+            os.close(w)
+
+        self.assertEqual(state.renderer.events, 1)
+
+    def test_request_handler(self):
+        # The default request_handler() releases the renderer's hold, so
+        # the capture runs with more frames than buffers
+        state = create_state(capture=12)
+
+        run_capture(state)
+
+        ctx = state.contexts[0]
+        self.assertEqual(ctx.reqs_completed, 12)
+        self.assertEqual(ctx.reqs_queued, 12)
+
+
+class StubContext:
+    def __init__(self, idx):
+        self.idx = idx
+        self.id = f'cam{idx}'
+
+
+class StubRequest:
+    def __init__(self, seq, ts):
+        meta = types.SimpleNamespace(sequence=seq, timestamp=ts)
+        self.buffers = {'stream0': types.SimpleNamespace(metadata=meta)}
+
+
+class StubState:
+    """A CaptureState counting the holds of the requests"""
+
+    def __init__(self, num_cameras):
+        self.contexts = [StubContext(i) for i in range(1, num_cameras + 1)]
+        self.holds = {}
+        self.processed = []
+
+    def hold_request(self, req):
+        self.holds[req] = self.holds.get(req, 0) + 1
+
+    def request_processed(self, ctx, req):
+        self.processed.append(req)
+
+        self.holds[req] -= 1
+        if not self.holds[req]:
+            del self.holds[req]
+
+
+class FrameSyncTestMethods(unittest.TestCase):
+    def setUp(self):
+        self.sets = []
+
+    def create_sink(self, num_cameras, tolerance=100, depth=2):
+        state = StubState(num_cameras)
+        sink = frame_sync.FrameSyncSink(state, tolerance, depth)
+        sink.listeners.append(lambda frames, skew: self.sets.append((frames, skew)))
+        return state, sink
+
+    def push(self, state, sink, cam, seq, ts):
+        ctx = state.contexts[cam]
+        req = StubRequest(seq, ts)
+        sink.handle(ctx, req, None, 0)
+        return req
+
+    def test_bad_tolerance(self):
+        with self.assertRaises(ValueError):
+            frame_sync.FrameSyncSink(StubState(2), 0)
+
+    def test_match(self):
+        state, sink = self.create_sink(2)
+        c1, c2 = state.contexts
+
+        r2 = self.push(state, sink, 1, 0, 1050)
+        self.assertEqual(self.sets, [])
+        self.assertEqual(state.holds, {r2: 1})
+
+        r1 = self.push(state, sink, 0, 0, 1000)
+        self.assertEqual(self.sets, [([(c1, r1), (c2, r2)], 50)])
+        self.assertEqual(state.holds, {})
+
+        self.assertEqual(sink.sets, 1)
+        self.assertEqual(sink.skew_max, 50)
+
+    def test_no_match(self):
+        state, sink = self.create_sink(2)
+
+        r1 = self.push(state, sink, 0, 0, 1000)
+        r2 = self.push(state, sink, 1, 0, 1101)
+
+        self.assertEqual(self.sets, [])
+        self.assertEqual(state.holds, {r1: 1, r2: 1})
+
+    def test_nearest(self):
+        state, sink = self.create_sink(2, tolerance=100, depth=3)
+        c1, c2 = state.contexts
+
+        # The bucket boundaries are at multiples of the tolerance
+        r1 = [self.push(state, sink, 0, i, ts) for i, ts in enumerate((930, 990, 1060))]
+        r2 = self.push(state, sink, 1, 0, 1010)
+
+        self.assertEqual(self.sets, [([(c1, r1[1]), (c2, r2)], 20)])
+
+        # The older frame of the first camera can no longer be matched, the
+        # newer one is still held
+        self.assertEqual(state.holds, {r1[2]: 1})
+        self.assertEqual(sink.unmatched[c1], 1)
+
+    def test_overflow(self):
+        state, sink = self.create_sink(2, depth=2)
+        c1, c2 = state.contexts
+
+        reqs = [self.push(state, sink, 0, i, i * 1000) for i in range(5)]
+
+        # The frames pushed out of the full ring are released
+        self.assertEqual(state.holds, {reqs[3]: 1, reqs[4]: 1})
+        self.assertEqual(sink.unmatched, {c1: 3, c2: 0})
+        self.assertEqual(self.sets, [])
+
+    def test_three_cameras(self):
+        state, sink = self.create_sink(3)
+        c1, c2, c3 = state.contexts
+
+        # Both within the tolerance of the third frame, but not of each other
+        self.push(state, sink, 0, 0, 910)
+        r2 = self.push(state, sink, 1, 0, 1090)
+        r3 = self.push(state, sink, 2, 0, 1000)
+
+        self.assertEqual(self.sets, [])
+
+        # The next frame of the first camera matches both
+        r1b = self.push(state, sink, 0, 1, 1060)
+
+        self.assertEqual(self.sets, [([(c1, r1b), (c2, r2), (c3, r3)], 90)])
+        self.assertEqual(state.holds, {})
+        self.assertEqual(sink.unmatched, {c1: 1, c2: 0, c3: 0})
+
+    def test_close(self):
+        state, sink = self.create_sink(3, depth=3)
+
+        for i in range(3):
+            self.push(state, sink, i, 0, i * 1000)
+            self.push(state, sink, i, 1, i * 1000 + 10000)
+
+        self.assertEqual(len(state.holds), 6)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            sink.close()
+
+        self.assertEqual(state.holds, {})
+
+    def test_capture(self):
+        state = create_state(num_cameras=2, capture=30)
+
+        # A frame interval of 5 ms, the fake cameras running with an
+        # arbitrary phase
+        sink = frame_sync.FrameSyncSink(state, 5000000)
+        sets = []
+
+        def listener(frames, skew):
+            # The requests are reused after the listeners return
+            timestamps = [next(iter(req.buffers.values())).metadata.timestamp
+                          for _, req in frames]
+            sets.append(([ctx for ctx, _ in frames], timestamps, skew))
+
+        sink.listeners.append(listener)
+
+        held = []
+
+        class CheckSink(sinks.Sink):
+            """Checks that the requests are released when the sync sink is closed"""
+
+            def handle(self, ctx, req, completion, dispatch_ts):
+                pass
+
+            def close(self):
+                held.extend(ctx.pool.held for ctx in state.contexts)
+
+        state.sinks = [sink, CheckSink(state)]
+
+        run_capture(state)
+
+        self.assertEqual([ctx.reqs_completed for ctx in state.contexts], [30, 30])
+        self.assertEqual(held, [0, 0])
+        self.assertGreater(len(sets), 0)
+
+        for contexts, timestamps, skew in sets:
+            self.assertEqual(contexts, state.contexts)
+            self.assertLessEqual(skew, 5000000)
+            self.assertEqual(max(timestamps) - min(timestamps), skew)
+
+
+class DisplayQueueTestMethods(unittest.TestCase):
+    def push_requests(self, policy, depth, count):
+        state = StubState(1)
+        ctx = state.contexts[0]
+        queue = display_queue.DisplayQueue(state, policy, depth)
+
+        reqs = [StubRequest(i, i * 1000) for i in range(count)]
+
+        for req in reqs:
+            state.hold_request(req)
+            queue.push(ctx, req)
+
+        return state, queue, reqs
+
+    def pop_all(self, queue):
+        reqs = []
+        while (item := queue.pop()) is not None:
+            reqs.append(item[1])
+        return reqs
+
+    def test_bad_args(self):
+        with self.assertRaises(ValueError):
+            display_queue.DisplayQueue(StubState(1), 'newest')
+        with self.assertRaises(ValueError):
+            display_queue.DisplayQueue(StubState(1), 'fifo', 0)
+
+    def test_drop_oldest(self):
+        state, queue, reqs = self.push_requests('drop-oldest', 2, 5)
+
+        self.assertEqual(state.processed, reqs[:3])
+        self.assertEqual(queue.dropped, 3)
+        self.assertEqual(self.pop_all(queue), reqs[3:])
+
+    def test_latest(self):
+        # The depth is ignored, only the latest request is kept
+        state, queue, reqs = self.push_requests('latest', 3, 5)
+
+        self.assertEqual(state.processed, reqs[:4])
+        self.assertEqual(queue.dropped, 4)
+        self.assertEqual(self.pop_all(queue), reqs[4:])
+
+    def test_fifo(self):
+        state, queue, reqs = self.push_requests('fifo', 2, 5)
+
+        self.assertEqual(state.processed, reqs[2:])
+        self.assertEqual(queue.dropped, 3)
+        self.assertEqual(self.pop_all(queue), reqs[:2])
+
+    def test_no_drops(self):
+        for policy in display_queue.DisplayQueue.POLICIES:
+            state, queue, reqs = self.push_requests(policy, 2, 1)
+
+            self.assertEqual(state.processed, [])
+            self.assertEqual(queue.dropped, 0)
+            self.assertEqual(len(queue), 1)
+
+            # Displaying keeps up with the camera
+            state.request_processed(state.contexts[0], queue.pop()[1])
+            self.assertIsNone(queue.pop())
+
+    def test_clear(self):
+        for policy in display_queue.DisplayQueue.POLICIES:
+            state, queue, reqs = self.push_requests(policy, 2, 3)
+
+            queue.clear()
+
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(state.holds, {})
+            self.assertEqual(sorted(state.processed, key=reqs.index), reqs)
+
+            # The cleared requests are not counted as dropped
+            self.assertEqual(queue.dropped, 1 if policy != 'latest' else 2)
+
+
+class StatsTestMethods(unittest.TestCase):
+    def assertPercentiles(self, values, sub_bits=4):
+        hist = stats.LogHistogram(sub_bits)
+        for v in values:
+            hist.add(v)
+
+        ordered = sorted(values)
+
+        for p in (1, 10, 25, 50, 75, 90, 99, 100):
+            exact = ordered[max(1, int(len(values) * p / 100 + 0.5)) - 1]
+            res = hist.percentile(p)
+
+            # The bucket's upper bound, capped by the maximum value
+            self.assertGreaterEqual(res, exact, f'p{p}')
+            self.assertLessEqual(res, exact + (exact >> sub_bits), f'p{p}')
+
+        self.assertEqual(hist.count, len(values))
+        self.assertEqual(hist.min, ordered[0])
+        self.assertEqual(hist.max, ordered[-1])
+        self.assertEqual(hist.sum, sum(values))
+
+        return hist
+
+    def test_small_values(self):
+        # The values below 2 ** sub_bits are exact
+        hist = self.assertPercentiles(list(range(16)) * 3)
+
+        self.assertEqual(hist.percentile(50), 7)
+        self.assertEqual(hist.buckets(), [(i, 3) for i in range(16)])
+
+    def test_uniform(self):
+        # Frame intervals of 33.3 ms with up to +/- 10% of jitter
+        rnd = random.Random(1)
+        values = [33333333 + rnd.randint(-3333333, 3333333) for _ in range(5000)]
+
+        hist = self.assertPercentiles(values)
+
+        self.assertAlmostEqual(hist.percentile(50), 33333333, delta=33333333 / 16)
+
+    def test_bimodal(self):
+        # 90% of the frames on time, 10% late by a frame
+        values = [16666666] * 900 + [33333333] * 100
+
+        hist = self.assertPercentiles(values)
+
+        self.assertLess(hist.percentile(90), 20000000)
+        self.assertGreater(hist.percentile(91), 30000000)
+        self.assertEqual(hist.percentile(100), 33333333)
+
+    def test_long_tail(self):
+        rnd = random.Random(2)
+        values = [int(rnd.expovariate(1 / 1000000)) for _ in range(5000)]
+
+        for sub_bits in (2, 4, 6):
+            self.assertPercentiles(values, sub_bits)
+
+    def test_clamp(self):
+        hist = stats.LogHistogram(max_bits=10)
+
+        hist.add(-5)
+        hist.add(5000)
+
+        self.assertEqual((hist.min, hist.max), (0, 1023))
+        self.assertEqual(hist.percentile(100), 1023)
+
+    def test_empty(self):
+        hist = stats.LogHistogram()
+
+        self.assertEqual(hist.percentile(50), 0)
+        self.assertEqual(hist.mean, 0.0)
+
+    def test_drops(self):
+        st = stats.StreamStats()
+
+        interval = 10000000
+        seqs = [0, 1, 2, 5, 6, 10, 11]
+
+        for seq in seqs:
+            ts = seq * interval
+            st.add(seq, ts, ts + 1000, ts + 2000)
+
+        self.assertEqual(st.frames, len(seqs))
+        self.assertEqual(st.dropped, 2 + 3)
+
+        # The intervals span the dropped frames
+        self.assertEqual(st.intervals.count, len(seqs) - 1)
+        self.assertEqual(st.intervals.max, 4 * interval)
+        self.assertEqual(st.intervals.sum, 11 * interval)
+
+        self.assertEqual((st.completion_latency.min, st.completion_latency.max), (1000, 1000))
+        self.assertEqual((st.dispatch_latency.min, st.dispatch_latency.max), (2000, 2000))
+
+    def test_drops_between_periods(self):
+        prev = stats.StreamStats()
+        for seq in range(4):
+            prev.add(seq, seq * 1000, seq * 1000, seq * 1000)
+
+        st = stats.StreamStats(prev)
+        st.add(6, 6000, 6000, 6000)
+
+        self.assertEqual(prev.dropped, 0)
+        self.assertEqual(st.dropped, 2)
+        self.assertEqual(st.intervals.count, 1)
+        self.assertEqual(st.intervals.max, 3000)
+
+    def test_capture_stats(self):
+        cs = stats.CaptureStats(period=1.0)
+
+        for seq in (0, 1, 3):
+            ts = seq * 100000000
+            cs.add('cam1', 'stream0', seq, ts, ts, ts)
+
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            cs.maybe_print_summary(time.monotonic_ns() + 2000000000)
+
+        self.assertIn('cam1-stream0: 3 frames', out.getvalue())
+        self.assertIn('1 dropped', out.getvalue())
+
+        cs.add('cam1', 'stream0', 5, 500000000, 500000000, 500000000)
+
+        totals = cs.to_dict()['cam1']['stream0']
+        self.assertEqual(totals['frames'], 4)
+        self.assertEqual(totals['dropped'], 2)
+        # The mean interval includes the dropped frames
+        self.assertAlmostEqual(totals['fps'], 6.0)
+
+
+def create_buffer(data):
+    """A single plane memfd FrameBuffer holding data"""
+    fd = os.memfd_create('camtests', os.MFD_CLOEXEC)
+    try:
+        os.write(fd, data)
+        return fake.FrameBuffer([fake.FrameBuffer.Plane(fd, 0, len(data))])
+    finally:
+        os.close(fd)
+
+
+class FrameWriterTestMethods(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state = StubState(1)
+        self.state.mfb_pool = libcamera.utils.MappedFrameBufferPool()
+        self.readers = []
+        self.buffers = []
+
+    def tearDown(self):
+        self.state.mfb_pool.clear()
+        self.tmpdir.cleanup()
+
+    def create_writer(self, *args):
+        writer = frame_writer.FrameWriter(self.state, *args)
+        self.addCleanup(self.close_writer, writer)
+        return writer
+
+    def close_writer(self, writer):
+        self.unblock()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            writer.close()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def blocked_path(self, name):
+        """A FIFO, blocking the writer until unblock() is called"""
+        path = self.path(name)
+        os.mkfifo(path)
+        self.readers.append(path)
+        return path
+
+    def unblock(self):
+        """Read the FIFOs, returning their contents"""
+        readers = self.readers
+        self.readers = []
+
+        res = {}
+
+        def read(path):
+            with open(path, 'rb') as f:
+                res[os.path.basename(path)] = f.read()
+
+        threads = [threading.Thread(target=read, args=(path,)) for path in readers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return res
+
+    def submit(self, writer, filename, data):
+        req = StubRequest(0, 0)
+        self.state.hold_request(req)
+
+        # The buffers are kept alive, as the pool caches the mappings by fd
+        fb = create_buffer(data)
+        self.buffers.append(fb)
+
+        writer.submit(self.state.contexts[0], req, [(filename, fb)])
+
+        # The hold of the request handler
+        self.state.request_processed(self.state.contexts[0], req)
+
+        return req
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            frame_writer.FrameWriter(self.state, 1, 1, 'block')
+
+    def test_write(self):
+        for direct in (False, True):
+            writer = frame_writer.FrameWriter(self.state, 2, 8, 'copy', direct)
+
+            frames = {f'frame-{i}.data': bytes([i]) * (5000 + i) for i in range(4)}
+
+            for filename, data in frames.items():
+                self.submit(writer, self.path(filename), data)
+
+            # The frames were copied, the requests not held
+            self.assertEqual(self.state.holds, {})
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                writer.close()
+
+            self.assertEqual(writer.frames, 4)
+            self.assertEqual(writer.bytes, sum(len(d) for d in frames.values()))
+            self.assertEqual(writer.errors, 0)
+
+            for filename, data in frames.items():
+                with open(self.path(filename), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_copy_backpressure(self):
+        writer = self.create_writer(1, 1, 'copy')
+
+        self.submit(writer, self.blocked_path('a'), b'a' * 100)
+        self.assertEqual(self.state.holds, {})
+
+        # The queue is full, the request is held until written
+        req = self.submit(writer, self.blocked_path('b'), b'b' * 100)
+        self.assertEqual(self.state.holds, {req: 1})
+        self.assertEqual(writer.delayed, 1)
+        self.assertEqual(writer.drops, 0)
+
+        self.assertEqual(self.unblock(), {'a': b'a' * 100, 'b': b'b' * 100})
+
+        self.close_writer(writer)
+
+        self.assertEqual(self.state.holds, {})
+        self.assertEqual(writer.frames, 2)
+
+    def test_drop(self):
+        writer = self.create_writer(1, 1, 'drop')
+
+        self.submit(writer, self.blocked_path('a'), b'a' * 100)
+
+        # The queue is full, the frames are dropped
+        self.submit(writer, self.path('b'), b'b' * 100)
+        self.submit(writer, self.path('c'), b'c' * 100)
+
+        self.assertEqual(self.state.holds, {})
+        self.assertEqual(writer.drops, 2)
+        self.assertEqual(writer.delayed, 0)
+
+        self.assertEqual(self.unblock(), {'a': b'a' * 100})
+
+        self.close_writer(writer)
+
+        self.assertEqual(writer.frames, 1)
+        self.assertFalse(os.path.exists(self.path('b')))
+
+    def test_hold(self):
+        writer = self.create_writer(1, 8, 'hold')
+
+        # The requests are held even if the queue is not full
+        reqs = [self.submit(writer, self.blocked_path(name), name.encode() * 100)
+                for name in 'ab']
+
+        self.assertEqual(self.state.holds, {req: 1 for req in reqs})
+        self.assertEqual(writer.delayed, 0)
+
+        self.assertEqual(self.unblock(), {'a': b'a' * 100, 'b': b'b' * 100})
+
+        self.close_writer(writer)
+
+        self.assertEqual(self.state.holds, {})
+        self.assertEqual(writer.frames, 2)
+
+
+def yuv_planes(fmt, y, u, v, pad=6):
+    """
+    The planes of a frame, as returned by MappedFrameBuffer.as_ndarray(),
+    from the Y plane and the U and V planes at the chroma resolution. The
+    planes are views of padded arrays, like the planes of strided buffers.
+    """
+    h, w = y.shape
+
+    def padded(arr):
+        buf = np.zeros((arr.shape[0], arr.shape[1] + pad) + arr.shape[2:], dtype=np.uint8)
+        buf[:, :arr.shape[1]] = arr
+        return buf[:, :arr.shape[1]]
+
+    if fmt in ('YUYV', 'YVYU', 'UYVY', 'VYUY'):
+        data = np.empty((h, w, 2), dtype=np.uint8)
+        ych = 0 if fmt[0] == 'Y' else 1
+        data[:, :, ych] = y
+        chroma = {'U': u, 'V': v}
+        for par, c in enumerate(fmt[1 - ych::2]):
+            data[:, par::2, 1 - ych] = chroma[c]
+        return [padded(data)]
+
+    if fmt in ('NV12', 'NV21'):
+        uv = np.stack((u, v) if fmt == 'NV12' else (v, u), axis=2)
+        # The CbCr plane has the stride of the Y plane
+        return [padded(y), padded(uv)]
+
+    return [padded(y)] + [padded(p) for p in ((u, v) if fmt == 'YUV420' else (v, u))]
+
+
+def yuv_reference(y, u, v, vsub, encoding, full_range):
+    """Convert to RGB in floating point, with the chroma of each luma sample"""
+    kr, kb = {'Rec601': (0.299, 0.114), 'Rec709': (0.2126, 0.0722),
+              'Rec2020': (0.2627, 0.0593)}[encoding]
+    kg = 1 - kr - kb
+
+    u = np.repeat(np.repeat(u, 2, axis=1), vsub, axis=0).astype(np.float64)
+    v = np.repeat(np.repeat(v, 2, axis=1), vsub, axis=0).astype(np.float64)
+    y = y.astype(np.float64)
+
+    if full_range:
+        yf, cb, cr = y, u - 128, v - 128
+    else:
+        yf, cb, cr = (y - 16) * 255 / 219, (u - 128) * 255 / 224, (v - 128) * 255 / 224
+
+    r = yf + 2 * (1 - kr) * cr
+    g = yf - 2 * kb * (1 - kb) / kg * cb - 2 * kr * (1 - kr) / kg * cr
+    b = yf + 2 * (1 - kb) * cb
+
+    return np.clip(np.round(np.stack((r, g, b), axis=2)), 0, 255)
+
+
+class YUVConverterTestMethods(unittest.TestCase):
+    FORMATS_420 = ['NV12', 'NV21', 'YUV420', 'YVU420']
+
+    def setUp(self):
+        self.rng = np.random.default_rng(1)
+
+    def frame(self, fmt, w, h):
+        vsub = 2 if fmt in self.FORMATS_420 else 1
+        y = self.rng.integers(0, 256, (h, w), dtype=np.uint8)
+        u = self.rng.integers(0, 256, (h // vsub, w // 2), dtype=np.uint8)
+        v = self.rng.integers(0, 256, (h // vsub, w // 2), dtype=np.uint8)
+        return y, u, v, vsub
+
+    def color_space(self, encoding, full_range):
+        cs = libcamera.ColorSpace.Rec709()
+        cs.ycbcrEncoding = getattr(libcamera.ColorSpace.YcbcrEncoding, encoding)
+        cs.range = libcamera.ColorSpace.Range.Full if full_range else libcamera.ColorSpace.Range.Limited
+        return cs
+
+    def test_formats(self):
+        # More rows than a tile, and a partial tile at the end
+        w, h = 22, 38
+
+        for fmt in convert_yuv.YUVConverter.FORMATS:
+            for encoding in ('Rec601', 'Rec709', 'Rec2020'):
+                for full_range in (False, True):
+                    conv = convert_yuv.YUVConverter(self.color_space(encoding, full_range),
+                                                    tile_rows=16)
+
+                    y, u, v, vsub = self.frame(fmt, w, h)
+                    ref = yuv_reference(y, u, v, vsub, encoding, full_range)
+
+                    rgb = conv.convert(fmt, yuv_planes(fmt, y, u, v))
+
+                    msg = f'{fmt} {encoding} {"full" if full_range else "limited"}'
+                    self.assertEqual(rgb.shape, (h, w, 3), msg)
+                    self.assertEqual(rgb.dtype, np.uint8, msg)
+                    self.assertLessEqual(np.abs(rgb - ref).max(), 1, msg)
+
+    def test_default(self):
+        # Without a color space, Rec601 full range
+        conv = convert_yuv.YUVConverter()
+
+        y, u, v, vsub = self.frame('NV12', 16, 8)
+        rgb = conv.convert('NV12', yuv_planes('NV12', y, u, v))
+
+        self.assertLessEqual(np.abs(rgb - yuv_reference(y, u, v, vsub, 'Rec601', True)).max(), 1)
+
+    def test_step(self):
+        w, h = 24, 16
+        conv = convert_yuv.YUVConverter(self.color_space('Rec709', False), tile_rows=4)
+
+        for fmt in convert_yuv.YUVConverter.FORMATS:
+            y, u, v, vsub = self.frame(fmt, w, h)
+            ref = yuv_reference(y, u, v, vsub, 'Rec709', False)
+
+            for step in (2, 4):
+                rgb = conv.convert(fmt, yuv_planes(fmt, y, u, v), step=step)
+
+                # Every step'th pixel of the full resolution conversion
+                self.assertEqual(rgb.shape, (h // step, w // step, 3), f'{fmt} step {step}')
+                self.assertLessEqual(np.abs(rgb - ref[::step, ::step]).max(), 1,
+                                     f'{fmt} step {step}')
+
+        with self.assertRaises(ValueError):
+            conv.convert('NV12', yuv_planes('NV12', *self.frame('NV12', w, h)[:3]), step=3)
+
+    def test_out(self):
+        w, h = 16, 8
+        conv = convert_yuv.YUVConverter()
+        y, u, v, vsub = self.frame('YUYV', w, h)
+        planes = yuv_planes('YUYV', y, u, v)
+
+        out = np.zeros((h, w, 3), dtype=np.uint8)
+        self.assertIs(conv.convert('YUYV', planes, out), out)
+        self.assertLessEqual(np.abs(out - yuv_reference(y, u, v, vsub, 'Rec601', True)).max(), 1)
+
+        # A view of a wider array, and arrays of the wrong shape or type
+        bad = [np.zeros((h, w + 2, 3), dtype=np.uint8)[:, :w],
+               np.zeros((h, w, 4), dtype=np.uint8),
+               np.zeros((h, w, 3), dtype=np.int32)]
+
+        for arr in bad:
+            with self.assertRaises(ValueError):
+                conv.convert('YUYV', planes, arr)
+
+    def test_odd_size(self):
+        conv = convert_yuv.YUVConverter()
+
+        for fmt in self.FORMATS_420:
+            y, u, v, vsub = self.frame(fmt, 16, 10)
+
+            with self.assertRaisesRegex(ValueError, 'even height'):
+                conv.convert(fmt, yuv_planes(fmt, y[:9], u, v))
+
+        # 4:2:2 has no vertical subsampling
+        y, u, v, vsub = self.frame('UYVY', 16, 9)
+        self.assertEqual(conv.convert('UYVY', yuv_planes('UYVY', y, u, v)).shape, (9, 16, 3))
+
+        y, u, v, vsub = self.frame('NV12', 16, 8)
+        with self.assertRaisesRegex(ValueError, 'even width'):
+            conv.convert('NV12', [yuv_planes('NV12', y, u, v)[0][:, :15],
+                                  yuv_planes('NV12', y, u, v)[1]])
+
+
+def mosaic(rgb, order):
+    """Sample an RGB image with a Bayer pattern"""
+    raw = np.empty(rgb.shape[:2], dtype=rgb.dtype)
+
+    for i, c in enumerate(order):
+        y, x = i // 2, i % 2
+        raw[y::2, x::2] = rgb[y::2, x::2, 'RGB'.index(c)]
+
+    return raw
+
+
+class DemosaicerTestMethods(unittest.TestCase):
+    ORDERS = demosaic.Demosaicer.ORDERS
+
+    def process(self, raw, order, mode, bits=8, num_threads=0):
+        h, w = raw.shape
+        dm = demosaic.Demosaicer(w, h, order, bits, mode, num_threads)
+        try:
+            return dm.process(raw)
+        finally:
+            dm.close()
+
+    def test_bad_args(self):
+        with self.assertRaises(ValueError):
+            demosaic.Demosaicer(16, 16, 'RGGB', mode='nearest')
+        with self.assertRaises(ValueError):
+            demosaic.Demosaicer(16, 16, 'RGBG')
+        with self.assertRaises(ValueError):
+            demosaic.Demosaicer(15, 16, 'RGGB')
+
+    def test_flat_field(self):
+        w, h = 16, 12
+        rgb = np.empty((h, w, 3), dtype=np.uint16)
+        rgb[...] = (200, 100, 50)
+
+        for order in self.ORDERS:
+            raw = mosaic(rgb, order)
+
+            for mode in ('bilinear', 'malvar'):
+                res = self.process(raw, order, mode)
+                self.assertEqual(res.shape, (h, w, 3))
+                self.assertTrue((res == (200, 100, 50)).all(), f'{order} {mode}')
+
+            res = self.process(raw, order, 'binned')
+            self.assertEqual(res.shape, (h // 2, w // 2, 3))
+            self.assertTrue((res == (200, 100, 50)).all(), f'{order} binned')
+
+            # 10-bit samples are scaled to 8 bits
+            res = self.process(raw * 4, order, 'malvar', bits=10)
+            self.assertTrue((res == (200, 100, 50)).all(), f'{order} 10-bit')
+
+    def test_binned(self):
+        rgb = np.zeros((4, 4, 3), dtype=np.uint16)
+        rgb[0:2, 0:2] = (10, 20, 30)
+        rgb[0:2, 2:4] = (40, 50, 60)
+        rgb[2:4, 0:2] = (70, 80, 90)
+        rgb[2:4, 2:4] = (100, 110, 120)
+
+        for order in self.ORDERS:
+            raw = mosaic(rgb, order)
+
+            # One of the greens differs, the average is rounded down
+            g = [(y, x) for y in (0, 1) for x in (0, 1) if order[y * 2 + x] == 'G'][0]
+            raw[g[0]::2, g[1]::2] += 1
+
+            res = self.process(raw, order, 'binned')
+            self.assertEqual(res.tolist(), rgb[::2, ::2].tolist(), order)
+
+    def test_ramp(self):
+        # The interpolation is exact for linear gradients, away from the
+        # mirrored edges
+        w, h = 20, 16
+
+        yy, xx = np.mgrid[0:h, 0:w]
+
+        for ramp in (10 + 8 * xx, 20 + 9 * yy, 5 + 4 * xx + 5 * yy):
+            rgb = np.repeat(ramp[:, :, None], 3, axis=2).astype(np.uint16)
+
+            for order in self.ORDERS:
+                raw = mosaic(rgb, order)
+
+                for mode in ('bilinear', 'malvar'):
+                    res = self.process(raw, order, mode)
+                    self.assertEqual(res[2:-2, 2:-2].tolist(), rgb[2:-2, 2:-2].tolist(),
+                                     f'{order} {mode}')
+
+    def test_edge(self):
+        # A vertical edge between the columns 7 and 8
+        w, h = 16, 8
+        rgb = np.full((h, w, 3), 40, dtype=np.uint16)
+        rgb[:, 8:] = 200
+
+        for order in self.ORDERS:
+            raw = mosaic(rgb, order)
+
+            res = self.process(raw, order, 'bilinear').astype(np.int32)
+
+            # Only the pixels next to the edge are interpolated across it
+            self.assertTrue((res[:, :7] == 40).all(), order)
+            self.assertTrue((res[:, 9:] == 200).all(), order)
+            self.assertTrue(((res[:, 7:9] >= 40) & (res[:, 7:9] <= 200)).all(), order)
+
+            res = self.process(raw, order, 'malvar').astype(np.int32)
+
+            # The 5x5 filter reaches two pixels further
+            self.assertTrue((res[:, :6] == 40).all(), order)
+            self.assertTrue((res[:, 10:] == 200).all(), order)
+
+            # The edge is kept in the native samples
+            for i, c in enumerate(order):
+                y, x = i // 2, i % 2
+                ch = 'RGB'.index(c)
+                self.assertEqual(res[y::2, x::2, ch].tolist(), rgb[y::2, x::2, ch].tolist())
+
+    def test_threads(self):
+        rng = np.random.default_rng(3)
+        w, h = 24, 38
+        raw = rng.integers(0, 1024, (h, w), dtype=np.uint16)
+
+        for order in self.ORDERS:
+            for mode in ('bilinear', 'malvar'):
+                ref = self.process(raw, order, mode, bits=10)
+
+                # Bands of different sizes, some processed by the same thread
+                for num_threads in (2, 3, 4, 7):
+                    res = self.process(raw, order, mode, bits=10, num_threads=num_threads)
+                    self.assertTrue((res == ref).all(), f'{order} {mode} {num_threads}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,9 +4,17 @@
 # Copyright (C) 2022, Tomi Valkeinen <tomi.valkeinen@ideasonboard.com>
 
 from collections import defaultdict
+import asyncio
+import binascii
+import concurrent.futures
 import gc
 import libcamera as libcam
+import libcamera.fake
+import libcamera.utils
+import os
 import selectors
+import threading
+import time
 import typing
 import unittest
 import weakref
@@ -230,6 +238,52 @@ class SimpleCaptureMethods(CameraTesterBase):
 
         cam.stop()
 
+    def test_wait(self):
+        cm = self.cm
+        cam = self.cam
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.StillCapture])
+        cam.configure(camconfig)
+
+        stream = camconfig.at(0).stream
+
+        allocator = libcam.FrameBufferAllocator(cam)
+        num_bufs = allocator.allocate(stream)
+        self.assertTrue(num_bufs > 1)
+
+        # Nothing is queued, so the wait times out
+        t = time.monotonic()
+        self.assertEqual(cm.wait_for_requests(0.05), [])
+        self.assertGreaterEqual(time.monotonic() - t, 0.05)
+
+        reqs = []
+        for i in range(num_bufs):
+            req = cam.create_request(i)
+            req.add_buffer(stream, allocator.buffers(stream)[i])
+            reqs.append(req)
+
+        cam.start()
+
+        for req in reqs:
+            cam.queue_request(req)
+
+        reqs = []
+
+        while len(reqs) < num_bufs:
+            ready_reqs = cm.wait_for_requests(1, max_count=1)
+            self.assertEqual(len(ready_reqs), 1)
+            reqs += ready_reqs
+
+        self.assertEqual([req.cookie for req in reqs], list(range(num_bufs)))
+
+        # All the requests have been taken, so the eventfd has been cleared
+        self.assertEqual(cm.get_ready_requests(), [])
+
+        reqs = None
+        gc.collect()
+
+        cam.stop()
+
     def test_select(self):
         cm = self.cm
         cam = self.cam
@@ -298,6 +352,950 @@ class SimpleCaptureMethods(CameraTesterBase):
 
         cam.stop()
 
+    def test_batch(self):
+        cm = self.cm
+        cam = self.cam
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.StillCapture])
+        streamconfig = camconfig.at(0)
+        cam.configure(camconfig)
+        stream = streamconfig.stream
+
+        allocator = libcam.FrameBufferAllocator(cam)
+        num_bufs = allocator.allocate(stream)
+        self.assertTrue(num_bufs > 0)
+
+        reqs = []
+        for i in range(num_bufs):
+            # Use two cookies to check the grouping
+            req = cam.create_request(i % 2)
+            req.add_buffer(stream, allocator.buffers(stream)[i])
+            reqs.append(req)
+
+        cam.start()
+
+        for req in reqs:
+            cam.queue_request(req)
+
+        reqs = None
+        gc.collect()
+
+        sel = selectors.DefaultSelector()
+        sel.register(cm.event_fd, selectors.EVENT_READ)
+
+        completions = defaultdict(list)
+        num_done = 0
+
+        while num_done < num_bufs:
+            sel.select()
+
+            for cookie, batch in cm.get_ready_request_batch().items():
+                for completion in batch:
+                    self.assertEqual(completion.cookie, cookie)
+                    self.assertEqual(completion.request.cookie, cookie)
+                    self.assertTrue(completion.timestamp <= time.monotonic_ns())
+                    self.assertTrue(completion.wall_time > 0)
+
+                completions[cookie] += batch
+                num_done += len(batch)
+
+        for batch in completions.values():
+            timestamps = [c.timestamp for c in batch]
+            self.assertEqual(timestamps, sorted(timestamps))
+
+        completions = None
+        gc.collect()
+
+        cam.stop()
+
+    def test_metadata(self):
+        cm = self.cm
+        cam = self.cam
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.StillCapture])
+        streamconfig = camconfig.at(0)
+        cam.configure(camconfig)
+        stream = streamconfig.stream
+
+        allocator = libcam.FrameBufferAllocator(cam)
+        num_bufs = allocator.allocate(stream)
+        self.assertTrue(num_bufs > 0)
+
+        req = cam.create_request()
+        req.add_buffer(stream, allocator.buffers(stream)[0])
+
+        cam.start()
+
+        sel = selectors.DefaultSelector()
+        sel.register(cm.event_fd, selectors.EVENT_READ)
+
+        timestamps = []
+
+        for _ in range(2):
+            cam.queue_request(req)
+
+            reqs = []
+            while not reqs:
+                sel.select()
+                reqs = cm.get_ready_requests()
+
+            self.assertIs(reqs[0], req)
+
+            md = req.metadata
+
+            # The view is cached in the request
+            self.assertIs(req.metadata, md)
+
+            ts_id = libcam.controls.SensorTimestamp
+            self.assertIn(ts_id, md)
+            self.assertEqual(md[ts_id], req.buffers[stream].metadata.timestamp)
+            self.assertEqual(md.get_many([ts_id]), [md[ts_id]])
+            self.assertEqual(dict(md.items())[ts_id], md[ts_id])
+            self.assertIsNone(md.get(libcam.controls.draft.PipelineDepth))
+
+            timestamps.append(md[ts_id])
+
+            # reuse() invalidates the cached values
+            req.reuse()
+
+        self.assertNotEqual(timestamps[0], timestamps[1])
+
+        md = None
+        reqs = None
+        req = None
+        gc.collect()
+
+        cam.stop()
+
+    def test_metadata_array(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('No numpy found')
+
+        cm = self.cm
+        cam = self.cam
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.StillCapture])
+        streamconfig = camconfig.at(0)
+        cam.configure(camconfig)
+        stream = streamconfig.stream
+
+        allocator = libcam.FrameBufferAllocator(cam)
+        num_bufs = allocator.allocate(stream)
+        self.assertTrue(num_bufs > 0)
+
+        req = cam.create_request()
+        req.add_buffer(stream, allocator.buffers(stream)[0])
+
+        cam.start()
+        cam.queue_request(req)
+
+        sel = selectors.DefaultSelector()
+        sel.register(cm.event_fd, selectors.EVENT_READ)
+
+        reqs = []
+        while not reqs:
+            sel.select()
+            reqs = cm.get_ready_requests()
+
+        md = req.metadata
+        ts_id = libcam.controls.SensorTimestamp
+
+        arr = md.get_array(ts_id)
+        self.assertEqual(arr.dtype, np.int64)
+        self.assertEqual(arr.tolist(), [md[ts_id]])
+
+        view = md.get_array(ts_id, copy=False)
+        self.assertFalse(view.flags.writeable)
+        self.assertTrue(np.array_equal(view, arr))
+
+        with self.assertRaises(KeyError):
+            md.get_array(libcam.controls.draft.PipelineDepth)
+
+        # The request can't be reused while a view of the metadata is alive
+        with self.assertRaises(BufferError):
+            req.reuse()
+        self.assertTrue(np.array_equal(view, arr))
+
+        # Copies don't prevent reusing
+        view = None
+        gc.collect()
+        req.reuse()
+
+        arr = None
+        md = None
+        reqs = None
+        req = None
+        gc.collect()
+
+        cam.stop()
+
+    def test_control_array(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('No numpy found')
+
+        cam = self.cam
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.StillCapture])
+        cam.configure(camconfig)
+
+        req = cam.create_request()
+
+        # The controls the camera doesn't support are dropped
+        brightness = libcam.controls.Brightness
+        contrast = libcam.controls.Contrast
+        if brightness not in cam.controls or contrast not in cam.controls:
+            self.skipTest('Brightness or Contrast not supported')
+
+        # NumPy scalars and 0-d arrays are scalars
+        req.set_control(brightness, np.float32(0.5))
+        self.assertEqual(req.controls[brightness], 0.5)
+
+        req.set_control(contrast, np.array(1.5, dtype=np.float64))
+        self.assertEqual(req.controls[contrast], 1.5)
+
+        gains = libcam.controls.ColourGains
+        if gains not in cam.controls:
+            self.skipTest('ColourGains not supported')
+
+        # Arrays of the control's dtype, of another dtype, strided and
+        # multi-dimensional arrays and lists give the same value
+        values = [
+            np.array([1.5, 2.25], dtype=np.float32),
+            np.array([1.5, 2.25], dtype=np.float64),
+            np.array([1.5, 0.0, 2.25, 0.0], dtype=np.float32)[::2],
+            np.array([[1.5, 2.25]], dtype=np.float32),
+            [1.5, 2.25],
+        ]
+
+        for v in values:
+            req.set_control(gains, v)
+            self.assertEqual(req.controls[gains], (1.5, 2.25))
+
+        # Integer arrays are converted to the control's type
+        req.set_control(gains, np.array([1, 2]))
+        self.assertEqual(req.controls[gains], (1.0, 2.0))
+
+        req = None
+        gc.collect()
+
+
+class AsyncCaptureMethods(CameraTesterBase):
+    def test_async(self):
+        cm = self.cm
+        cam = self.cam
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.StillCapture])
+        streamconfig = camconfig.at(0)
+        cam.configure(camconfig)
+        stream = streamconfig.stream
+
+        allocator = libcam.FrameBufferAllocator(cam)
+        num_bufs = allocator.allocate(stream)
+        self.assertTrue(num_bufs > 0)
+
+        reqs = []
+        for i in range(num_bufs):
+            req = cam.create_request(i)
+            req.add_buffer(stream, allocator.buffers(stream)[i])
+            reqs.append(req)
+
+        async def capture():
+            with libcamera.utils.AsyncCameraManager(cm) as acm:
+                for req in reqs:
+                    cam.queue_request(req)
+
+                return [await acm.get_request() for _ in range(num_bufs)]
+
+        cam.start()
+
+        done = asyncio.run(capture())
+
+        self.assertEqual(len(done), num_bufs)
+
+        for i, req in enumerate(done):
+            self.assertTrue(i == req.cookie)
+
+        reqs = None
+        done = None
+        gc.collect()
+
+        cam.stop()
+
+
+class FakeCaptureMethods(BaseTestCase):
+    def test_capture(self):
+        fake = libcamera.fake
+
+        cm = fake.CameraManager([fake.FakeCameraOptions(fps=1000, width=64, height=32,
+                                                        pixel_format='NV12')])
+        cam = cm.cameras[0]
+        cam.acquire()
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.Viewfinder])
+        self.assertEqual(camconfig.validate(), libcam.CameraConfiguration.Status.Valid)
+        cam.configure(camconfig)
+        stream = camconfig.at(0).stream
+
+        allocator = fake.FrameBufferAllocator(cam)
+        num_bufs = allocator.allocate(stream)
+        self.assertTrue(num_bufs > 0)
+
+        reqs = []
+        for i in range(num_bufs):
+            req = cam.create_request(i)
+            req.add_buffer(stream, allocator.buffers(stream)[i])
+            reqs.append(req)
+
+        cam.start()
+
+        for req in reqs:
+            cam.queue_request(req)
+
+        sel = selectors.DefaultSelector()
+        sel.register(cm.event_fd, selectors.EVENT_READ)
+
+        seqs = []
+        while len(seqs) < 50:
+            sel.select()
+            for cookie, completions in cm.get_ready_request_batch().items():
+                for completion in completions:
+                    req = completion.request
+                    self.assertEqual(req.cookie, cookie)
+                    self.assertEqual(req.status, libcam.Request.Status.Complete)
+
+                    fb = req.buffers[stream]
+                    self.assertEqual(req.metadata[libcam.controls.SensorTimestamp],
+                                     fb.metadata.timestamp)
+
+                    # The sequence number is stamped in the frame
+                    with libcamera.utils.MappedFrameBuffer(fb) as mfb:
+                        self.assertEqual(len(mfb.planes), 2)
+                        self.assertEqual(int.from_bytes(mfb.planes[0][:4], 'little'),
+                                         fb.metadata.sequence)
+
+                    seqs.append(fb.metadata.sequence)
+
+                    req.reuse()
+                    cam.queue_request(req)
+
+        self.assertEqual(seqs, sorted(seqs))
+
+        # Wait for the requests in flight on another thread
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            reqs = executor.submit(cm.wait_for_requests, 1, num_bufs).result()
+        self.assertTrue(0 < len(reqs) <= num_bufs)
+
+        cam.stop()
+
+        # Requests still queued are cancelled
+        for req in cm.get_ready_requests():
+            self.assertEqual(req.status, libcam.Request.Status.Cancelled)
+
+        cam.release()
+
+    def test_metadata_array(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('No numpy found')
+
+        ts_id = libcam.controls.SensorTimestamp
+        gains = libcam.controls.ColourGains
+
+        md = libcamera.fake.RequestMetadata({ts_id: 1000, gains: (1.5, 2.25)})
+
+        # The arrays have the dtypes of the bindings
+        arr = md.get_array(ts_id)
+        self.assertEqual(arr.dtype, np.int64)
+        self.assertEqual(arr.tolist(), [1000])
+
+        arr = md.get_array(gains)
+        self.assertEqual(arr.dtype, np.float32)
+        self.assertEqual(arr.tolist(), [1.5, 2.25])
+        self.assertTrue(arr.flags.writeable)
+
+        view = md.get_array(gains, copy=False)
+        self.assertFalse(view.flags.writeable)
+        self.assertTrue(np.array_equal(view, arr))
+
+        with self.assertRaises(KeyError):
+            md.get_array(libcam.controls.draft.PipelineDepth)
+
+
+class RequestPoolTestMethods(BaseTestCase):
+    def test_pool(self):
+        fake = libcamera.fake
+
+        cm = fake.CameraManager([fake.FakeCameraOptions(fps=1000, width=64, height=32)])
+        cam = cm.cameras[0]
+        cam.acquire()
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.Viewfinder])
+        cam.configure(camconfig)
+        stream = camconfig.at(0).stream
+
+        pool = libcamera.utils.RequestPool(cam, [stream], 7, fake.FrameBufferAllocator(cam),
+                                           limit=20)
+        num_reqs = len(pool.requests)
+        self.assertTrue(num_reqs > 1)
+
+        cam.start()
+        pool.start()
+        self.assertEqual(pool.in_flight, num_reqs)
+
+        held = []
+
+        while pool.completed < 20:
+            for req in cm.wait_for_requests(1):
+                self.assertEqual(req.cookie, 7)
+                pooled = pool.take(req)
+
+                # Hold the first request with a second holder until the end
+                if not held:
+                    pool.hold(req)
+                    held.append(pooled)
+
+                with pooled as r:
+                    self.assertEqual(r.status, libcam.Request.Status.Complete)
+
+        self.assertEqual(pool.queued, 20)
+        self.assertEqual(pool.in_flight, 0)
+        self.assertEqual(pool.held, 1)
+
+        held[0].release()
+        self.assertEqual(pool.held, 0)
+        self.assertEqual(pool.queued, 20)
+
+        pool.stop()
+        cam.stop()
+        pool.close()
+        cam.release()
+
+
+class MetadataSubscriptionTestMethods(BaseTestCase):
+    def test_subscription(self):
+        fake = libcamera.fake
+
+        cm = fake.CameraManager([fake.FakeCameraOptions(fps=1000, width=64, height=32)])
+        cam = cm.cameras[0]
+        cam.acquire()
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.Viewfinder])
+        cam.configure(camconfig)
+        stream = camconfig.at(0).stream
+
+        pool = libcamera.utils.RequestPool(cam, [stream], 0, fake.FrameBufferAllocator(cam),
+                                           limit=10)
+
+        ids = [libcam.controls.FrameDuration, libcam.controls.ExposureTime]
+        sub = libcamera.utils.MetadataSubscription(ids, changes_only=True)
+        all_sub = libcamera.utils.MetadataSubscription(ids + [libcam.controls.SensorTimestamp])
+
+        records = []
+        all_records = []
+
+        cam.start()
+        pool.start()
+
+        while pool.completed < 10:
+            for req in cm.wait_for_requests(1):
+                with pool.take(req):
+                    record = sub.read(req)
+                    if record is not None:
+                        records.append(record)
+                    all_records.append(all_sub.read(req))
+
+        pool.stop()
+        cam.stop()
+        pool.close()
+        cam.release()
+
+        # The frame duration does not change, and there is no exposure time
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].FrameDuration, 1000)
+        self.assertIsNone(records[0].ExposureTime)
+
+        self.assertEqual(len(all_records), 10)
+
+        arr = all_sub.to_numpy(all_records)
+        self.assertEqual(list(arr['sequence']), [r.sequence for r in all_records])
+        self.assertEqual(list(arr['SensorTimestamp']), [r.SensorTimestamp for r in all_records])
+        self.assertEqual(arr.dtype['FrameDuration'], 'int64')
+
+
+class MappedFrameBufferPoolTestMethods(BaseTestCase):
+    def setUp(self):
+        self.fd = os.memfd_create('pytest')
+        os.ftruncate(self.fd, 8192)
+        os.pwrite(self.fd, b'\x01' * 4096 + b'\x02' * 4096, 0)
+
+    def tearDown(self):
+        os.close(self.fd)
+
+    def test_pool(self):
+        planes = [
+            libcam.FrameBuffer.Plane(self.fd, 0, 4096),
+            libcam.FrameBuffer.Plane(self.fd, 4096, 4096),
+        ]
+        fb = libcam.FrameBuffer(planes)
+
+        pool = libcamera.utils.MappedFrameBufferPool()
+
+        for _ in range(3):
+            with libcamera.utils.MappedFrameBuffer(fb, pool) as mfb:
+                self.assertEqual(len(mfb.planes), 2)
+                self.assertEqual(bytes(mfb.planes[0][:1]), b'\x01')
+                self.assertEqual(bytes(mfb.planes[1][:1]), b'\x02')
+
+        # Each plane has its own dup of the fd, so each is mapped once
+        self.assertEqual(pool.misses, 2)
+        self.assertEqual(pool.hits, 4)
+        self.assertEqual(len(pool), 2)
+
+        pool.unmap(fb)
+        self.assertZero(len(pool))
+
+    def test_pool_eviction(self):
+        fd2 = os.memfd_create('pytest')
+        os.ftruncate(fd2, 4096)
+
+        fb1 = libcam.FrameBuffer([libcam.FrameBuffer.Plane(self.fd, 0, 4096)])
+        fb2 = libcam.FrameBuffer([libcam.FrameBuffer.Plane(fd2, 0, 4096)])
+
+        pool = libcamera.utils.MappedFrameBufferPool(max_maps=1)
+
+        pool.planes(fb1)
+        pool.planes(fb2)
+        pool.planes(fb1)
+
+        self.assertEqual(pool.misses, 3)
+        self.assertEqual(pool.evictions, 2)
+        self.assertEqual(len(pool), 1)
+
+        pool.clear()
+        os.close(fd2)
+
+    def test_pool_eviction_in_use(self):
+        fd2 = os.memfd_create('pytest')
+        os.ftruncate(fd2, 4096)
+        os.pwrite(fd2, b'\x03' * 4096, 0)
+
+        fb1 = libcam.FrameBuffer([libcam.FrameBuffer.Plane(self.fd, 0, 4096)])
+        # A buffer with a dmabuf per plane
+        fb2 = libcam.FrameBuffer([libcam.FrameBuffer.Plane(self.fd, 4096, 4096),
+                                  libcam.FrameBuffer.Plane(fd2, 0, 4096)])
+
+        pool = libcamera.utils.MappedFrameBufferPool(max_maps=1)
+
+        planes1 = pool.planes(fb1)
+
+        # Evicts the mapping of fb1, and the mapping of the first plane of
+        # fb2, but the views stay valid
+        planes2 = pool.planes(fb2)
+
+        self.assertEqual(pool.evictions, 2)
+        self.assertEqual(bytes(planes1[0][:2]), b'\x01\x01')
+        self.assertEqual(bytes(planes2[0][:2]), b'\x02\x02')
+        self.assertEqual(bytes(planes2[1][:2]), b'\x03\x03')
+
+        pool.clear()
+        self.assertEqual(bytes(planes2[1][-2:]), b'\x03\x03')
+
+        del planes1, planes2
+        os.close(fd2)
+
+    def test_singleton(self):
+        pools = []
+
+        threads = [threading.Thread(target=lambda: pools.append(
+            libcamera.utils.MappedFrameBufferPool.singleton())) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(map(id, pools))), 1)
+        self.assertIs(pools[0], libcamera.utils.MappedFrameBufferPool.singleton())
+
+
+class MappedFrameBufferNdarrayTestMethods(BaseTestCase):
+    class StreamConfig(typing.NamedTuple):
+        pixel_format: libcam.PixelFormat
+        size: libcam.Size
+        stride: int
+
+    def setUp(self):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            self.skipTest('No numpy found')
+
+        self.fd = os.memfd_create('pytest')
+        os.ftruncate(self.fd, 65536)
+
+    def tearDown(self):
+        os.close(self.fd)
+
+    def test_nv12(self):
+        w, h, stride = 64, 32, 128
+        cfg = self.StreamConfig(libcam.PixelFormat('NV12'), libcam.Size(w, h), stride)
+
+        planes = [
+            libcam.FrameBuffer.Plane(self.fd, 0, stride * h),
+            libcam.FrameBuffer.Plane(self.fd, stride * h, stride * h // 2),
+        ]
+        fb = libcam.FrameBuffer(planes)
+
+        with libcamera.utils.MappedFrameBuffer(fb) as mfb:
+            y = mfb.as_ndarray(0, cfg)
+            uv = mfb.as_ndarray(1, cfg)
+
+            self.assertEqual(y.shape, (h, w))
+            self.assertEqual(y.strides, (stride, 1))
+            self.assertEqual(uv.shape, (h // 2, w // 2, 2))
+            self.assertEqual(uv.strides, (stride, 2, 1))
+
+            # The arrays are views of the mapped buffer
+            y[1, 2] = 42
+            self.assertEqual(mfb.planes[0][stride + 2], 42)
+
+            del y, uv
+
+    def test_packed(self):
+        w, h, stride = 64, 4, 96
+        cfg = self.StreamConfig(libcam.PixelFormat('SRGGB10_CSI2P'), libcam.Size(w, h), stride)
+        fb = libcam.FrameBuffer([libcam.FrameBuffer.Plane(self.fd, 0, stride * h)])
+
+        with libcamera.utils.MappedFrameBuffer(fb) as mfb:
+            raw = mfb.as_ndarray(0, cfg)
+            self.assertEqual(raw.shape, (h, w * 10 // 8))
+
+            # Pixels 0x3ff, 0x001, 0x155, 0x2aa
+            raw[1, 0:5] = [0xff, 0x00, 0x55, 0xaa, 0b10_01_01_11]
+
+            info = libcamera.utils.PixelFormatInfo.info(cfg.pixel_format)
+            pixels = info.unpack(raw, w)
+            self.assertEqual(pixels.shape, (h, w))
+            self.assertEqual(pixels.dtype.itemsize, 2)
+            self.assertEqual(list(pixels[1, 0:4]), [0x3ff, 0x001, 0x155, 0x2aa])
+
+            del raw, pixels
+
+    def test_rgb565(self):
+        import numpy as np
+
+        w, h, stride = 16, 4, 32
+        data = bytearray(stride * h)
+        data[0:2] = bytes([0x12, 0x34])
+
+        for name, value in (('RGB565', 0x3412), ('RGB565_BE', 0x1234)):
+            info = libcamera.utils.PixelFormatInfo.info(name)
+            pixels = info.ndarray([data], 0, w, h, stride)
+
+            self.assertEqual(pixels.shape, (h, w))
+            self.assertEqual(int(pixels[0, 0]), value, name)
+
+            # The samples convert to native endian integers
+            self.assertEqual(int(pixels.astype(np.uint16)[0, 0]), value, name)
+
+
+def pack_csi2p(pixels, bits, stride):
+    """Pack rows of pixels to MIPI CSI-2 packed lines, bit by bit"""
+    ppg = {10: 4, 12: 2, 14: 4}[bits]
+    lsb_bits = bits - 8
+
+    data = bytearray()
+
+    for row in pixels:
+        row = list(row) + [0] * (-len(row) % ppg)
+        line = bytearray()
+
+        for g in range(0, len(row), ppg):
+            group = row[g:g + ppg]
+            lsb = 0
+            for i, p in enumerate(group):
+                lsb |= (p & ((1 << lsb_bits) - 1)) << (lsb_bits * i)
+
+            line += bytes(p >> lsb_bits for p in group)
+            line += lsb.to_bytes(ppg * lsb_bits // 8, 'little')
+
+        data += line + bytes(stride - len(line))
+
+    return bytes(data)
+
+
+class Csi2UnpackTestMethods(BaseTestCase):
+    def setUp(self):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            self.skipTest('No numpy found')
+
+    def unpack(self, name, data, w, h, stride):
+        import numpy as np
+
+        info = libcamera.utils.PixelFormatInfo.info(libcam.PixelFormat(name))
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(h, stride)
+        return info.unpack(raw, w)
+
+    def test_known_values(self):
+        # Pixels 0xfff, 0x001
+        pixels = self.unpack('SRGGB12_CSI2P', bytes([0xff, 0x00, 0x1f]), 2, 1, 3)
+        self.assertEqual(list(pixels[0]), [0xfff, 0x001])
+
+        # Pixels 0x3fff, 0x0001, 0x1555, 0x2aaa
+        pixels = self.unpack('SRGGB14_CSI2P',
+                             bytes([0xff, 0x00, 0x55, 0xaa, 0x7f, 0x50, 0xa9]), 4, 1, 7)
+        self.assertEqual(list(pixels[0]), [0x3fff, 0x0001, 0x1555, 0x2aaa])
+
+    def test_reference(self):
+        import numpy as np
+        import random
+
+        rnd = random.Random(1)
+
+        for bits in (10, 12, 14):
+            # Widths with and without partial groups at the end of the lines
+            for w in (8, 10, 13):
+                h = 3
+                stride = (w * bits // 8 + 16) // 16 * 16 + 16
+                pixels = [[rnd.randrange(1 << bits) for _ in range(w)] for _ in range(h)]
+
+                data = pack_csi2p(pixels, bits, stride)
+                res = self.unpack(f'SBGGR{bits}_CSI2P', data, w, h, stride)
+
+                self.assertEqual(res.dtype, np.uint16)
+                self.assertEqual(res.tolist(), pixels, f'{bits} bits, width {w}')
+
+    def test_out(self):
+        import numpy as np
+
+        info = libcamera.utils.PixelFormatInfo.info(libcam.PixelFormat('SRGGB12_CSI2P'))
+        raw = np.array([[0xff, 0x00, 0x1f, 0x00]] * 2, dtype=np.uint8)
+
+        # Also with a partial group at the end of the lines
+        for w in (2, 1):
+            out = np.zeros((2, w), dtype=np.uint16)
+            self.assertIs(info.unpack(raw, w, out), out)
+            self.assertEqual(out.tolist(), [[0xfff, 0x001][:w]] * 2)
+
+        bad = [
+            np.zeros((2, 3), dtype=np.uint16),
+            np.zeros((2, 2), dtype=np.uint32),
+            np.zeros((2, 4), dtype=np.uint16)[:, ::2],
+        ]
+
+        for out in bad:
+            with self.assertRaises(ValueError):
+                info.unpack(raw, 2, out)
+
+    def test_standalone(self):
+        import subprocess
+        import sys
+
+        # The unpacking module can be used without the bindings
+        utils_dir = os.path.dirname(libcamera.utils.__file__)
+        code = ('import sys; import csi2, numpy; '
+                'print(csi2.unpack_csi2p(numpy.array([[0xff, 0x00, 0x1f]], numpy.uint8), 2, 12).tolist(), '
+                "'libcamera' in sys.modules)")
+
+        out = subprocess.run([sys.executable, '-c', code], cwd=utils_dir, check=True,
+                             capture_output=True, text=True).stdout
+
+        self.assertEqual(out.strip(), '[[4095, 1]] False')
+
+    def test_ctt(self):
+        import numpy as np
+        import random
+        import sys
+
+        ctt_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '../../utils/raspberrypi/ctt')
+        sys.path.insert(0, ctt_dir)
+        try:
+            import ctt_image_load
+        except ImportError as e:
+            self.skipTest(f'ctt dependencies not available: {e}')
+        finally:
+            sys.path.remove(ctt_dir)
+
+        rnd = random.Random(2)
+
+        for bits, lin_len in ((10, 32), (12, 32), (14, 32)):
+            w, h = 16, 4
+            pixels = [[rnd.randrange(1 << bits) for _ in range(w)] for _ in range(h)]
+
+            img = ctt_image_load.Image(None)
+            img.w, img.h, img.pad, img.sigbits = w, h, 0, bits
+
+            self.assertEqual(img.get_image(pack_csi2p(pixels, bits, lin_len)), 1)
+
+            # The channels are scaled to 16 bits
+            expected = np.array(pixels, dtype=np.uint16) << (16 - bits)
+            self.assertEqual(img.channels[0].tolist(), expected[0::2, 0::2].tolist())
+            self.assertEqual(img.channels[3].tolist(), expected[1::2, 1::2].tolist())
+
+
+class ChecksumEngineTestMethods(BaseTestCase):
+    def test_crc32(self):
+        data = bytes(range(256)) * 1000 + b'\x42' * 123
+        planes = [memoryview(data), memoryview(data)[:1000], memoryview(b'')]
+
+        with libcamera.utils.ChecksumEngine('crc32', chunk_size=4096) as engine:
+            # The combined chunk CRCs match the CRC of the whole plane
+            self.assertEqual(engine.checksum(planes),
+                             [binascii.crc32(p) for p in planes])
+
+            res = engine.submit(planes, tag=42).result()
+            self.assertEqual(res.tag, 42)
+            self.assertEqual(len(res.checksums), 3)
+
+    def test_sampled(self):
+        data = bytearray(65536)
+
+        with libcamera.utils.ChecksumEngine('sampled', sample_step=4) as engine:
+            crc = engine.checksum([memoryview(data)])[0]
+
+            # Only every 4th block is sampled
+            data[4096] = 1
+            self.assertEqual(engine.checksum([memoryview(data)])[0], crc)
+            data[4 * 4096] = 1
+            self.assertNotEqual(engine.checksum([memoryview(data)])[0], crc)
+
+    def test_many_chunks(self):
+        data = bytes(range(256)) * 256
+        planes = [memoryview(data)[i:] for i in range(8)]
+
+        # Small chunks on many threads, completing concurrently
+        with libcamera.utils.ChecksumEngine('crc32', num_threads=8, chunk_size=64) as engine:
+            futs = [engine.submit(planes, tag=i) for i in range(16)]
+
+            for i, fut in enumerate(futs):
+                res = fut.result()
+                self.assertEqual(res.tag, i)
+                self.assertEqual(res.checksums, [binascii.crc32(p) for p in planes])
+
+    def test_algorithms(self):
+        with self.assertRaises(RuntimeError):
+            libcamera.utils.ChecksumEngine('md5')
+
+        if 'xxhash' not in libcamera.utils.ChecksumEngine.ALGORITHMS:
+            with self.assertRaisesRegex(RuntimeError, 'xxhash module'):
+                libcamera.utils.ChecksumEngine('xxhash')
+
+
+class FrameStoreTestMethods(BaseTestCase):
+    def setUp(self):
+        import tempfile
+        fd, self.filename = tempfile.mkstemp(suffix='.lcfs')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def write_frames(self, count):
+        streams = [libcamera.utils.FrameStoreStream('cam1-stream0', 'R8', 64, 4, 64)]
+
+        with libcamera.utils.FrameStoreWriter(self.filename, streams) as writer:
+            for i in range(count):
+                data = bytes([i]) * 256
+                writer.append(0, i * 2, i * 1000, [memoryview(data)], [len(data)],
+                              {'SensorTimestamp': i * 1000})
+
+    def test_read(self):
+        self.write_frames(10)
+
+        with libcamera.utils.FrameStoreReader(self.filename) as reader:
+            self.assertEqual(len(reader), 10)
+            self.assertEqual(reader.streams[0].name, 'cam1-stream0')
+
+            frame = reader[7]
+            self.assertEqual(frame.sequence, 14)
+            self.assertEqual(frame.timestamp, 7000)
+            self.assertEqual(frame.bytes_used, [256])
+            self.assertEqual(frame.metadata, {'SensorTimestamp': 7000})
+            self.assertEqual(bytes(frame.planes[0]), b'\x07' * 256)
+
+            del frame
+
+    def test_recover_index(self):
+        self.write_frames(5)
+
+        # Drop the index and the end of the last frame
+        size = os.path.getsize(self.filename)
+        os.truncate(self.filename, size - 5 * 24 - 20 - 16)
+
+        with libcamera.utils.FrameStoreReader(self.filename) as reader:
+            self.assertEqual(len(reader), 4)
+            self.assertEqual(reader[-1].sequence, 6)
+
+
+class MetadataStoreTestMethods(BaseTestCase):
+    def setUp(self):
+        import tempfile
+        fd, self.filename = tempfile.mkstemp(suffix='.lcmd')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_record(self):
+        fake = libcamera.fake
+
+        cm = fake.CameraManager([fake.FakeCameraOptions(fps=1000, width=64, height=32)])
+        cam = cm.cameras[0]
+        cam.acquire()
+
+        camconfig = cam.generate_configuration([libcam.StreamRole.Viewfinder])
+        cam.configure(camconfig)
+        stream = camconfig.at(0).stream
+
+        pool = libcamera.utils.RequestPool(cam, [stream], 0, fake.FrameBufferAllocator(cam),
+                                           limit=10)
+
+        ids = [libcam.controls.SensorTimestamp, libcam.controls.FrameDuration,
+               libcam.controls.Lux]
+
+        # Small chunks, to write the rows in several parts
+        writer = libcamera.utils.MetadataStoreWriter(self.filename, ['stream0'], ids,
+                                                     chunk_rows=4)
+
+        cam.start()
+        pool.start()
+
+        while pool.completed < 10:
+            for req in cm.wait_for_requests(1):
+                with pool.take(req):
+                    writer.append(req)
+
+        pool.stop()
+        cam.stop()
+        pool.close()
+        cam.release()
+
+        writer.close()
+
+        with libcamera.utils.MetadataStoreReader(self.filename) as reader:
+            self.assertEqual(len(reader), 10)
+            self.assertEqual(reader.streams, ['stream0'])
+            self.assertEqual(list(reader['stream0.sequence']), list(range(10)))
+            self.assertEqual(list(reader['SensorTimestamp']), list(reader['stream0.timestamp']))
+            self.assertTrue(all(reader['FrameDuration'] == 1000))
+            self.assertTrue(reader.present('FrameDuration').all())
+            self.assertFalse(reader.present('Lux').any())
+
+            row_size = reader.dtype.itemsize
+
+        # A partially written last row is ignored
+        os.truncate(self.filename, os.path.getsize(self.filename) - row_size // 2)
+
+        with libcamera.utils.MetadataStoreReader(self.filename) as reader:
+            self.assertEqual(len(reader), 9)
+
 
 # Recursively expand slist's objects into olist, using seen to track already
 # processed objects.
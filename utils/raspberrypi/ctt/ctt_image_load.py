@@ -90,75 +90,33 @@ class Image:
     def get_image(self, raw):
         self.dptr = []
         """
-        check if data is 10 or 12 bits
+        check if data is 10, 12 or 14 bits
         """
         if self.sigbits == 10:
             """
             calc length of scanline
             """
             lin_len = ((((((self.w+self.pad+3)>>2)) * 5)+31)>>5) * 32
-            """
-            stack scan lines into matrix
-            """
-            raw = np.array(raw).reshape(-1, lin_len).astype(np.int64)[:self.h, ...]
-            """
-            separate 5 bits in each package, stopping when w is satisfied
-            """
-            ba0 = raw[..., 0:5*((self.w+3)>>2):5]
-            ba1 = raw[..., 1:5*((self.w+3)>>2):5]
-            ba2 = raw[..., 2:5*((self.w+3)>>2):5]
-            ba3 = raw[..., 3:5*((self.w+3)>>2):5]
-            ba4 = raw[..., 4:5*((self.w+3)>>2):5]
-            """
-            assemble 10 bit numbers
-            """
-            ch0 = np.left_shift((np.left_shift(ba0, 2) + (ba4 % 4)), 6)
-            ch1 = np.left_shift((np.left_shift(ba1, 2) + (np.right_shift(ba4, 2) % 4)), 6)
-            ch2 = np.left_shift((np.left_shift(ba2, 2) + (np.right_shift(ba4, 4) % 4)), 6)
-            ch3 = np.left_shift((np.left_shift(ba3, 2) + (np.right_shift(ba4, 6) % 4)), 6)
-            """
-            interleave bits
-            """
-            mat = np.empty((self.h, self.w), dtype=ch0.dtype)
-
-            mat[..., 0::4] = ch0
-            mat[..., 1::4] = ch1
-            mat[..., 2::4] = ch2
-            mat[..., 3::4] = ch3
-
-            """
-            There is som eleaking memory somewhere in the code. This code here
-            seemed to make things good enough that the code would run for
-            reasonable numbers of images, however this is techincally just a
-            workaround. (sorry)
-            """
-            ba0, ba1, ba2, ba3, ba4 = None, None, None, None, None
-            del ba0, ba1, ba2, ba3, ba4
-            ch0, ch1, ch2, ch3 = None, None, None, None
-            del ch0, ch1, ch2, ch3
-
-            """
-        same as before but 12 bit case
-        """
         elif self.sigbits == 12:
             lin_len = ((((((self.w+self.pad+1)>>1)) * 3)+31)>>5) * 32
-            raw = np.array(raw).reshape(-1, lin_len).astype(np.int64)[:self.h, ...]
-            ba0 = raw[..., 0:3*((self.w+1)>>1):3]
-            ba1 = raw[..., 1:3*((self.w+1)>>1):3]
-            ba2 = raw[..., 2:3*((self.w+1)>>1):3]
-            ch0 = np.left_shift((np.left_shift(ba0, 4) + ba2 % 16), 4)
-            ch1 = np.left_shift((np.left_shift(ba1, 4) + (np.right_shift(ba2, 4)) % 16), 4)
-            mat = np.empty((self.h, self.w), dtype=ch0.dtype)
-            mat[..., 0::2] = ch0
-            mat[..., 1::2] = ch1
-
+        elif self.sigbits == 14:
+            lin_len = ((((((self.w+self.pad+3)>>2)) * 7)+31)>>5) * 32
         else:
             """
-            data is neither 10 nor 12 or incorrect data
+            data is neither 10, 12 nor 14 bits or incorrect data
             """
-            print('ERROR: wrong bit format, only 10 or 12 bit supported')
+            print('ERROR: wrong bit format, only 10, 12 or 14 bit supported')
             return 0
 
+        """
+        stack scan lines into matrix, unpack the pixels to 16 bit samples and
+        scale them to 16 bits
+        """
+        raw = np.frombuffer(raw, dtype=np.uint8)
+        raw = raw[:len(raw) // lin_len * lin_len].reshape(-1, lin_len)[:self.h, ...]
+        mat = unpack_csi2p(raw, self.w, self.sigbits)
+        mat <<= 16 - self.sigbits
+
         """
         separate bayer channels
         """
@@ -199,7 +157,7 @@ class Image:
                 Patch pixels are sorted by pixel brightness so spatial
                 information is lost.
                 '''
-                patch = ch[cen[1]-7:cen[1]+9, cen[0]-7:cen[0]+9].flatten()
+                patch = ch[cen[1]-7:cen[1]+9, cen[0]-7:cen[0]+9].astype(np.int32).flatten()
                 patch.sort()
                 if patch[-5] == (2**self.sigbits-1)*2**(16-self.sigbits):
                     self.saturated = True
@@ -429,7 +387,7 @@ def load_image(Cam, im_str, mac_config=None, show=False, mac=True, show_meta=Fal
         optional debug
         """
         if show and __name__ == '__main__':
-            copy = sum(Img.channels)/2**18
+            copy = sum(ch.astype(np.float64) for ch in Img.channels)/2**18
             copy = np.reshape(copy, (Img.h//2, Img.w//2)).astype(np.float64)
             copy, _ = reshape(copy, 800)
             represent(copy)
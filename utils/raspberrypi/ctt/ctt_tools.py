@@ -147,3 +147,36 @@ returns image and scale factor
 def reshape(img, width):
     factor = width/img.shape[0]
     return cv2.resize(img, None, fx=factor, fy=factor), factor
+
+
+"""
+unpack MIPI CSI-2 packed 10, 12 or 14 bit raw data to 16 bit samples
+
+raw is a (height, stride) uint8 array. Each group of pixels stores the 8 most
+significant bits of each pixel in one byte, followed by the remaining least
+significant bits of all the pixels of the group. The samples are returned in
+the low bits of a (height, width) uint16 array.
+
+The unpacker of the libcamera Python bindings is used when they are installed.
+"""
+try:
+    from libcamera.utils.csi2 import unpack_csi2p
+except ImportError:
+    def unpack_csi2p(raw, width, bits):
+        ppg = {10: 4, 12: 2, 14: 4}[bits]
+        lsb_bits = bits - 8
+        group_bytes = ppg + ppg * lsb_bits // 8
+        groups = (width + ppg - 1) // ppg
+        height = raw.shape[0]
+
+        src = raw[:, :groups * group_bytes].reshape(height, groups, group_bytes)
+        lsb = src[..., ppg].astype(np.uint32)
+        for i in range(1, group_bytes - ppg):
+            lsb |= src[..., ppg + i].astype(np.uint32) << (8 * i)
+
+        mat = np.empty((height, groups, ppg), dtype=np.uint16)
+        for i in range(ppg):
+            np.left_shift(src[..., i], lsb_bits, out=mat[..., i], dtype=np.uint16)
+            mat[..., i] |= ((lsb >> (lsb_bits * i)) & ((1 << lsb_bits) - 1)).astype(np.uint16)
+
+        return mat.reshape(height, groups * ppg)[:, :width]